@@ -0,0 +1,439 @@
+import argparse
+import configparser
+import json
+import os
+import time
+from math import radians, sin, cos, acos
+from urllib.request import urlopen
+
+import psycopg2
+from pyspark.sql.functions import udf, col, rand, floor, lit, sum as spark_sum
+from pyspark.sql.types import DoubleType as Dbl
+
+from data_quality import run_quality_checks
+from etl import create_spark_session, journey_distance_km, process_docking_station_data, \
+    process_station_pair_distances, process_weather_data, process_journey_data, journey_distance, process_rollups, \
+    JOURNEY_DATA, RENTAL_BUCKETS, MIN_RENTAL_BUCKETS
+from generate_data import write_source_data
+from lake_query import SAMPLE_QUERIES, connect as connect_lake, query
+from lake_writer import write_bucketed_parquet
+from loaders import connection_dsn
+from run_report import RunRecorder
+from spark_profiles import load_profile, input_size
+from table_definitions import TABLES
+
+
+def create_local_spark_session():
+    """Builds a local Spark session for benchmark runs, from the local-benchmark run profile"""
+
+    return create_spark_session(load_profile('local-benchmark'))
+
+
+def timed(label, action):
+    """Runs an action, prints and returns its wall time in seconds
+
+    :param label: (str): Benchmark case description
+    :param action: (callable): Zero argument function running the benchmarked work
+    :return: (float): Wall time in seconds
+    """
+
+    start = time.perf_counter()
+    action()
+    elapsed = time.perf_counter() - start
+    print(f'{label:<40} {elapsed:>8.2f}s')
+    return elapsed
+
+
+def legacy_journey_distance_calc(start_lat, start_lon, end_lat, end_lon):
+    """Original row-at-a-time journey distance calculation, kept as the benchmark baseline"""
+
+    slat = radians(float(start_lat))
+    slon = radians(float(start_lon))
+    elat = radians(float(end_lat))
+    elon = radians(float(end_lon))
+
+    if slat == elat and slon == elon:
+        dist = 0
+    else:
+        distance = 6371.01 * acos(sin(slat) * sin(elat) + cos(slat) * cos(elat) * cos(slon - elon))
+        return round(distance, 2)
+
+
+def benchmark_distance(spark, rows, stations):
+    """Compares journey distance calculation by Python UDF, native column expression and station pair lookup
+
+    - Generates synthetic journeys between randomly chosen docking stations in central London.
+    - Each case sums the calculated distances, so every row is evaluated but nothing is written.
+
+    :param spark: (object): Built spark session instance
+    :param rows: (int): No. of synthetic journeys
+    :param stations: (int): No. of synthetic docking stations
+    """
+
+    stations_df = spark.range(1, stations + 1) \
+        .select(col("id").cast("int").alias("docking_station_id"),
+                (51.45 + rand(1) * 0.1).alias("docking_station_latitude"),
+                (-0.25 + rand(2) * 0.2).alias("docking_station_longitude")) \
+        .cache()
+    stations_df.count()
+
+    journeys_df = spark.range(rows) \
+        .select(col("id").alias("rental_id"),
+                (floor(rand(3) * stations) + 1).cast("int").alias("start_station_id"),
+                (floor(rand(4) * stations) + 1).cast("int").alias("end_station_id")) \
+        .cache()
+    journeys_df.count()
+
+    start_df = stations_df.select(col("docking_station_id").alias("start_station_id"),
+                                  col("docking_station_latitude").alias("start_lat"),
+                                  col("docking_station_longitude").alias("start_lon"))
+    end_df = stations_df.select(col("docking_station_id").alias("end_station_id"),
+                                col("docking_station_latitude").alias("end_lat"),
+                                col("docking_station_longitude").alias("end_lon"))
+    coords_df = journeys_df.join(start_df, 'start_station_id').join(end_df, 'end_station_id').cache()
+    coords_df.count()
+
+    pairs_df = start_df.crossJoin(end_df) \
+        .withColumn("journey_distance_km", journey_distance_km(col("start_lat"), col("start_lon"),
+                                                                col("end_lat"), col("end_lon"))) \
+        .cache()
+    pairs_df.count()
+
+    distance_udf = udf(legacy_journey_distance_calc, Dbl())
+
+    print(f'Journey distance benchmark: {rows} journeys, {stations} stations')
+    legacy = timed('python udf', lambda: coords_df.agg(spark_sum(
+        distance_udf("start_lat", "start_lon", "end_lat", "end_lon"))).collect())
+    native = timed('native column expression', lambda: coords_df.agg(spark_sum(
+        journey_distance_km(col("start_lat"), col("start_lon"), col("end_lat"), col("end_lon")))).collect())
+    lookup = timed('station pair lookup join', lambda: journeys_df.join(
+        pairs_df, ['start_station_id', 'end_station_id']).agg(spark_sum("journey_distance_km")).collect())
+
+    print(f'native speedup x{legacy / native:.1f}, station pair lookup speedup x{legacy / lookup:.1f}')
+
+    for df in (stations_df, journeys_df, coords_df, pairs_df):
+        df.unpersist()
+
+
+def legacy_quality_checks(cur):
+    """Original record count and duplicate record checks, kept as the benchmark baseline"""
+
+    for _ in range(2):
+        cur.execute("SELECT * FROM information_schema.tables WHERE table_schema='public'")
+        table_list = [table[2] for table in cur.fetchall()]
+        for table_name in table_list:
+            cur.execute(f"SELECT COUNT(*) FROM {table_name}")
+            cur.fetchall()
+    for table_name in table_list:
+        cur.execute(f"SELECT DISTINCT COUNT(*) FROM {table_name}")
+        cur.fetchall()
+
+
+def benchmark_quality(dsn, workers):
+    """Compares wall time of the original serial data quality checks against the single scan, concurrent checks
+
+    :param dsn: (str): psycopg2 connection string of a loaded data warehouse
+    :param workers: (int): No. of tables checked at once
+    """
+
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+
+    print(f'Data quality check benchmark: {workers} workers')
+    legacy = timed('record count + duplicate record check', lambda: legacy_quality_checks(cur))
+    conn.close()
+    checks = timed('single scan concurrent checks', lambda: run_quality_checks(dsn, workers=workers))
+
+    print(f'speedup x{legacy / checks:.1f}')
+
+
+def peak_jvm_memory(spark):
+    """Gets the highest peak JVM heap plus off heap memory of the application's driver and executors
+
+    :param spark: (object): Built spark session instance
+    :return: (int): Peak memory in bytes, None when the Spark UI is disabled
+    """
+
+    ui_url = spark.sparkContext.uiWebUrl
+    if not ui_url:
+        return None
+    with urlopen(f'{ui_url}/api/v1/applications/{spark.sparkContext.applicationId}/allexecutors',
+                 timeout=10) as response:
+        executors = json.load(response)
+    peaks = [executor.get('peakMemoryMetrics') or {} for executor in executors]
+    return max((peak.get('JVMHeapMemory', 0) + peak.get('JVMOffHeapMemory', 0) for peak in peaks), default=None)
+
+
+def benchmark_scale(scales, stations, skew, data_dir, regenerate=False):
+    """Runs each ETL stage on local Spark over synthetic data at several scales
+
+    - Source data for each scale is generated once under the data directory, and reused unless regenerated.
+    - Each scale runs in a fresh Spark application, so its peak memory is its own.
+    - Throughput is journeys per second for every stage, so stages compare across scales.
+
+    :param scales: (list): No. of journeys of each scale
+    :param stations: (int): No. of docking stations
+    :param skew: (float): Station popularity skew, 1 for uniform
+    :param data_dir: (str): Directory of generated source data and written output
+    :param regenerate: (bool): Generate source data again, even if present
+    :return: (list): Result dicts of rows, stage, seconds and rows per second, and of each scale's peak memory
+    """
+
+    profile = load_profile('local-benchmark')
+    results = []
+    for rows in scales:
+        input_data = os.path.join(data_dir, str(rows), 'source_data', '')
+        output_data = os.path.join(data_dir, str(rows), 'lake', '')
+
+        if regenerate or not input_size(os.path.join(input_data, JOURNEY_DATA)):
+            spark = create_spark_session(profile)
+            write_source_data(spark, input_data, rows, stations, skew)
+            spark.stop()
+
+        spark = create_spark_session(profile, input_size(os.path.join(input_data, JOURNEY_DATA)))
+        journeys = {}
+
+        def run_journeys():
+            journeys['partitions'], _, journeys['df'] = process_journey_data(spark, input_data, output_data)
+
+        stages = [
+            ('process_docking_station_data', lambda: process_docking_station_data(spark, input_data, output_data,
+                                                                                  force=True)),
+            ('process_station_pair_distances', lambda: process_station_pair_distances(spark, output_data)),
+            ('process_weather_data', lambda: process_weather_data(spark, input_data, output_data, force=True)),
+            ('process_journey_data', run_journeys),
+            ('journey_distance', lambda: journey_distance(spark, output_data, output_data, journeys['partitions'],
+                                                          journeys['df'], bucket_partitioned=True)),
+            ('process_rollups', lambda: process_rollups(spark, output_data, journeys['partitions'], journeys['df'])),
+        ]
+
+        print(f'Scale benchmark: {rows} journeys, {stations} stations, skew {skew}')
+        try:
+            for stage, action in stages:
+                seconds = timed(stage, action)
+                results.append({'rows': rows, 'stage': stage, 'seconds': round(seconds, 3),
+                                'rows_per_second': round(rows / seconds) if seconds else None})
+        finally:
+            if journeys.get('df') is not None:
+                journeys['df'].unpersist(blocking=True)
+
+        peak_bytes = peak_jvm_memory(spark)
+        results.append({'rows': rows, 'stage': 'peak_jvm_memory', 'bytes': peak_bytes})
+        if peak_bytes is not None:
+            print(f"{'peak jvm memory':<40} {peak_bytes / (1024 * 1024):>8.0f}MB")
+        spark.stop()
+
+    return results
+
+
+def benchmark_bucketing(spark, rows, buckets, data_dir):
+    """Compares shuffle bytes and wall time of rental id joins and duplicate drops over plain and bucketed tables
+
+    - Writes synthetic journeys, with some duplicate rentals, and journey distances partitioned by month, once as plain
+      parquet files and once bucketed and sorted by rental id as etl.py writes them.
+    - Broadcast joins are disabled, so the plain join is the sort merge join a large fact table join would be.
+    - Shuffle bytes of each case are fetched from the Spark UI REST API, as for a run report.
+
+    :param spark: (object): Built spark session instance
+    :param rows: (int): No. of synthetic journeys
+    :param buckets: (int): No. of rental id buckets
+    :param data_dir: (str): Directory of the written tables
+    :return: (list): Result dicts of case, seconds and shuffle read and write bytes
+    """
+
+    partition_columns = ['rental_start_year_', 'rental_start_month_']
+    journeys_df = spark.range(rows) \
+        .select((col('id') % int(rows * 0.99) + 1).cast('int').alias('rental_id'),
+                (floor(rand(1) * 12000) + 1).cast('int').alias('bike_id'),
+                (floor(rand(2) * 3600) + 60).cast('int').alias('rental_duration_seconds'),
+                lit(2012).alias('rental_start_year_'),
+                (col('id') % 12 + 1).cast('int').alias('rental_start_month_'))
+    distances_df = journeys_df.select('rental_id', (rand(3) * 8).alias('journey_distance_km'), *partition_columns) \
+        .dropDuplicates(['rental_id'])
+
+    for name, df in (('journeys', journeys_df), ('journey_distances', distances_df)):
+        df.write.partitionBy(*partition_columns).mode('overwrite').parquet(os.path.join(data_dir, 'plain', name))
+        write_bucketed_parquet(spark, df, os.path.join(data_dir, 'bucketed', name), f'benchmark_{name}',
+                               partition_columns, 'rental_id', buckets)
+
+    def plain(name):
+        return spark.read.parquet(os.path.join(data_dir, 'plain', name))
+
+    def bucketed(name):
+        return spark.table(f'benchmark_{name}')
+
+    cases = []
+    for layout, read in (('plain', plain), ('bucketed', bucketed)):
+        cases += [
+            (f'{layout} rental id join', lambda read=read: read('journeys').join(read('journey_distances'), 'rental_id')
+             .agg(spark_sum('journey_distance_km')).collect()),
+            (f'{layout} rental id duplicate drop', lambda read=read: read('journeys')
+             .dropDuplicates(['rental_id']).count()),
+        ]
+
+    broadcast_threshold = spark.conf.get('spark.sql.autoBroadcastJoinThreshold')
+    spark.conf.set('spark.sql.autoBroadcastJoinThreshold', '-1')
+    recorder = RunRecorder(spark, enabled=True)
+    print(f'Bucketing benchmark: {rows} journeys, {buckets} buckets')
+    try:
+        for case, action in cases:
+            with recorder.stage(case):
+                timed(case, action)
+    finally:
+        spark.conf.set('spark.sql.autoBroadcastJoinThreshold', broadcast_threshold)
+
+    results = [{'case': stage['stage'], 'seconds': stage['wall_seconds'],
+                'shuffle_read_bytes': stage.get('shuffle_read_bytes'),
+                'shuffle_write_bytes': stage.get('shuffle_write_bytes')} for stage in recorder.stages]
+    for result in results:
+        if result['shuffle_write_bytes'] is not None:
+            print(f"{result['case']:<40} {result['shuffle_write_bytes'] / (1024 * 1024):>8.1f}MB shuffle written")
+    return results
+
+
+def benchmark_lake_query(spark, output_data, repeat=3):
+    """Compares the README sample queries run by the embedded DuckDB query layer and by Spark SQL, over the data lake
+
+    - Both engines see each table as a view of its parquet files, year and month read from the partition directories.
+    - Each query runs once to warm file caches, then the best of the repeated runs is kept.
+
+    :param spark: (object): Built spark session instance
+    :param output_data: (str): Data lake path written by etl.py
+    :param repeat: (int): Timed runs of each query
+    :return: (list): Result dicts of query, rows and best seconds of each engine
+    """
+
+    for table in TABLES.values():
+        lake_partitions = dict(zip(table.partitions, table.lake_partitions))
+        spark.read.parquet(output_data + table.lake_path) \
+            .select(*[col(lake_partitions.get(column.name, column.name)).cast(column.spark_type).alias(column.name)
+                      for column in table.columns]) \
+            .createOrReplaceTempView(table.name)
+    spark.conf.set('spark.sql.ansi.doubleQuotedIdentifiers', 'true')
+    con = connect_lake(output_data)
+
+    def best_of(action):
+        action()
+        return min(timed_quietly(action) for _ in range(repeat))
+
+    def timed_quietly(action):
+        start = time.perf_counter()
+        action()
+        return time.perf_counter() - start
+
+    print(f'Lake query benchmark: best of {repeat} runs')
+    results = []
+    for name, sql in SAMPLE_QUERIES.items():
+        rows = {}
+        duckdb_seconds = best_of(lambda: rows.update(duckdb=query(con, sql).num_rows))
+        spark_seconds = best_of(lambda: rows.update(spark=len(spark.sql(sql).collect())))
+        if rows['duckdb'] != rows['spark']:
+            print(f"{name}: {rows['duckdb']} rows from duckdb, {rows['spark']} from spark")
+        print(f'{name:<40} duckdb {duckdb_seconds:>7.2f}s spark {spark_seconds:>7.2f}s '
+              f'x{spark_seconds / duckdb_seconds:.1f}')
+        results.append({'query': name, 'rows': rows['duckdb'], 'duckdb_seconds': round(duckdb_seconds, 3),
+                        'spark_seconds': round(spark_seconds, 3)})
+
+    con.close()
+    return results
+
+
+def scale_regressions(results, baseline, tolerance):
+    """Compares stage times with a baseline run, listing stages slower by more than the tolerance
+
+    :param results: (list): Results of benchmark_scale
+    :param baseline: (list): Results of an earlier benchmark_scale run
+    :param tolerance: (float): Allowed slow down, eg. 0.2 for 20%
+    :return: (list): Regression descriptions
+    """
+
+    baseline_seconds = {(result['rows'], result['stage']): result['seconds'] for result in baseline
+                        if 'seconds' in result}
+    regressions = []
+    for result in results:
+        previous = baseline_seconds.get((result['rows'], result['stage']))
+        if 'seconds' in result and previous and result['seconds'] > previous * (1 + tolerance):
+            regressions.append(f"{result['stage']} at {result['rows']} journeys took {result['seconds']:.2f}s, "
+                               f"baseline {previous:.2f}s")
+    return regressions
+
+
+def main():
+    """Benchmark script function"""
+
+    parser = argparse.ArgumentParser(description='LndBikeHire ETL benchmarks on local Spark')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    distance_parser = subparsers.add_parser('distance', help='journey distance calculation')
+    distance_parser.add_argument('--rows', type=int, default=5000000)
+    distance_parser.add_argument('--stations', type=int, default=800)
+
+    quality_parser = subparsers.add_parser('quality', help='data warehouse data quality checks')
+    quality_parser.add_argument('--section', default='POSTGRES', help='dl.cfg section of the database connection')
+    quality_parser.add_argument('--workers', type=int, default=4)
+
+    scale_parser = subparsers.add_parser('scale', help='ETL stages over synthetic data at several scales')
+    scale_parser.add_argument('--scales', type=int, nargs='+', default=[100000, 1000000, 10000000])
+    scale_parser.add_argument('--stations', type=int, default=800)
+    scale_parser.add_argument('--skew', type=float, default=1.5)
+    scale_parser.add_argument('--data-dir', default='data/benchmark')
+    scale_parser.add_argument('--regenerate', action='store_true', help='generate source data again, if present')
+    scale_parser.add_argument('--output', default='benchmark_scale.json', help='results file')
+    scale_parser.add_argument('--baseline', help='results file of an earlier run, stages slower than it fail the run')
+    scale_parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slow down against the baseline')
+
+    bucketing_parser = subparsers.add_parser('bucketing', help='rental id joins and duplicate drops, plain vs bucketed')
+    bucketing_parser.add_argument('--rows', type=int, default=5000000)
+    bucketing_parser.add_argument('--buckets', type=int, default=RENTAL_BUCKETS or MIN_RENTAL_BUCKETS)
+    bucketing_parser.add_argument('--data-dir', default='data/benchmark/bucketing')
+    bucketing_parser.add_argument('--output', help='results file')
+
+    lake_query_parser = subparsers.add_parser('lake-query', help='README sample queries, duckdb vs spark sql')
+    lake_query_parser.add_argument('--profile', default='local-benchmark', help='Spark run profile of the data lake')
+    lake_query_parser.add_argument('--repeat', type=int, default=3)
+    lake_query_parser.add_argument('--output', help='results file')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'distance':
+        spark = create_local_spark_session()
+        benchmark_distance(spark, args.rows, args.stations)
+        spark.stop()
+    elif args.benchmark == 'quality':
+        config = configparser.ConfigParser()
+        config.read('aws/dl.cfg')
+        benchmark_quality(connection_dsn(config, args.section), args.workers)
+    elif args.benchmark == 'bucketing':
+        spark = create_local_spark_session()
+        results = benchmark_bucketing(spark, args.rows, args.buckets, args.data_dir)
+        spark.stop()
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(results, file, indent=2)
+            print(f'Results written to {args.output}')
+    elif args.benchmark == 'lake-query':
+        profile = load_profile(args.profile)
+        spark = create_spark_session(profile)
+        results = benchmark_lake_query(spark, profile.output_data, args.repeat)
+        spark.stop()
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(results, file, indent=2)
+            print(f'Results written to {args.output}')
+    elif args.benchmark == 'scale':
+        results = benchmark_scale(args.scales, args.stations, args.skew, args.data_dir, args.regenerate)
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f'Results written to {args.output}')
+
+        if args.baseline:
+            with open(args.baseline) as file:
+                regressions = scale_regressions(results, json.load(file), args.tolerance)
+            for regression in regressions:
+                print(f'REGRESSION, {regression}')
+            if regressions:
+                raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
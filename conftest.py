@@ -0,0 +1 @@
+# pytest adds this directory to sys.path, so tests import the project scripts as modules
@@ -1,6 +1,8 @@
+import argparse
 import configparser
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from loaders import connection_dsn
+from sql_queries import create_table_queries, drop_table_queries, postgres_create_table_queries
 
 
 def drop_tables(cur, conn):
@@ -14,12 +16,13 @@ def drop_tables(cur, conn):
         print('Success! table dropped')
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, backend='redshift'):
     """
     Creates each table using the queries in `create_table_queries` list.
+    A PostgreSQL stand-in database uses `postgres_create_table_queries`, without Redshift only table attributes.
     """
 
-    for query in create_table_queries:
+    for query in postgres_create_table_queries if backend == 'postgres' else create_table_queries:
         cur.execute(query)
         conn.commit()
         print('Success! table created')
@@ -27,7 +30,8 @@ def create_tables(cur, conn):
 
 def main():
     """
-    - Establishes connection with Redshift cluster and lndbikehire database and gets cursor to it.
+    - Establishes connection with Redshift cluster, or a local PostgreSQL stand-in, and lndbikehire database and gets
+      cursor to it.
 
     - Drops all the tables, if exist.
 
@@ -36,14 +40,19 @@ def main():
     - Finally, closes the connection.
     """
 
+    parser = argparse.ArgumentParser(description='Create LndBikeHire data warehouse tables')
+    parser.add_argument('--backend', choices=['redshift', 'postgres'], default='redshift',
+                        help='redshift: the [CLUSTER] database, postgres: the [POSTGRES] database')
+    args = parser.parse_args()
+
     config = configparser.ConfigParser()
     config.read('aws/dl.cfg')
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    conn = psycopg2.connect(connection_dsn(config, 'CLUSTER' if args.backend == 'redshift' else 'POSTGRES'))
     cur = conn.cursor()
 
     drop_tables(cur, conn)
-    create_tables(cur, conn)
+    create_tables(cur, conn, args.backend)
 
     conn.close()
 
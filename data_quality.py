@@ -0,0 +1,99 @@
+from collections import namedtuple
+
+from loaders import run_pooled
+from table_definitions import TABLES
+
+# Declared data quality checks for each table, from the table definitions
+#   keys: columns identifying a row, checked for duplicates
+#   not_null: columns that must not hold nulls
+#   timestamps: columns reported with their min and max values
+TABLE_CHECKS = {
+    name: {
+        'keys': list(table.keys),
+        'not_null': [column.name for column in table.columns if column.not_null],
+        'timestamps': [column.name for column in table.columns if column.sql_type in ('TIMESTAMP', 'DATE')],
+    }
+    for name, table in TABLES.items()
+}
+
+TableQualityResult = namedtuple('TableQualityResult', [
+    'table',             # table name
+    'row_count',         # No. of rows
+    'duplicate_keys',    # No. of rows sharing a key with another row
+    'null_counts',       # dict of No. of nulls in each NOT NULL column
+    'timestamp_ranges',  # dict of (min, max) of each timestamp column
+    'failures',          # list of failed check descriptions, empty when the table passed
+])
+
+
+def quality_query(table, checks):
+    """Builds a single query computing every data quality metric of a table in one scan
+
+    :param table: (str): Table name
+    :param checks: (dict): Declared checks of the table, as per TABLE_CHECKS
+    :return: (str): SQL query, returning one row of metrics
+    """
+
+    keys = checks['keys']
+    if len(keys) == 1:
+        key_expression = keys[0]
+    else:
+        key_expression = " || '|' || ".join(f"COALESCE(CAST({key} AS VARCHAR), '')" for key in keys)
+
+    metrics = ['COUNT(*)', f'COUNT({key_expression}) - COUNT(DISTINCT {key_expression})']
+    metrics += [f'SUM(CASE WHEN {column} IS NULL THEN 1 ELSE 0 END)' for column in checks['not_null']]
+    for column in checks['timestamps']:
+        metrics += [f'MIN({column})', f'MAX({column})']
+
+    return f"SELECT {', '.join(metrics)} FROM {table}"
+
+
+def check_table(cur, table, checks):
+    """Runs the data quality checks of a table
+
+    :param cur: (object): Database cursor
+    :param table: (str): Table name
+    :param checks: (dict): Declared checks of the table, as per TABLE_CHECKS
+    :return: (object): TableQualityResult
+    """
+
+    cur.execute(quality_query(table, checks))
+    metrics = list(cur.fetchone())
+
+    row_count, duplicate_keys = metrics[0], metrics[1]
+    null_counts = {column: metrics[2 + index] or 0 for index, column in enumerate(checks['not_null'])}
+    offset = 2 + len(checks['not_null'])
+    timestamp_ranges = {column: (metrics[offset + 2 * index], metrics[offset + 2 * index + 1])
+                        for index, column in enumerate(checks['timestamps'])}
+
+    failures = []
+    if row_count == 0:
+        failures.append('no records')
+    if duplicate_keys:
+        failures.append(f"{duplicate_keys} duplicate records on {', '.join(checks['keys'])}")
+    failures += [f'{nulls} nulls in NOT NULL column {column}' for column, nulls in null_counts.items() if nulls]
+
+    return TableQualityResult(table, row_count, duplicate_keys, null_counts, timestamp_ranges, failures)
+
+
+def format_result(result):
+    """Formats a table's data quality result as a single line"""
+
+    ranges = ''.join(f', {column} {low} to {high}' for column, (low, high) in result.timestamp_ranges.items())
+    if result.failures:
+        return f"WARNING, {result.table} failed checks: {'; '.join(result.failures)}"
+    return f"SUCCESS, {result.table} has {result.row_count} records, no duplicates or nulls{ranges}"
+
+
+def run_quality_checks(dsn, table_checks=None, workers=4):
+    """Runs data quality checks on tables concurrently, a single scan of each table
+
+    :param dsn: (str): psycopg2 connection string
+    :param table_checks: (dict): Declared checks of each table, defaults to TABLE_CHECKS
+    :param workers: (int): No. of tables checked at once
+    :return: (dict): TableQualityResult of each table
+    """
+
+    table_checks = table_checks or TABLE_CHECKS
+    return run_pooled(dsn, lambda cur, table: check_table(cur, table, table_checks[table]), list(table_checks),
+                      workers, lambda table, result: print(format_result(result)))
@@ -1,94 +1,104 @@
+import argparse
 import configparser
-import psycopg2
-from sql_queries import copy_table_queries
+from data_quality import run_quality_checks
+from loaders import connection_dsn, load_tables, postgres_backend, redshift_backend, upsert_backend, \
+    fingerprint_backend, lake_fingerprints, loaded_fingerprints, lake_table_digests, start_load_run, finish_load_run, \
+    run_state_backend
+from sql_queries import table_copy_queries, table_lake_paths, table_names, table_partitions
 
 
-def load_parquet_tables(cur, conn):
-    """
-    Executes SQL COPY queries to load partitioned parquet data from S3 datalake to data warehouse tables.
-    """
-
-    for query in copy_table_queries:
-        cur.execute(query)
-        conn.commit()
-        print('Success, table data loaded!')
-
-
-def record_count(cur, conn):
-    """
-    Data quality check - Confirm table record counts after data load
-    - Gets user created tables from database
-    - Check for at least 1 record and return table record count
-    """
-    # get all created tables from db
-    cur.execute("SELECT * FROM information_schema.tables WHERE table_schema='public'")
-    result = cur.fetchall()
-
-    # create list of tables
-    table_list = [table[2] for table in result]
-
-    print('Verifying table record counts...')
-
-    # get row count for each table
-    for table_name in table_list:
-        cur.execute(f"SELECT COUNT(*) FROM {table_name}")
-        row_count = cur.fetchall()
-        if row_count == 0:
-            print(f"WARNING, record count for {table_name} is zero '0'")
-        else:
-            print(f"SUCCESS, {row_count[0][0]} record count for {table_name} looks good!")
-
-
-def duplicate_record_check(cur):
-    """
-    Data quality check - Confirm distinct table records after data load
-    - Gets user created tables from database
-    - Compares table record count against distinct record count
+def main():
     """
-    # get all created tables from db
-    cur.execute("SELECT * FROM information_schema.tables WHERE table_schema='public'")
-    result = cur.fetchall()
+    - Loads all table data from partitioned parquet files, with the chosen loader backend.
+      redshift: SQL COPY queries of S3 hosted parquet files, run by the Redshift cluster.
+      postgres: parquet files streamed in batches to a PostgreSQL compatible database with binary COPY.
+      Tables are loaded concurrently over a small connection pool.
 
-    # create list of tables
-    table_list = [table[2] for table in result]
+    - Or, in upsert mode, merges only changed year/month partitions into the partitioned tables. Each table's partitions
+      are staged, then replace the table's rows for those partitions and keys in a single transaction.
 
-    print('Checking tables for duplicate records...')
+    - Dimension tables whose source fingerprint, recorded by etl.py, is unchanged since their last load are skipped.
+      Changed ones are replaced in full, in either mode.
 
-    # check each table for duplicates
-    for table_name in table_list:
-        cur.execute(f"SELECT COUNT(*) FROM {table_name}")
-        row_count = cur.fetchall()
-        cur.execute(f"SELECT DISTINCT COUNT(*) FROM {table_name}")
-        distinct_count = cur.fetchall()
-        if row_count[0][0] == distinct_count[0][0]:
-            print(f"GREAT, no duplicate records found in {table_name}!")
-        elif distinct_count[0][0] < row_count[0][0]:
-            print(f"WARNING, duplicate records found! {distinct_count[0][0]}"
-                  f"distinct record count is less than total record count of {row_count[0][0]}")
+    - Each table's load is recorded in its load transaction. A resumed load skips the tables it committed, unless
+      their data lake files have changed since, then replaces their rows.
 
+    - Runs data quality checks on the loaded tables, concurrently and in a single scan of each table.
+      Row count, duplicates on the table key, nulls in NOT NULL columns and timestamp ranges.
 
-def main():
+    - Exits with an error if any table fails its checks.
     """
-    - Establishes connection with Redshift cluster and LndBikeHire database and gets cursor to it.
 
-    - Loads all table data from partitioned S3 hosted parquet files.
-
-    - Load data from staging tables to fact and dimension tables.
-
-    - Closes the connection.
-    """
+    parser = argparse.ArgumentParser(description='Load LndBikeHire parquet files to data warehouse tables')
+    parser.add_argument('--backend', choices=['redshift', 'postgres'], default='redshift',
+                        help='redshift: S3 COPY on the [CLUSTER], postgres: binary COPY to the [POSTGRES] database')
+    parser.add_argument('--workers', type=int, default=3, help='No. of tables loaded at once')
+    parser.add_argument('--mode', choices=['reload', 'upsert'], default='reload',
+                        help='reload: COPY every table in full, upsert: merge changed partitions of partitioned tables')
+    parser.add_argument('--partitions', nargs='+', metavar='YYYY-MM', default=[],
+                        help='changed year/month partitions, upsert mode only')
+    parser.add_argument('--force', action='store_true',
+                        help='load docking station and weather tables even if unchanged since the last load')
+    parser.add_argument('--resume', action='store_true',
+                        help='resume the last load, skipping the tables it committed, with the same arguments')
+    args = parser.parse_args()
+
+    if args.mode == 'upsert' and not args.partitions:
+        parser.error('--mode upsert requires --partitions')
+    partitions = {tuple(int(part) for part in partition.split('-')) for partition in args.partitions}
 
     config = configparser.ConfigParser()
     config.read('aws/dl.cfg')
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
-
-    load_parquet_tables(cur, conn)
-    record_count(cur, conn)
-    duplicate_record_check(cur)
-
-    conn.close()
+    if args.backend == 'redshift':
+        dsn = connection_dsn(config, 'CLUSTER')
+        lake_data = config.get('S3', 'OUTPUT_DATA', fallback='')
+        copy_table = redshift_backend(table_copy_queries, lake_data, table_lake_paths, table_partitions)
+    else:
+        dsn = connection_dsn(config, 'POSTGRES')
+        lake_data = config.get('POSTGRES', 'LAKE_DATA', fallback=config.get('S3', 'OUTPUT_DATA', fallback=''))
+        copy_table = postgres_backend(lake_data, table_lake_paths, table_partitions)
+
+    # a resumed load picks up from the tables the last load committed
+    run = start_load_run(dsn, {'backend': args.backend, 'mode': args.mode, 'partitions': sorted(args.partitions),
+                               'force': args.force}, args.resume)
+    if run is None:
+        return
+    run_id, run_loaded = run
+    table_digests = lake_table_digests(lake_data, table_lake_paths, table_names)
+    committed = {table for table, digest in run_loaded.items() if table_digests.get(table) == digest}
+    for table in sorted(committed):
+        print(f'Skipped {table}, loaded earlier in this run')
+    reloaded = {table: digest for table, digest in run_loaded.items() if table not in committed}
+
+    # fingerprinted dimension tables are loaded only when their data lake files changed since the last load
+    digests = lake_fingerprints(lake_data, table_names)
+    loaded = loaded_fingerprints(dsn)
+    unchanged = set() if args.force else {table for table, digest in digests.items() if loaded.get(table) == digest}
+    for table in sorted(unchanged - committed):
+        print(f'Skipped {table}, its data lake files are unchanged since the last load')
+    unchanged |= committed
+    changed_dimensions = [table for table in table_names if table in digests and table not in unchanged]
+    load_table = fingerprint_backend(copy_table, {table: digests[table] for table in changed_dimensions})
+    load_table = run_state_backend(load_table, run_id, table_digests, reloaded)
+
+    if args.mode == 'upsert':
+        print(f"Merging partitions {', '.join(sorted(args.partitions))}...")
+        load_tables(dsn, run_state_backend(upsert_backend(copy_table, table_partitions, partitions), run_id,
+                                           table_digests),
+                    [table for table in table_names
+                     if table in table_partitions and table not in digests and table not in committed],
+                    args.workers)
+        if changed_dimensions:
+            load_tables(dsn, load_table, changed_dimensions, args.workers)
+    else:
+        load_tables(dsn, load_table, [table for table in table_names if table not in unchanged], args.workers)
+
+    print('Running data quality checks...')
+    results = run_quality_checks(dsn, workers=args.workers)
+    if any(result.failures for result in results.values()):
+        raise SystemExit('Data quality checks failed!')
+    finish_load_run(dsn, run_id)
 
 
 if __name__ == "__main__":
@@ -1,104 +1,503 @@
+import argparse
 import configparser
+import json
+import math
 import os
+from datetime import datetime
+from urllib.parse import unquote
 
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
-from math import radians, sin, cos, acos
-from pyspark.sql.functions import udf, col
+from pyspark.sql.functions import col, lit, when, least, greatest, broadcast
+from pyspark.sql.functions import radians, sin, cos, acos, round as spark_round
 from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format, from_unixtime, dayofweek
 from pyspark.sql.functions import to_timestamp, to_date, unix_timestamp
-from pyspark.sql.functions import explode
+from pyspark.sql.functions import explode, input_file_name
+from pyspark.sql.functions import floor, trunc, add_months, min as spark_min, max as spark_max
+from pyspark.sql.functions import count, first, sum as spark_sum
 from pyspark.sql.types import StructType as R, StructField as Fld, DoubleType as Dbl, StringType as Str, \
-    IntegerType as Int, DateType as Date, TimestampType
+    IntegerType as Int, LongType as Long, DateType as Date, TimestampType, ArrayType
+from pyspark.sql.utils import AnalysisException
+
+from lake_fs import hadoop_path, total_size, list_files, read_text, write_text, source_fingerprint, delete_path, \
+    promote_staged
+from lake_writer import write_partitioned_parquet, write_bucketed_parquet, register_bucketed_table, layout_options
+from run_report import RunRecorder, write_run_report, write_prometheus_textfile
+from run_state import start_run, finish_run, checkpoint_stages
+from stage_scheduler import Stage, run_stages
+from spark_profiles import DEFAULT_PROFILE, profile_names, load_profile, input_size, session_settings, \
+    log_effective_config, task_slots
+from table_definitions import TABLES, FINGERPRINT_DIR, INGEST_COUNT_DIR, spark_schema, spark_columns, lake_schema, \
+    table_layout, partition_key
 
 config = configparser.ConfigParser()
 config.read('aws/dl.cfg')
 
-os.environ['AWS_ACCESS_KEY_ID'] = config['AWS']['AWS_ACCESS_KEY_ID']
-os.environ['AWS_SECRET_ACCESS_KEY'] = config['AWS']['AWS_SECRET_ACCESS_KEY']
+if config.has_section('AWS'):
+    os.environ['AWS_ACCESS_KEY_ID'] = config['AWS']['AWS_ACCESS_KEY_ID']
+    os.environ['AWS_SECRET_ACCESS_KEY'] = config['AWS']['AWS_SECRET_ACCESS_KEY']
+
+# output file sizing for partitioned parquet writers
+WRITE_OPTIONS = {
+    'target_file_bytes': config.getint('ETL', 'TARGET_FILE_MB', fallback=128) * 1024 * 1024,
+    'max_records_per_file': config.getint('ETL', 'MAX_RECORDS_PER_FILE', fallback=5000000),
+}
+
+# No. of rental_id buckets in each partition of the journeys and journey distances tables, the two must match for
+# bucket to bucket joins, and a changed count needs a full run to rewrite the tables. Set by each full run from the
+# profile's task slots and input size, or fixed in the config, and recorded with the data lake for the runs that
+# follow once both tables are written. MIN_RENTAL_BUCKETS is the count before a full run has recorded one. A full
+# run's count is held in the Spark session setting while it runs
+RENTAL_BUCKETS = config.getint('ETL', 'RENTAL_BUCKETS', fallback=None)
+MIN_RENTAL_BUCKETS = 16
+RENTAL_BUCKETS_RECORD = 'manifests/rental_buckets.json'
+RENTAL_BUCKETS_SETTING = 'etl.rentalBuckets'
+
+# data lake directory tables are written to before they are moved into place, relative to output data
+TABLE_STAGING_DIR = 'staging/tables/'
+
+# record partition row counts at each ingest step for reconcile.py, counted from data already persisted or written
+RECORD_INGEST_COUNTS = config.getboolean('ETL', 'INGEST_COUNTS', fallback=True)
+
+# also record raw journey rows before the start date filter, these aren't kept so costs an extra pass of the csv files
+RECORD_RAW_COUNTS = config.getboolean('ETL', 'INGEST_RAW_COUNTS', fallback=False)
+
+# tables stream micro-batches append to, the rest of the tables they write are rewritten by partition
+STREAM_APPENDED_TABLES = ('fact_journeys', 'dim_journey_distances')
+
+# maximum stages running at once in each FAIR scheduler pool, as per fairscheduler.xml
+STAGE_POOL_LIMITS = {'dimensions': 2, 'journeys': 1}
+
+# mean earth radius used by the journey distance calculation
+EARTH_RADIUS_KM = 6371.01
+
+# bike hire data files, relative to input data - Select 1 of 3 options below
+# JOURNEY_DATA = 'journey/2012/11. Journey Data Extract 23Aug-25 Aug12.csv'
+JOURNEY_DATA = 'journey/2012/*.csv'
+# JOURNEY_DATA = 'journey/*/*.csv'
+
+JOURNEY_SCHEMA = R([
+    Fld('Rental Id', Int(), True),
+    Fld('Duration', Int()),
+    Fld('Bike Id', Int()),
+    Fld('End Date', Str()),
+    Fld('EndStation Id', Int()),
+    Fld('EndStation Name', Str()),
+    Fld('Start Date', Str()),
+    Fld('StartStation Id', Int()),
+    Fld('StartStation Name', Str()),
+])
+
+# estimated persisted size of staged journeys relative to their source csv, station name text isn't kept
+STAGED_BYTES_PER_SOURCE_BYTE = 0.5
+
+# source files of the dimension tables skipped when their sources are unchanged, relative to input data
+DIMENSION_SOURCES = {
+    'dim_docking_stations': 'infrastructure/FOI-0689-2122.csv',
+    'dim_daily_weather': 'weather/*.json',
+}
+
+# data lake directories written by each stage, a resumed run only skips a completed stage while they are present
+STAGE_OUTPUTS = {
+    'process_journey_data': [TABLES['dim_time'].lake_path, TABLES['fact_journeys'].lake_path],
+    'process_docking_station_data': [TABLES['dim_docking_stations'].lake_path],
+    'process_station_pair_distances': ['infrastructure/station_pair_distances'],
+    'process_weather_data': [TABLES['dim_daily_weather'].lake_path],
+    'journey_distance': [TABLES['dim_journey_distances'].lake_path],
+    'process_rollups': [TABLES[name].lake_path
+                        for name in ('rollup_station_daily', 'rollup_hour_of_week', 'rollup_daily_weather_demand')],
+}
+
+# kept fields of a daily weather observation, the rest of the nested weather files are never parsed
+WEATHER_DAY_SCHEMA = R([
+    Fld('datetime', Str()),
+    Fld('conditions', Str()),
+    Fld('description', Str()),
+    Fld('temp', Dbl()),
+    Fld('tempmin', Dbl()),
+    Fld('tempmax', Dbl()),
+    Fld('precip', Dbl()),
+    Fld('windspeed', Dbl()),
+    Fld('sunrise', Str()),
+    Fld('sunset', Str()),
+])
+WEATHER_SCHEMA = R([Fld('days', ArrayType(WEATHER_DAY_SCHEMA))])
+
+# ingested journey source files and the rental start partitions each file holds rows for
+JOURNEY_MANIFEST_SCHEMA = R([
+    Fld('source_file', Str()),
+    Fld('rental_start_year', Int()),
+    Fld('rental_start_month', Int()),
+    Fld('row_count', Long()),
+    Fld('ingested_at', TimestampType()),
+])
+
+
+def create_spark_session(profile, input_bytes=None):
+    """Builds a Spark session from a run profile, sized to the measured input
+
+    :param profile: (object): SparkProfile, as per spark_profiles.load_profile
+    :param input_bytes: (int): Measured journey input size, None for the profile's minimum sizes
+    :return: (object): Spark session
+    """
 
+    settings = session_settings(profile, input_bytes)
 
-def create_spark_session():
-    """Builds a Spark session"""
+    builder = SparkSession.builder.appName(profile.app_name)
+    if profile.master:
+        builder = builder.master(profile.master)
+    for key, value in settings.items():
+        builder = builder.config(key, value)
+    spark = builder.getOrCreate()
 
-    spark = SparkSession \
-        .builder \
-        .appName("LndBikeHireDataProcessing") \
-        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
-        .getOrCreate()
+    log_effective_config(spark, profile, input_bytes, settings)
     return spark
 
 
-def process_docking_station_data(spark, input_data, output_data):
+def journey_distance_km(start_lat, start_lon, end_lat, end_lon):
+    """Builds a native Spark column expression of the distance between journey start and end station coordinates
+
+    - Spherical law of cosines, evaluated by Spark as a vectorised column expression, no Python worker round trip.
+    - Cosine term is clamped to [-1, 1] so floating point error on near identical coordinates can't produce NaN.
+    - Identical start and end coordinates return a distance of 0.
+
+    :param start_lat: (Column): Start station latitude
+    :param start_lon: (Column): Start station longitude
+    :param end_lat: (Column): End station latitude
+    :param end_lon: (Column): End station longitude
+    :return: (Column): Kilometre distance between stations, rounded to 2 decimal places
+    """
+
+    slat, slon = radians(start_lat), radians(start_lon)
+    elat, elon = radians(end_lat), radians(end_lon)
+
+    cosine = sin(slat) * sin(elat) + cos(slat) * cos(elat) * cos(slon - elon)
+    cosine = greatest(lit(-1.0), least(lit(1.0), cosine))
+
+    return when((start_lat == end_lat) & (start_lon == end_lon), lit(0.0)) \
+        .otherwise(spark_round(lit(EARTH_RADIUS_KM) * acos(cosine), 2))
+
+
+def unchanged_dimension(spark, input_data, output_data, name, force=False):
+    """Fingerprints a dimension table's source files, and compares them with the fingerprint recorded with its output
+
+    :param spark: (object): Built spark session instance
+    :param input_data: (str): Path to AWS S3 bucket source data
+    :param output_data: (str): Path to AWS S3 bucket of written parquet files
+    :param name: (str): Dimension table name, as per DIMENSION_SOURCES
+    :param force: (bool): Treat the sources as changed
+    :return: (tuple): True when the sources are unchanged and the table's files are present, source fingerprint
+    """
+
+    fingerprint = source_fingerprint(spark, os.path.join(input_data, DIMENSION_SOURCES[name]))
+    if force:
+        return False, fingerprint
+
+    recorded = read_text(spark, f'{output_data}{FINGERPRINT_DIR}/{name}.json')
+    unchanged = recorded is not None and json.loads(recorded)['digest'] == fingerprint['digest'] and \
+        bool(list_files(spark, output_data + TABLES[name].lake_path))
+    if unchanged:
+        print(f'{name} sources unchanged since {json.loads(recorded)["recorded_at"]}, skipped')
+    return unchanged, fingerprint
+
+
+def record_fingerprint(spark, output_data, name, fingerprint):
+    """Records the source fingerprint of a written dimension table with the data lake, read by later runs and dwh_load
+
+    :param spark: (object): Built spark session instance
+    :param output_data: (str): Path to AWS S3 bucket of written parquet files
+    :param name: (str): Dimension table name
+    :param fingerprint: (dict): Source fingerprint, as per lake_fs.source_fingerprint
+    """
+
+    record = {'table': name, **fingerprint, 'recorded_at': datetime.utcnow().isoformat(timespec='seconds') + 'Z'}
+    write_text(spark, f'{output_data}{FINGERPRINT_DIR}/{name}.json', json.dumps(record, indent=2))
+
+
+def partition_counts(df, year_column, month_column, **counts):
+    """Counts the rows of a dataframe in each (year, month) partition, every count in one aggregation
+
+    :param df: (object): Dataframe
+    :param year_column: (str|Column): Year column
+    :param month_column: (str|Column): Month column
+    :param counts: (Column): Count expressions by count name, eg. rows=count(lit(1))
+    :return: (dict): Counts by count name, by partition key as per table_definitions.partition_key
+    """
+
+    year_column, month_column = (col(column) if isinstance(column, str) else column
+                                 for column in (year_column, month_column))
+    rows = df.groupBy(year_column.alias('partition_year'), month_column.alias('partition_month')) \
+        .agg(*[expression.alias(name) for name, expression in counts.items()]) \
+        .collect()
+    return {partition_key(row['partition_year'], row['partition_month']): {name: row[name] for name in counts}
+            for row in rows}
+
+
+def merge_counts(*partition_counts_list):
+    """Merges the partition counts of several dataframes, as per partition_counts"""
+
+    merged = {}
+    for counts in partition_counts_list:
+        for key, partition in counts.items():
+            merged.setdefault(key, {}).update(partition)
+    return merged
+
+
+def record_ingest_counts(spark, output_data, name, counts, partitions=None, append=False):
+    """Records a table's partition row counts at ingest with the data lake, read by reconcile.py
+
+    - A full run replaces the record, a run rewriting only some partitions replaces just their counts.
+    - Rows appended to partitions, eg. by a stream micro-batch, add their counts to those recorded.
+
+    :param spark: (object): Built spark session instance
+    :param output_data: (str): Path to AWS S3 bucket of written parquet files
+    :param name: (str): Table name
+    :param counts: (dict): Counts by count name, by partition key, as per partition_counts
+    :param partitions: (set): (year, month) partitions written, None for all
+    :param append: (bool): Counts are of rows appended to the partitions written
+    """
+
+    path = f'{output_data}{INGEST_COUNT_DIR}/{name}.json'
+    recorded = {}
+    if partitions is not None:
+        written = {partition_key(partition_year, partition_month) for partition_year, partition_month in partitions}
+        counts = {key: partition for key, partition in counts.items() if key in written}
+        text = read_text(spark, path)
+        recorded = json.loads(text)['partitions'] if text else {}
+
+    if append:
+        counts = {key: {count_name: recorded.get(key, {}).get(count_name, 0) + value
+                        for count_name, value in partition.items()}
+                  for key, partition in counts.items()}
+    recorded.update(counts)
+    record = {'table': name, 'partitions': dict(sorted(recorded.items())),
+              'recorded_at': datetime.utcnow().isoformat(timespec='seconds') + 'Z'}
+    write_text(spark, path, json.dumps(record, indent=2))
+
+
+def process_docking_station_data(spark, input_data, output_data, force=False):
     """Processes bike docking station data to AWS S3 hosted parquet file
 
     - Reads in docking station data from a csv file and builds a schema defined docking station dataframe.
     - Writes 'docking stations' dimension table as parquet file to AWS S3 data lake.
+    - Skipped when the docking station file is unchanged since the table was written.
 
     :param spark: (object): Built spark session instance
     :param input_data: (str): Path to AWS S3 bucket source data
     :param output_data: (str): Path to AWS S3 bucket of written parquet file
+    :param force: (bool): Process the docking station file even if unchanged
+    :return: (bool): True when the table was written, False when skipped
     """
 
+    unchanged, fingerprint = unchanged_dimension(spark, input_data, output_data, 'dim_docking_stations', force)
+    if unchanged:
+        return False
+
     # sets filepath to docking station data file
-    station_data = os.path.join(input_data, 'infrastructure/FOI-0689-2122.csv')
+    station_data = os.path.join(input_data, DIMENSION_SOURCES['dim_docking_stations'])
 
-    # set docking station table schema
-    docking_schema = R([
-        Fld('docking_station_live_date', Str()),
-        Fld('docking_station_name', Str()),
-        Fld('docking_station_id', Int()),
-        Fld('docking_points', Int()),
-        Fld('docking_station_latitude', Dbl()),
-        Fld('docking_station_longitude', Dbl()),
-    ])
-    # read docking station data to dataframe
-    dim_docking_stations = spark.read.option("header", True).csv(station_data, docking_schema)
+    # read docking station data to dataframe, with the docking station table schema
+    docking_table = TABLES['dim_docking_stations']
+    dim_docking_stations = spark.read.option("header", True).csv(station_data, spark_schema(docking_table))
 
-    # write docking station table to parquet file
-    dim_docking_stations.write.mode("overwrite").parquet(output_data + 'infrastructure/docking_stations')
+    # write docking station table to parquet file, moved into place once written
+    dim_docking_stations.write.mode("overwrite").options(**layout_options(lake_layout('dim_docking_stations'))) \
+        .parquet(output_data + TABLE_STAGING_DIR + docking_table.lake_path)
+    promote_staged(spark, output_data + TABLE_STAGING_DIR + docking_table.lake_path,
+                   output_data + docking_table.lake_path)
 
+    record_fingerprint(spark, output_data, 'dim_docking_stations', fingerprint)
+    return True
 
-def process_journey_data(spark, input_data, output_data):
-    """Processes bike hire data to partitioned parquet files
 
-    - Reads in bike hire journey data from csv files to schema defined staging dataframe.
-    - Builds a 'Time' dimension table from selected selected staging dataframe columns and writes table to partitioned
-      parquet files.
-    - Builds a 'Distances' dimension table from selected selected staging dataframe columns and imported docking station
-      data, then writes table to a parquet file.
-    - Builds a 'Journeys' fact table from selected selected staging dataframe columns and writes table to partitioned
-      parquet files.
+def rental_buckets(spark, output_data):
+    """Gets the No. of rental_id buckets the journey tables are written with
+
+    - A full run's own count while it runs, otherwise the count recorded by the last full run.
 
     :param spark: (object): Built spark session instance
-    :param input_data: (str): Path to AWS S3 bucket source data
     :param output_data: (str): Path to AWS S3 bucket of written partitioned parquet files
+    :return: (int): No. of buckets, the configured or minimum count before a full run has recorded one
     """
 
-    # sets filepath to bike hire data files - Select 1 of 3 options below
-    # journey_data = os.path.join(input_data, 'journey/2012/11. Journey Data Extract 23Aug-25 Aug12.csv')
-    journey_data = os.path.join(input_data, 'journey/2012/*.csv')
-    # journey_data = os.path.join(input_data, 'journey/*/*.csv')
+    running = spark.conf.get(RENTAL_BUCKETS_SETTING, None)
+    if running:
+        return int(running)
+    recorded = read_text(spark, output_data + RENTAL_BUCKETS_RECORD)
+    if recorded is None:
+        return RENTAL_BUCKETS or MIN_RENTAL_BUCKETS
+    return json.loads(recorded)['rental_buckets']
 
-    journey_schema = R([
-        Fld('Rental Id', Int(), True),
-        Fld('Duration', Int()),
-        Fld('Bike Id', Int()),
-        Fld('End Date', Str()),
-        Fld('EndStation Id', Int()),
-        Fld('EndStation Name', Str()),
-        Fld('Start Date', Str()),
-        Fld('StartStation Id', Int()),
-        Fld('StartStation Name', Str()),
-    ])
 
-    # reads journey data files to spark dataframe
-    raw_df = spark.read.option("header", True).csv(journey_data, journey_schema)
+def plan_rental_buckets(profile, input_bytes):
+    """Plans the No. of rental_id buckets of a full run
+
+    - The [ETL] RENTAL_BUCKETS count when set, otherwise twice the profile's task slots, so each slot fills a bucket
+      of every month at a time with one to spare.
+    - No more buckets than the journey input fills at the target file size, so a large profile over a small input
+      doesn't write a small file for every bucket of every month. The csv input is larger than the parquet written, so
+      files still come out below target.
 
-    # Staging Transforms: Timestamp conversions | Duration filter | Start Date Filter | Drop duplicates
-    df_staging = raw_df.withColumn("Start Date", unix_timestamp("Start Date", 'dd/MM/yyyy HH:mm').cast(TimestampType())) \
+    :param profile: (object): SparkProfile of the run
+    :param input_bytes: (int): Journey input bytes, None when unmeasured
+    :return: (int): No. of buckets
+    """
+
+    if RENTAL_BUCKETS:
+        return RENTAL_BUCKETS
+    buckets = 2 * task_slots(profile)
+    if input_bytes is not None:
+        buckets = min(buckets, math.ceil(input_bytes / WRITE_OPTIONS['target_file_bytes']))
+    return max(1, buckets)
+
+
+def record_rental_buckets(spark, output_data, buckets):
+    """Records the No. of rental_id buckets a full run wrote the journey tables with, for the runs that follow
+
+    - Only recorded once the journeys and journey distances are both in place, so a failed full run leaves the
+      record matching the tables. Incremental, backfill and streamed runs keep the recorded count.
+
+    :param spark: (object): Built spark session instance
+    :param output_data: (str): Path to AWS S3 bucket of written partitioned parquet files
+    :param buckets: (int): No. of buckets
+    """
+
+    recorded = read_text(spark, output_data + RENTAL_BUCKETS_RECORD)
+    previous = json.loads(recorded)['rental_buckets'] if recorded else None
+    if previous is not None and buckets != previous:
+        print(f'Journey tables rebucketed from {previous} to {buckets} rental_id buckets')
+    write_text(spark, output_data + RENTAL_BUCKETS_RECORD, json.dumps({'rental_buckets': buckets}))
+
+
+def lake_layout(name):
+    """Gets a table's parquet file layout, with any settings overridden in a [layout:<table>] section of dl.cfg"""
+
+    section = f'layout:{name}'
+    return table_layout(TABLES[name], config[section] if config.has_section(section) else None)
+
+
+def register_lake_table(spark, output_data, name):
+    """Registers a bucketed data lake table with the Spark catalog, so Spark jobs can read it bucket by bucket
+
+    eg. spark.table('fact_journeys').join(spark.table('dim_journey_distances'), 'rental_id') has no shuffle, nor a
+    sort unless the table's layout sorts its files by other columns
+
+    :param spark: (object): Built spark session instance
+    :param output_data: (str): Path to AWS S3 bucket of written partitioned parquet files
+    :param name: (str): Table name
+    :return: (bool): True when the table is registered, False when it hasn't been written yet
+    """
+
+    table = TABLES[name]
+    layout = lake_layout(name)
+    return register_bucketed_table(spark, name, output_data + table.lake_path, lake_schema(table),
+                                   list(table.lake_partitions), table.bucket_column, rental_buckets(spark, output_data),
+                                   list(layout.sort_columns), layout_options(layout))
+
+
+def write_table(spark, df, output_data, name, overwrite_mode='static', bucket_partitioned=False):
+    """Writes a data warehouse table to partitioned parquet files, as per its table definition
+
+    - Selects the table's columns in table order, cast to their defined types, so COPY maps them to the right columns.
+    - Adds the partition directory columns and writes to the table's data lake directory.
+    - Files are sorted and encoded as per the table's parquet layout.
+    - Tables with a bucket column are written as Spark tables of that name, bucketed by the column.
+    - Overwrites are written to a staging directory, then moved into place once complete, replacing the whole table
+      or only the partitions written. A failed write leaves the table as it was. On S3 the move copies each file, so
+      readers can see a replaced directory missing or part copied while it moves, as per lake_fs.promote_staged.
+      Appends are written in place.
+
+    :param spark: (object): Built spark session instance
+    :param df: (object): Dataframe holding the table's columns
+    :param output_data: (str): Path to AWS S3 bucket of written partitioned parquet files
+    :param name: (str): Table name
+    :param overwrite_mode: (str): 'static' to replace the whole table, 'dynamic' to replace only partitions written,
+        'append' to add to the partitions written
+    :param bucket_partitioned: (bool): Dataframe is already hash partitioned into the table's buckets
+    :return: (dict): Output file report
+    """
+
+    table = TABLES[name]
+    staged = overwrite_mode != 'append'
+    path = output_data + (TABLE_STAGING_DIR if staged else '') + table.lake_path
+    write_mode = 'static' if staged else overwrite_mode
+
+    if table.bucket_column:
+        # staged files are written as a table of their own, dropping it keeps its files
+        table_name = f'{name}_staging' if staged else name
+        if staged:
+            delete_path(spark, path)
+        report = write_bucketed_parquet(spark, df.select(*spark_columns(table)), path, table_name,
+                                        list(table.lake_partitions), table.bucket_column,
+                                        rental_buckets(spark, output_data), write_mode,
+                                        bucket_partitioned, WRITE_OPTIONS['target_file_bytes'], lake_layout(name))
+        if staged:
+            spark.sql(f'DROP TABLE IF EXISTS {table_name}')
+    else:
+        report = write_partitioned_parquet(spark, df.select(*spark_columns(table)), path,
+                                           list(table.lake_partitions), write_mode, **WRITE_OPTIONS,
+                                           layout=lake_layout(name))
+
+    if staged:
+        promote_staged(spark, path, output_data + table.lake_path, partitions_only=overwrite_mode == 'dynamic')
+        if table.bucket_column:
+            # registered afresh over the promoted files, so the catalog holds the table's current partitions
+            spark.sql(f'DROP TABLE IF EXISTS {name}')
+            register_lake_table(spark, output_data, name)
+    return report
+
+
+def process_station_pair_distances(spark, output_data):
+    """Processes docking station data to a lookup table of distances between every pair of docking stations
+
+    - Reads docking station id and location coordinates data from processed parquet file, Creates dataframe.
+    - Cross joins start and end station dataframes, roughly 800 x 800 station pairs.
+    - Calculates the distance of each station pair once, so journeys get their distance from an equi-join.
+
+    :param spark: (object): Built spark session instance
+    :param output_data: (str): Path to processed docking station data and written parquet file
+    """
+
+    # Read in processed docking station data from parquet file, one row per station with known coordinates
+    stations_df = spark.read.parquet(output_data + 'infrastructure/docking_stations') \
+        .select('docking_station_id', 'docking_station_latitude', 'docking_station_longitude') \
+        .dropna() \
+        .dropDuplicates(['docking_station_id'])
+
+    start_station_df = stations_df.select(col("docking_station_id").alias("start_station_id"),
+                                          col("docking_station_latitude").alias("start_lat"),
+                                          col("docking_station_longitude").alias("start_lon"))
+
+    end_station_df = stations_df.select(col("docking_station_id").alias("end_station_id"),
+                                        col("docking_station_latitude").alias("end_lat"),
+                                        col("docking_station_longitude").alias("end_lon"))
+
+    # Create station pair dataframe with calculated distance between each pair
+    station_pair_distances = start_station_df.crossJoin(broadcast(end_station_df)) \
+        .withColumn("journey_distance_km", journey_distance_km(col("start_lat"), col("start_lon"),
+                                                                col("end_lat"), col("end_lon")))
+
+    # write station pair distances table to a single parquet file, moved into place once written
+    station_pair_distances.coalesce(1) \
+        .write.mode("overwrite") \
+        .parquet(output_data + TABLE_STAGING_DIR + 'infrastructure/station_pair_distances')
+    promote_staged(spark, output_data + TABLE_STAGING_DIR + 'infrastructure/station_pair_distances',
+                   output_data + 'infrastructure/station_pair_distances')
+
+
+def stage_journey_data(raw_df):
+    """Applies staging transforms to raw bike hire journey data
+
+    - Timestamp conversions | Start Date Filter | Column renames | Rental start year, month and day columns.
+    - Duplicate rentals are left to the caller, so the filter on rental start partitions can be applied first.
+
+    :param raw_df: (object): Journey dataframe read with the journey schema
+    :return: (object): Staged journey dataframe
+    """
+
+    return raw_df.withColumn("Start Date", unix_timestamp("Start Date", 'dd/MM/yyyy HH:mm').cast(TimestampType())) \
         .withColumn("End Date", unix_timestamp("End Date", 'dd/MM/yyyy HH:mm').cast(TimestampType())) \
         .filter(col("Start Date") > "2012-01-01 00:00:00") \
-        .dropDuplicates(["Rental Id"]) \
         .withColumnRenamed("StartStation Id", "start_station_id") \
         .withColumnRenamed("EndStation Id", "end_station_id") \
         .withColumn("rental_start_year", year("Start Date")) \
@@ -107,8 +506,238 @@ def process_journey_data(spark, input_data, output_data):
         .withColumnRenamed("Start Date", "rental_start_date") \
         .withColumnRenamed("End Date", "rental_end_date")
 
-    # extract columns to create a time dimension table
-    dim_time_table = df_staging.select('rental_start_date') \
+
+def drop_duplicate_rentals(df_staging):
+    """Drops duplicate rentals, keeping one row of each rental with the No. of source rows it had
+
+    Spark runs a duplicate drop as this same aggregation of each column's first value, so the count adds no pass.
+
+    :param df_staging: (object): Staged journey dataframe, hash partitioned by rental id
+    :return: (object): Deduplicated journey dataframe with a 'source_rows' column
+    """
+
+    return df_staging.groupBy("Rental Id") \
+        .agg(*[first(column).alias(column) for column in df_staging.columns if column != "Rental Id"],
+             count(lit(1)).alias("source_rows"))
+
+
+def journey_fact(df_staging, time_granularity_seconds, extra_columns=()):
+    """Projects staged journeys to the journeys fact table columns, keeping their source file
+
+    :param df_staging: (object): Staged journey dataframe with a 'source_file' column
+    :param time_granularity_seconds: (int): Time dimension slot length in seconds
+    :param extra_columns: (tuple): Further staged columns kept, eg. 'source_rows' for the ingest counts
+    :return: (object): Journeys fact dataframe
+    """
+
+    return df_staging.select([col("Rental Id").alias("rental_id"),
+                              col("Bike Id").alias("bike_id"),
+                              col("Duration").alias("rental_duration_seconds"),
+                              col("start_station_id"),
+                              col("rental_start_date"),
+                              col("end_station_id"),
+                              col("rental_end_date"),
+                              col("source_file"),
+                              *[col(column) for column in extra_columns]]) \
+        .withColumn("rental_start_year", year("rental_start_date")) \
+        .withColumn("rental_start_month", month("rental_start_date")) \
+        .withColumn("rental_start_day", dayofmonth("rental_start_date")) \
+        .withColumn("time_id", time_key("rental_start_date", time_granularity_seconds))
+
+
+def month_range(start, end):
+    """Lists the (year, month) partitions between two months, inclusive
+
+    :param start: (str): First month as 'YYYY-MM'
+    :param end: (str): Last month as 'YYYY-MM'
+    :return: (set): Set of (year, month) tuples
+    """
+
+    start_year, start_month = (int(part) for part in start.split('-'))
+    end_year, end_month = (int(part) for part in end.split('-'))
+
+    months = set()
+    for index in range(start_year * 12 + start_month - 1, end_year * 12 + end_month):
+        months.add((index // 12, index % 12 + 1))
+    return months
+
+
+def partition_filter(partitions, year_column, month_column):
+    """Builds a filter condition matching rows in a set of (year, month) partitions
+
+    :param partitions: (set): Set of (year, month) tuples
+    :param year_column: (str): Name of year column
+    :param month_column: (str): Name of month column
+    :return: (Column): Filter condition
+    """
+
+    condition = lit(False)
+    for partition_year, partition_month in sorted(partitions):
+        condition = condition | ((col(year_column) == partition_year) & (col(month_column) == partition_month))
+    return condition
+
+
+def read_journey_manifest(spark, output_data):
+    """Reads the manifest of ingested journey source files, an empty list before the first run
+
+    :param spark: (object): Built spark session instance
+    :param output_data: (str): Path to AWS S3 bucket of written partitioned parquet files
+    :return: (list): Manifest rows, one per source file and rental start partition
+    """
+
+    try:
+        return spark.read.schema(JOURNEY_MANIFEST_SCHEMA).json(output_data + 'manifests/journeys').collect()
+    except AnalysisException:
+        return []
+
+
+def write_journey_manifest(spark, output_data, manifest_rows, mode):
+    """Records ingested journey source files and the rental start partitions they contain
+
+    :param spark: (object): Built spark session instance
+    :param output_data: (str): Path to AWS S3 bucket of written partitioned parquet files
+    :param manifest_rows: (list): (source_file, rental_start_year, rental_start_month, row_count) tuples
+    :param mode: (str): 'overwrite' to replace the manifest after a full run, 'append' after an incremental run
+    """
+
+    if not manifest_rows and mode == 'append':
+        return
+
+    ingested_at = datetime.utcnow()
+    rows = [(source_file, partition_year, partition_month, row_count, ingested_at)
+            for source_file, partition_year, partition_month, row_count in manifest_rows]
+
+    spark.createDataFrame(rows, JOURNEY_MANIFEST_SCHEMA) \
+        .coalesce(1) \
+        .write.mode(mode) \
+        .json(output_data + 'manifests/journeys')
+
+
+def source_file_partitions(df_staging, source_files=()):
+    """Groups staged journeys by source file and rental start partition
+
+    - Source files read without a row surviving staging, eg. every rental before the start date filter, get a row
+      with no partition, so they are recorded as ingested rather than scanned again by each incremental run.
+
+    :param df_staging: (object): Staged journey dataframe with a 'source_file' column
+    :param source_files: (list): Source file paths read into the dataframe
+    :return: (list): (source_file, rental_start_year, rental_start_month, row_count) tuples
+    """
+
+    rows = df_staging.groupBy('source_file', 'rental_start_year', 'rental_start_month').count().collect()
+    manifest_rows = [(unquote(row['source_file']), row['rental_start_year'], row['rental_start_month'], row['count'])
+                     for row in rows]
+    staged_files = {source_file for source_file, _, _, _ in manifest_rows}
+    return manifest_rows + [(unquote(path), None, None, 0) for path in source_files
+                            if unquote(path) not in staged_files]
+
+
+def plan_journey_sources(spark, input_data, output_data, mode='full', backfill=None):
+    """Works out which journey source files to read and which rental start partitions to rewrite
+
+    - full: every source file, every partition.
+    - incremental: partitions touched by source files missing from the manifest, plus the previously ingested files
+      holding rows for those partitions, so each rewritten partition is complete. New files without a staged row have
+      nothing to read, only their manifest rows are returned.
+    - backfill: partitions in an explicit month range, from the previously ingested files holding rows for them.
+
+    :param spark: (object): Built spark session instance
+    :param input_data: (str): Path to AWS S3 bucket source data
+    :param output_data: (str): Path to AWS S3 bucket of written partitioned parquet files
+    :param mode: (str): 'full', 'incremental' or 'backfill'
+    :param backfill: (tuple): ('YYYY-MM', 'YYYY-MM') month range, backfill mode only
+    :return: (tuple): Source file paths, set of (year, month) partitions or None for all, new manifest rows
+    """
+
+    journey_data = os.path.join(input_data, JOURNEY_DATA)
+    source_files = spark.read.option("header", True).csv(journey_data, JOURNEY_SCHEMA).inputFiles()
+
+    if mode == 'full':
+        return source_files, None, None
+
+    manifest = read_journey_manifest(spark, output_data)
+    ingested_files = {row['source_file'] for row in manifest}
+
+    if mode == 'backfill':
+        partitions = month_range(*backfill)
+        new_manifest_rows = []
+        if manifest:
+            wanted = {row['source_file'] for row in manifest
+                      if (row['rental_start_year'], row['rental_start_month']) in partitions}
+            source_files = [path for path in source_files if unquote(path) in wanted]
+    else:
+        new_files = [path for path in source_files if unquote(path) not in ingested_files]
+        if not new_files:
+            return [], set(), []
+
+        # scan only the new files to find the partitions they touch
+        new_raw_df = spark.read.option("header", True).csv(new_files, JOURNEY_SCHEMA) \
+            .withColumn('source_file', input_file_name())
+        new_manifest_rows = source_file_partitions(stage_journey_data(new_raw_df), new_files)
+        partitions = {(partition_year, partition_month) for _, partition_year, partition_month, row_count
+                      in new_manifest_rows if row_count}
+        if not partitions:
+            return [], set(), new_manifest_rows
+
+        wanted = {row['source_file'] for row in manifest
+                  if (row['rental_start_year'], row['rental_start_month']) in partitions}
+        source_files = new_files + [path for path in source_files if unquote(path) in wanted]
+
+    return source_files, partitions, new_manifest_rows
+
+
+def staging_storage_level(spark, source_files, memory_budget_mb):
+    """Picks the storage level for persisted staged journeys from an estimate of their size
+
+    - Staged journeys are estimated from the size of the source csv files, station name text is not kept.
+    - Within the memory budget, staged journeys are kept in memory, spilling any blocks that don't fit to disk.
+    - Over the memory budget, staged journeys go straight to local disk, leaving executor memory to the writers.
+
+    :param spark: (object): Built spark session instance
+    :param source_files: (list): Journey source file paths
+    :param memory_budget_mb: (int): Memory available to staged journeys, MB
+    :return: (object): Spark StorageLevel
+    """
+
+    estimated_mb = total_size(spark, source_files) * STAGED_BYTES_PER_SOURCE_BYTE / (1024 * 1024)
+    storage_level = StorageLevel.MEMORY_AND_DISK if estimated_mb <= memory_budget_mb else StorageLevel.DISK_ONLY
+
+    print(f'Persisting staged journeys as {storage_level}, estimated {estimated_mb:.0f}MB of {memory_budget_mb}MB')
+    return storage_level
+
+
+def time_key(timestamp_column, granularity_seconds):
+    """Builds the time dimension surrogate key of a timestamp, the No. of whole time slots since the unix epoch
+
+    :param timestamp_column: (str): Name of timestamp column
+    :param granularity_seconds: (int): Time slot length in seconds, eg. 60 for a minute calendar
+    :return: (Column): Surrogate key column
+    """
+
+    return floor(unix_timestamp(timestamp_column) / granularity_seconds).cast(Long())
+
+
+def build_time_dimension(spark, journeys_df, granularity_seconds):
+    """Builds a distinct time dimension calendar covering the months of the observed rental start dates
+
+    - One row per time slot rather than one row per journey, from the first to the last observed month.
+    - Calendar covers whole months, so an incremental rebuild of a month partition rewrites the same rows.
+    - Surrogate key 'time_id' is derived from the timestamp, journeys reference it without a join.
+
+    :param spark: (object): Built spark session instance
+    :param journeys_df: (object): Journey dataframe with a 'rental_start_date' column
+    :param granularity_seconds: (int): Time slot length in seconds, eg. 60 for a minute calendar
+    :return: (object): Time dimension dataframe
+    """
+
+    month_start = trunc('rental_start_date', 'month')
+    bounds = journeys_df.agg(spark_min(unix_timestamp(month_start)).alias('first_slot'),
+                             spark_max(unix_timestamp(add_months(month_start, 1))).alias('end_slot')).first()
+    first_slot, end_slot = bounds['first_slot'] or 0, bounds['end_slot'] or 0
+
+    return spark.range(first_slot // granularity_seconds, end_slot // granularity_seconds) \
+        .select(col('id').alias('time_id')) \
+        .withColumn('rental_start_date', (col('time_id') * granularity_seconds).cast(TimestampType())) \
         .withColumn('hour', hour('rental_start_date')) \
         .withColumn('day', dayofmonth('rental_start_date')) \
         .withColumn('weekday', dayofweek('rental_start_date')) \
@@ -116,190 +745,587 @@ def process_journey_data(spark, input_data, output_data):
         .withColumn('month', month('rental_start_date')) \
         .withColumn('year', year('rental_start_date'))
 
+
+def process_journey_data(spark, input_data, output_data, mode='full', backfill=None, memory_budget_mb=2048,
+                         time_granularity_seconds=60):
+    """Processes bike hire data to partitioned parquet files
+
+    - Reads in bike hire journey data from csv files to schema defined staging dataframe.
+    - Builds a 'Time' dimension calendar at the configured granularity over the observed months and writes table to
+      partitioned parquet files.
+    - Builds a 'Journeys' fact table from selected selected staging dataframe columns and writes table to partitioned
+      parquet files.
+    - Incremental and backfill modes read only the source files behind the affected rental start partitions, and
+      rewrite just those partitions with dynamic partition overwrite.
+    - Staged journeys are persisted once and returned for the journey distance table, the caller releases them.
+    - Duplicate rentals are dropped after hash partitioning on rental id into the table's buckets, so the one shuffle
+      serves the duplicate drop and the bucketed journeys and journey distances writes.
+    - Records each partition's start date filtered and deduplicated rows, and rows without an end station, counted
+      from the persisted journeys. Raw rows before the start date filter cost a second read of the csv files, and
+      are only recorded when configured.
+
+    :param spark: (object): Built spark session instance
+    :param input_data: (str): Path to AWS S3 bucket source data
+    :param output_data: (str): Path to AWS S3 bucket of written partitioned parquet files
+    :param mode: (str): 'full', 'incremental' or 'backfill'
+    :param backfill: (tuple): ('YYYY-MM', 'YYYY-MM') month range, backfill mode only
+    :param memory_budget_mb: (int): Memory available to persisted staged journeys, MB
+    :param time_granularity_seconds: (int): Time dimension slot length in seconds
+    :return: (tuple): Set of rewritten (year, month) partitions or None for all, manifest rows to record once the
+        partitions' downstream tables are written, persisted journeys dataframe or None when there was nothing to do
+    """
+
+    source_files, partitions, manifest_rows = plan_journey_sources(spark, input_data, output_data, mode, backfill)
+    if not source_files:
+        print('No journey data files to process')
+        return set(), manifest_rows or [], None
+
+    # reads journey data files to spark dataframe
+    raw_df = spark.read.option("header", True).csv(source_files, JOURNEY_SCHEMA) \
+        .withColumn('source_file', input_file_name())
+
+    # Staging Transforms: Timestamp conversions | Start Date Filter | Partition Filter | Drop duplicates
+    df_staging = stage_journey_data(raw_df)
+    if partitions is not None:
+        df_staging = df_staging.filter(partition_filter(partitions, 'rental_start_year', 'rental_start_month'))
+    df_staging = drop_duplicate_rentals(df_staging.repartition(rental_buckets(spark, output_data), "Rental Id"))
+
+    # static overwrite replaces the whole table, dynamic overwrite replaces only the partitions written
+    overwrite_mode = 'static' if partitions is None else 'dynamic'
+
+    # project fact table columns and persist them, so the csv parse and duplicate drop run once for every table
+    fact_journeys_table = journey_fact(df_staging, time_granularity_seconds, ('source_rows',)) \
+        .persist(staging_storage_level(spark, source_files, memory_budget_mb))
+
+    # generate a time dimension calendar over the months of the persisted journeys
+    dim_time_table = build_time_dimension(spark, fact_journeys_table, time_granularity_seconds)
+
     # write time table to parquet files partitioned by year and month
-    dim_time_table.withColumn('month_', month('rental_start_date')) \
-        .withColumn('year_', year('rental_start_date')) \
-        .repartition(10) \
-        .write.partitionBy('year_', 'month_') \
-        .mode("overwrite") \
-        .parquet(output_data + 'time')
-
-    fact_journeys_table = df_staging.select([col("Rental Id").alias("rental_id"),
-                                             col("Bike Id").alias("bike_id"),
-                                             col("Duration").alias("rental_duration_seconds"),
-                                             col("start_station_id"),
-                                             col("rental_start_date"),
-                                             col("end_station_id"),
-                                             col("rental_end_date")]) \
-        .withColumn("rental_start_year", year("rental_start_date")) \
-        .withColumn("rental_start_month", month("rental_start_date")) \
-        .withColumn("rental_start_day", dayofmonth("rental_start_date"))
+    write_table(spark, dim_time_table, output_data, 'dim_time', overwrite_mode)
 
     # write journeys fact table to parquet files partitioned by year and month
-    fact_journeys_table.withColumn("rental_start_year_", col("rental_start_year")) \
-        .withColumn("rental_start_month_", col("rental_start_month")) \
-        .repartition(10) \
-        .write.partitionBy('rental_start_year_', 'rental_start_month_') \
-        .mode("overwrite") \
-        .parquet(output_data + 'journeys')
+    write_table(spark, fact_journeys_table, output_data, 'fact_journeys', overwrite_mode, bucket_partitioned=True)
 
+    # counted from the persisted journeys, each holds the No. of source rows of its rental before the duplicate drop
+    if RECORD_INGEST_COUNTS:
+        no_end_station = when(col('end_station_id') > 0, 0).otherwise(1)
+        journey_counts = partition_counts(fact_journeys_table, 'rental_start_year', 'rental_start_month',
+                                          date_filtered_rows=spark_sum('source_rows'),
+                                          deduplicated_rows=count(lit(1)),
+                                          end_station_dropped=spark_sum(no_end_station))
+        # rows dropped by the start date filter were never persisted, so the start dates are read again
+        if RECORD_RAW_COUNTS:
+            raw_dates = raw_df.select(unix_timestamp("Start Date", 'dd/MM/yyyy HH:mm').cast(TimestampType())
+                                      .alias('rental_start_date'))
+            journey_counts = merge_counts(partition_counts(raw_dates, year('rental_start_date'),
+                                                           month('rental_start_date'), raw_rows=count(lit(1))),
+                                          journey_counts)
+        record_ingest_counts(spark, output_data, 'fact_journeys', journey_counts, partitions)
+        record_ingest_counts(spark, output_data, 'dim_time',
+                             partition_counts(dim_time_table, 'year', 'month', rows=count(lit(1))), partitions)
 
-def journey_distance(spark, output_infrastructure_data, output_data):
-    """Processes journey and docking station data to create a dimension table of calculated journey distances
+    # a full run records every source file and the partitions it holds
+    if mode == 'full':
+        manifest_rows = source_file_partitions(fact_journeys_table, source_files)
+        partitions = None
 
-    - Reads docking station id and location coordinates data from processed parquet file, Creates dataframe.
-    - Reads journey rental id and start/end station id from processed parquet files, Creates dataframe.
-    - Creates start and end station dataframes, each combining station ids and coordinates
-    - Creates merged dataframe of start and end station ids, coordinates and calculated journey distance.
-
-    :param spark: (object): Built spark session instance
-    :param output_infrastructure_data: (str): Path to processed docking station data
-    :param output_data: (str): Path to processed journey data
-    """
+    return partitions, manifest_rows, fact_journeys_table
 
-    def journey_distance_calc(start_lat, start_lon, end_lat, end_lon):
-        """Inner function - Calculates distance between journey start and end station coordinates
 
-        Parameters:
-        start_lat (float): Start station latitude
-        start_lon (float): Start station longitude
-        end_lat (float): End station latitude
-        end_lon (float): End station longitude
-        returns:
-        distance (float): Kilometer distance between stations
-        """
+def journey_distance(spark, output_infrastructure_data, output_data, partitions=None, journeys_df=None,
+                     overwrite_mode=None, bucket_partitioned=False):
+    """Processes journey and station pair distance data to create a dimension table of journey distances
 
-        slat = radians(float(start_lat))
-        slon = radians(float(start_lon))
-        elat = radians(float(end_lat))
-        elon = radians(float(end_lon))
+    - Reads station pair coordinates and calculated distances from processed parquet file, Creates dataframe.
+    - Reads journey rental id and start/end station id from processed parquet files, Creates dataframe. Unless the
+      persisted journeys from process_journey_data are passed in, saving a re-read of the freshly written files.
+    - Joins journeys to their station pair on start and end station id, attaching coordinates and distance.
+    - Station pair table is broadcast, its size is set by the No. of stations not journeys, so the join is map-only
+      with no shuffle of the journey data, and busy stations can't skew a shuffle partition. Persisted journeys are
+      already in rental id buckets, so their journey distances are written bucketed with no shuffle at all.
 
-        if slat == elat and slon == elon:
-            dist = 0
-        else:
-            distance = 6371.01 * acos(sin(slat) * sin(elat) + cos(slat) * cos(elat) * cos(slon - elon))
-            return round(distance, 2)
+    :param spark: (object): Built spark session instance
+    :param output_infrastructure_data: (str): Path to processed station pair distance data
+    :param output_data: (str): Path to processed journey data
+    :param partitions: (set): (year, month) partitions to recompute, None for all
+    :param journeys_df: (object): Persisted journeys dataframe, already limited to the partitions being recomputed
+    :param overwrite_mode: (str): Write mode of the journey distances, defaults to 'static' for all partitions and
+        'dynamic' for the partitions being recomputed
+    :param bucket_partitioned: (bool): Passed journeys are hash partitioned into the rental id buckets
+    """
 
-    # Read in processed docking station data from parquet file
-    stations_df = spark.read.parquet(output_data + 'infrastructure/docking_stations') \
-        .select('docking_station_id', 'docking_station_latitude', 'docking_station_longitude')
+    # Read in processed station pair distances from parquet file
+    station_pairs_df = spark.read.parquet(output_infrastructure_data + 'infrastructure/station_pair_distances')
 
-    # Read in processed journey data from parquet files
-    journeys_df = spark.read.parquet(output_data + 'journeys') \
-        .select('rental_id', 'start_station_id', 'end_station_id',
-                'rental_start_day', 'rental_start_month', 'rental_start_year') \
+    # Read in processed journey data from parquet files, pruned to the partitions being recomputed
+    if journeys_df is None:
+        journeys_df = spark.read.parquet(output_data + 'journeys')
+        if partitions is not None:
+            journeys_df = journeys_df.filter(partition_filter(partitions, 'rental_start_year_', 'rental_start_month_'))
+    journeys_df = journeys_df.select('rental_id', 'start_station_id', 'end_station_id',
+                                     'rental_start_day', 'rental_start_month', 'rental_start_year') \
         .filter('end_station_id > 0')
 
-    # Create starting station dataframe for journey distance calculation
-    start_station_df = journeys_df.join(stations_df, (journeys_df.start_station_id == stations_df.docking_station_id),
-                                        'left') \
-        .select(col("rental_id"),
-                col("start_station_id"),
-                col("docking_station_latitude").alias("start_lat"),
-                col("docking_station_longitude").alias("start_lon"),
-                col("rental_start_year"),
-                col("rental_start_month"),
-                col("rental_start_day")) \
-        .dropDuplicates(["rental_id"])
-
-    # Create ending station dataframe for journey distance calculation
-    end_station_df = journeys_df.join(stations_df, (journeys_df.end_station_id == stations_df.docking_station_id),
-                                      'left') \
-        .select(col("rental_id"),
-                col("end_station_id"),
-                col("docking_station_latitude").alias("end_lat"),
-                col("docking_station_longitude").alias("end_lon")) \
-        .dropDuplicates(["rental_id"])
-
-    # Create journey distances dataframe from joined starting/ending dataframes
-    distances_df = start_station_df.join(end_station_df, ["rental_id"]).dropna()
-
-    # TEST WRITE -- DELETE--
-    # distances_df.withColumn("rental_start_year_", col("rental_start_year")) \
-    # .repartition(10) \
-    # .write.partitionBy('rental_start_year_') \
-    # .mode('overwrite') \
-    # .parquet(output_data + 'test')
-
-    # Add column to dataframe of calculated distances
-    distances_udf = udf(journey_distance_calc, Dbl())
-    dim_journey_distances = distances_df.withColumn("journey_distance_km",
-                                                    distances_udf(distances_df['start_lat'], distances_df['start_lon'],
-                                                                  distances_df['end_lat'], distances_df['end_lon']))
+    # Create journey distances dataframe from broadcast station pair lookup
+    dim_journey_distances = journeys_df.join(broadcast(station_pairs_df), ['start_station_id', 'end_station_id']) \
+        .dropna()
 
     # Write journey distances table to parquet files partitioned by year and month
-    dim_journey_distances.withColumn("rental_start_year_", col("rental_start_year")) \
-        .withColumn("rental_start_month_", col("rental_start_month")) \
-        .repartition(10) \
-        .write.partitionBy('rental_start_year_', 'rental_start_month_') \
-        .mode('overwrite') \
-        .parquet(output_data + 'journey_distances')
+    write_table(spark, dim_journey_distances, output_data, 'dim_journey_distances',
+                overwrite_mode or ('static' if partitions is None else 'dynamic'), bucket_partitioned)
+
+    # journeys with an end station, and those of them dropped for a missing station pair or null column
+    if RECORD_INGEST_COUNTS:
+        counts = merge_counts(
+            partition_counts(journeys_df, 'rental_start_year', 'rental_start_month', station_rows=count(lit(1))),
+            partition_counts(dim_journey_distances, 'rental_start_year', 'rental_start_month', rows=count(lit(1))))
+        for partition in counts.values():
+            partition['rows'] = partition.get('rows', 0)
+            partition['dropna_dropped'] = partition['station_rows'] - partition['rows']
+        record_ingest_counts(spark, output_data, 'dim_journey_distances', counts, partitions,
+                             overwrite_mode == 'append')
 
 
-def process_weather_data(spark, input_data, output_data):
+def process_weather_data(spark, input_data, output_data, json_lines=False, force=False):
     """Processes weather data from json files to partitioned parquet files
 
+    - Reads only the kept day fields, with a declared schema, so there is no schema inference pass over the files.
+    - Nested files are single documents, each read whole by one task. Optionally they are first converted to
+      line-delimited day records, streamed a day at a time, which Spark splits across tasks like any text file.
+    - Skipped when the weather files are unchanged since the table was written.
+
     :param spark:(object): Built spark session instance
     :param input_data: (str): Path to AWS S3 bucket source data
     :param output_data: (str): Path to AWS S3 bucket of written partitioned parquet files
+    :param json_lines: (bool): Convert the nested files to line-delimited day records, requires the pyarrow package
+    :param force: (bool): Process the weather files even if unchanged
+    :return: (bool): True when the table was written, False when skipped
     """
 
+    unchanged, fingerprint = unchanged_dimension(spark, input_data, output_data, 'dim_daily_weather', force)
+    if unchanged:
+        return False
+
     # sets filepath to bike hire data files
-    weather_data_path = os.path.join(input_data, 'weather/*.json')
-
-    # reads weather data files to dataframe
-    raw_weather_df = spark.read.option("multiLine", "true").format("json").load(weather_data_path)
-
-    # create daily weather dataframe from nested json
-    days_weather_df = raw_weather_df.select(explode('days').alias('day'))
-
-    # split daily weather array to individual columns
-    dim_daily_weather_table = days_weather_df.withColumn('date', days_weather_df.day.getItem('datetime').cast('date')) \
-        .withColumn("year", year('date')) \
-        .withColumn('month', month('date')) \
-        .withColumn('day_of_month', dayofmonth('date')) \
-        .withColumn('conditions', days_weather_df.day.getItem('conditions')) \
-        .withColumn('description', days_weather_df.day.getItem('description')) \
-        .withColumn('avg_temp', days_weather_df.day.getItem('temp')) \
-        .withColumn('min_temp', days_weather_df.day.getItem('tempmin')) \
-        .withColumn('max_temp', days_weather_df.day.getItem('tempmax')) \
-        .withColumn('precipitation', days_weather_df.day.getItem('precip')) \
-        .withColumn('windspeed', days_weather_df.day.getItem('windspeed')) \
-        .withColumn('sunrise', days_weather_df.day.getItem('sunrise')) \
-        .withColumn('sunset', days_weather_df.day.getItem('sunset')) \
-        .drop('day')
+    weather_data_path = os.path.join(input_data, DIMENSION_SOURCES['dim_daily_weather'])
+
+    # reads daily weather records to dataframe
+    if json_lines:
+        from weather_lines import convert_weather_files
+
+        weather_days_path = output_data + 'staging/weather_days/'
+        convert_weather_files(weather_data_path, weather_days_path, WEATHER_DAY_SCHEMA.fieldNames())
+        days_weather_df = spark.read.schema(WEATHER_DAY_SCHEMA).json(weather_days_path + '*.jsonl')
+    else:
+        days_weather_df = spark.read.schema(WEATHER_SCHEMA).option("multiLine", "true").json(weather_data_path) \
+            .select(explode('days').alias('day')) \
+            .select('day.*')
+
+    # daily weather columns
+    dim_daily_weather_table = days_weather_df.withColumn('date', col('datetime').cast('date')) \
+        .select('date',
+                year('date').alias('year'),
+                month('date').alias('month'),
+                dayofmonth('date').alias('day_of_month'),
+                'conditions',
+                'description',
+                col('temp').alias('avg_temp'),
+                col('tempmin').alias('min_temp'),
+                col('tempmax').alias('max_temp'),
+                col('precip').alias('precipitation'),
+                'windspeed',
+                'sunrise',
+                'sunset')
 
     # write daily weather table to parquet files  partitioned by year and month
-    dim_daily_weather_table.withColumn("year_", col('year')) \
-        .withColumn('month_', col('month')) \
-        .repartition(10) \
-        .write.partitionBy('year_', 'month_') \
-        .mode("overwrite") \
-        .parquet(output_data + 'weather')
+    write_table(spark, dim_daily_weather_table, output_data, 'dim_daily_weather')
+    if RECORD_INGEST_COUNTS:
+        record_ingest_counts(spark, output_data, 'dim_daily_weather',
+                             partition_counts(dim_daily_weather_table, 'year', 'month', rows=count(lit(1))))
+
+    record_fingerprint(spark, output_data, 'dim_daily_weather', fingerprint)
+    return True
+
+
+def process_rollups(spark, output_data, partitions=None, journeys_df=None):
+    """Aggregates journeys to compact rollup tables for dashboards, a month partition at a time
+
+    - Station daily: journeys and duration per start station and day.
+    - Hour of week: journeys and duration per weekday and hour, for each month.
+    - Daily weather demand: journeys, duration and distance per day, with the day's weather conditions, temperature and
+      precipitation.
+    - Totals are kept beside averages, so dashboards can combine rows into weekly or monthly averages exactly.
+    - Only the (year, month) partitions being recomputed are rewritten, so an incremental run aggregates new months
+      rather than the whole fact table.
+
+    :param spark: (object): Built spark session instance
+    :param output_data: (str): Path to AWS S3 bucket of processed journey, journey distance and weather data
+    :param partitions: (set): (year, month) partitions to recompute, None for all
+    :param journeys_df: (object): Persisted journeys dataframe, already limited to the partitions being recomputed
+    """
+
+    overwrite_mode = 'static' if partitions is None else 'dynamic'
+
+    # Read in processed journey data from parquet files, pruned to the partitions being recomputed
+    if journeys_df is None:
+        journeys_df = spark.read.parquet(output_data + 'journeys')
+        if partitions is not None:
+            journeys_df = journeys_df.filter(partition_filter(partitions, 'rental_start_year_', 'rental_start_month_'))
+    journeys_df = journeys_df.withColumn('rental_date', to_date('rental_start_date'))
+
+    def journey_totals(df, *group_columns):
+        return df.groupBy(*group_columns) \
+            .agg(count('*').alias('journeys'),
+                 spark_sum('rental_duration_seconds').alias('total_duration_seconds')) \
+            .withColumn('avg_duration_seconds', col('total_duration_seconds') / col('journeys'))
+
+    day_columns = ['rental_date', 'rental_start_year', 'rental_start_month', 'rental_start_day']
+
+    # Journeys per start station and day
+    write_table(spark, journey_totals(journeys_df, 'start_station_id', *day_columns), output_data,
+                'rollup_station_daily', overwrite_mode)
+
+    # Journeys per weekday and hour of each month
+    hour_of_week_df = journeys_df.withColumn('weekday', dayofweek('rental_start_date')) \
+        .withColumn('hour', hour('rental_start_date'))
+    write_table(spark, journey_totals(hour_of_week_df, 'rental_start_year', 'rental_start_month', 'weekday', 'hour'),
+                output_data, 'rollup_hour_of_week', overwrite_mode)
+
+    # Journey distances per day, aggregated apart from the journeys so no journey level join is needed
+    distances_df = spark.read.parquet(output_data + 'journey_distances')
+    weather_df = spark.read.parquet(output_data + 'weather')
+    if partitions is not None:
+        distances_df = distances_df.filter(partition_filter(partitions, 'rental_start_year_', 'rental_start_month_'))
+        weather_df = weather_df.filter(partition_filter(partitions, 'year_', 'month_'))
+    daily_distances_df = distances_df.groupBy('rental_start_year', 'rental_start_month', 'rental_start_day') \
+        .agg(count('journey_distance_km').alias('distance_journeys'),
+             spark_sum('journey_distance_km').alias('total_distance_km')) \
+        .withColumn('avg_journey_distance_km', spark_round(col('total_distance_km') / col('distance_journeys'), 2))
+
+    # Daily totals enriched with the day's weather, both sides one row per day
+    daily_weather_df = weather_df.select(col('date').alias('rental_date'), 'conditions', 'avg_temp', 'precipitation')
+    daily_demand_df = journey_totals(journeys_df, *day_columns) \
+        .join(daily_distances_df, ['rental_start_year', 'rental_start_month', 'rental_start_day'], 'left') \
+        .join(broadcast(daily_weather_df), 'rental_date', 'left')
+    write_table(spark, daily_demand_df, output_data, 'rollup_daily_weather_demand', overwrite_mode)
+
+
+def stream_batch_snapshot(spark, output_data, partitions):
+    """Snapshots what a stream micro-batch appends to, so a failed attempt can be rolled back before it is replayed
+
+    :param spark: (object): Built spark session instance
+    :param output_data: (str): Path to AWS S3 bucket of written partitioned parquet files
+    :param partitions: (set): (year, month) partitions the micro-batch appends to
+    :return: (dict): Output data path, files of each appended partition directory and of the journey manifest, and
+        the ingest count record of each table the micro-batch adds to, None where there is none
+    """
+
+    directories = [output_data + 'manifests/journeys']
+    for name in STREAM_APPENDED_TABLES:
+        table = TABLES[name]
+        directories += [f'{output_data}{table.lake_path}/{table.lake_partitions[0]}={partition_year}/'
+                        f'{table.lake_partitions[1]}={partition_month}'
+                        for partition_year, partition_month in sorted(partitions)]
+    return {'output_data': output_data,
+            'files': {directory: [path for path, _ in list_files(spark, directory)] for directory in directories},
+            'ingest_counts': {name: read_text(spark, f'{output_data}{INGEST_COUNT_DIR}/{name}.json')
+                              for name in STREAM_APPENDED_TABLES}}
+
+
+def roll_back_stream_batch(spark, snapshot):
+    """Removes the files a failed stream micro-batch appended, and restores the ingest counts it added to
+
+    :param spark: (object): Built spark session instance
+    :param snapshot: (dict): Snapshot taken before the micro-batch appended, as per stream_batch_snapshot
+    """
+
+    for directory, files in snapshot['files'].items():
+        kept = set(files)
+        for path, _ in list_files(spark, directory):
+            if path not in kept:
+                delete_path(spark, path)
+    for name, text in snapshot['ingest_counts'].items():
+        path = f"{snapshot['output_data']}{INGEST_COUNT_DIR}/{name}.json"
+        if text is None:
+            delete_path(spark, path)
+        else:
+            write_text(spark, path, text)
+
+
+def record_batch_counts(spark, output_data, partitions, fact_journeys_table, dim_time_table):
+    """Records the ingest counts of a stream micro-batch, adding its journeys to those recorded for each partition
+
+    - The time dimension's months are rewritten whole, so their counts are replaced.
+
+    :param spark: (object): Built spark session instance
+    :param output_data: (str): Path to AWS S3 bucket of written partitioned parquet files
+    :param partitions: (set): (year, month) partitions appended to
+    :param fact_journeys_table: (object): Persisted journeys of the micro-batch
+    :param dim_time_table: (object): Time dimension of the micro-batch's months
+    """
+
+    no_end_station = when(col('end_station_id') > 0, 0).otherwise(1)
+    record_ingest_counts(spark, output_data, 'fact_journeys',
+                         partition_counts(fact_journeys_table, 'rental_start_year', 'rental_start_month',
+                                          deduplicated_rows=count(lit(1)),
+                                          end_station_dropped=spark_sum(no_end_station)),
+                         partitions, append=True)
+    record_ingest_counts(spark, output_data, 'dim_time',
+                         partition_counts(dim_time_table, 'year', 'month', rows=count(lit(1))), partitions)
+
+
+def process_journey_stream(spark, input_data, output_data, available_now=False, trigger_seconds=60,
+                           watermark='31 days', max_files_per_trigger=4, time_granularity_seconds=60):
+    """Ingests journey extracts as they land in the journey input directory, in Structured Streaming micro-batches
+
+    - Discovered files are tracked in a checkpoint, each extract is read once with the journey schema and staged with
+      the batch staging transforms.
+    - Duplicate rentals are dropped across micro-batches, the state store keeps each rental only until the watermark
+      on rental start passes it, so state stays bounded. Rentals starting before the watermark are dropped as late.
+    - Each micro-batch appends to the journeys and journey distances tables, rewrites the time dimension and rollups
+      of the months it touched, and records its source files in the journey manifest.
+    - Extracts already in the journey manifest, ingested by a batch run or an earlier micro-batch, are dropped from a
+      micro-batch. A new checkpoint finds every extract in the input directory, and rentals of a batch run are never
+      in the state store, so they would otherwise be appended twice.
+    - Each micro-batch adds its journeys and journey distances to the ingest counts of the partitions it appended to.
+    - A micro-batch is marked committed once written, so a batch replayed after a failure is not appended twice. The
+      files and ingest counts of the partitions it appends to are snapshotted first, so a batch replayed after failing
+      part way is rolled back to the snapshot before it appends again.
+
+    :param spark: (object): Built spark session instance
+    :param input_data: (str): Path to AWS S3 bucket source data
+    :param output_data: (str): Path to AWS S3 bucket of written partitioned parquet files
+    :param available_now: (bool): Process the files present now in micro-batches then stop, eg. run from cron
+    :param trigger_seconds: (int): Micro-batch interval when running continuously
+    :param watermark: (str): Delay behind the latest rental start before a rental is no longer deduplicated
+    :param max_files_per_trigger: (int): Maximum extract files in a micro-batch
+    :param time_granularity_seconds: (int): Time dimension slot length in seconds
+    """
+
+    checkpoint = output_data + 'checkpoints/journey_stream/'
+
+    raw_stream = spark.readStream.schema(JOURNEY_SCHEMA) \
+        .option("header", True) \
+        .option("maxFilesPerTrigger", max_files_per_trigger) \
+        .csv(os.path.join(input_data, JOURNEY_DATA)) \
+        .withColumn('source_file', input_file_name())
+
+    # event time is part of the duplicate key, a duplicate rental repeats its start date, so state can be expired
+    staged_stream = stage_journey_data(raw_stream) \
+        .withWatermark('rental_start_date', watermark) \
+        .dropDuplicates(['Rental Id', 'rental_start_date'])
+
+    def write_batch(batch_df, batch_id):
+        fs, marker = hadoop_path(spark, f'{checkpoint}committed/{batch_id}')
+        if fs.exists(marker):
+            print(f'Journey stream batch {batch_id} already committed, skipped')
+            return
+
+        # a batch that failed part way is rolled back before it is replayed
+        pending_path = f'{checkpoint}pending/{batch_id}.json'
+        pending = read_text(spark, pending_path)
+        if pending is not None:
+            roll_back_stream_batch(spark, json.loads(pending))
+            print(f'Journey stream batch {batch_id} rolled back after a failed attempt')
+
+        # the micro-batch is parsed and deduplicated once, for the file check and every table written
+        batch_df = batch_df.persist()
+        try:
+            ingested_files = {row['source_file'] for row in read_journey_manifest(spark, output_data)}
+            batch_files = [row['source_file'] for row in batch_df.select('source_file').distinct().collect()]
+            new_files = [path for path in batch_files if unquote(path) not in ingested_files]
+            if len(new_files) < len(batch_files):
+                print(f'Journey stream batch {batch_id}, {len(batch_files) - len(new_files)} extracts already '
+                      f'ingested, skipped')
+
+            fact_journeys_table = journey_fact(batch_df.filter(col('source_file').isin(new_files)),
+                                               time_granularity_seconds)
+            partitions = {(row['rental_start_year'], row['rental_start_month']) for row in
+                          fact_journeys_table.select('rental_start_year', 'rental_start_month').distinct().collect()}
+            if partitions:
+                write_text(spark, pending_path, json.dumps(stream_batch_snapshot(spark, output_data, partitions)))
+                dim_time_table = build_time_dimension(spark, fact_journeys_table, time_granularity_seconds)
+                write_table(spark, dim_time_table, output_data, 'dim_time', 'dynamic')
+                write_table(spark, fact_journeys_table, output_data, 'fact_journeys', 'append')
+                if RECORD_INGEST_COUNTS:
+                    record_batch_counts(spark, output_data, partitions, fact_journeys_table, dim_time_table)
+                journey_distance(spark, output_data, output_data, partitions, fact_journeys_table, 'append')
+                process_rollups(spark, output_data, partitions)
+                write_journey_manifest(spark, output_data, source_file_partitions(fact_journeys_table), 'append')
+        finally:
+            batch_df.unpersist()
+
+        fs.create(marker).close()
+        delete_path(spark, pending_path)
+        print(f'Journey stream batch {batch_id} committed, {len(partitions)} partitions appended')
+
+    writer = staged_stream.writeStream \
+        .foreachBatch(write_batch) \
+        .option("checkpointLocation", checkpoint)
+    if available_now:
+        writer = writer.trigger(availableNow=True)
+    else:
+        writer = writer.trigger(processingTime=f'{trigger_seconds} seconds')
+
+    writer.start().awaitTermination()
 
 
 def main():
     """Main script function"""
 
-    spark = create_spark_session()
-    input_data = config.get("S3", "INPUT_DATA")
-    output_data = config.get("S3", "OUTPUT_DATA")
+    parser = argparse.ArgumentParser(description='Process LndBikeHire source data to partitioned parquet files')
+    run_mode = parser.add_mutually_exclusive_group()
+    run_mode.add_argument('--incremental', action='store_true',
+                          help='only rewrite journey partitions touched by source files not yet ingested')
+    run_mode.add_argument('--backfill', nargs=2, metavar=('START', 'END'),
+                          help='rewrite journey partitions for an inclusive YYYY-MM month range')
+    run_mode.add_argument('--stream', action='store_true',
+                          help='ingest journey extracts as they land, appending in micro-batches')
+    parser.add_argument('--available-now', action='store_true',
+                        help='with --stream, process the extracts present now then stop')
+    parser.add_argument('--profile', choices=profile_names(),
+                        default=config.get('ETL', 'PROFILE', fallback=DEFAULT_PROFILE),
+                        help='Spark run profile, from spark_profiles.cfg or a [profile:<name>] section of dl.cfg')
+    parser.add_argument('--run-report', metavar='PATH', default=config.get('ETL', 'RUN_REPORT', fallback=None),
+                        help='write a JSON report of each stage\'s wall time and Spark metrics')
+    parser.add_argument('--prometheus-textfile', metavar='PATH',
+                        default=config.get('ETL', 'PROMETHEUS_TEXTFILE', fallback=None),
+                        help='write stage metrics for the Prometheus node exporter textfile collector')
+    parser.add_argument('--weather-json-lines', action='store_true',
+                        default=config.getboolean('ETL', 'WEATHER_JSON_LINES', fallback=False),
+                        help='convert nested weather files to line-delimited day records before reading them')
+    parser.add_argument('--stage-workers', type=int, default=config.getint('ETL', 'STAGE_WORKERS', fallback=3),
+                        help='maximum independent stages run at once')
+    parser.add_argument('--force', action='store_true',
+                        help='process docking station and weather files even if unchanged since the last run')
+    parser.add_argument('--resume', action='store_true',
+                        help='resume the last run, skipping the stages it completed, with the same arguments')
+    args = parser.parse_args()
+
+    if args.available_now and not args.stream:
+        parser.error('--available-now applies to --stream')
+    if args.resume and args.stream:
+        parser.error('--resume does not apply to --stream')
+
+    if args.stream:
+        mode = 'stream'
+    elif args.backfill:
+        mode = 'backfill'
+    elif args.incremental:
+        mode = 'incremental'
+    else:
+        mode = 'full'
+
+    # profile paths, eg. the local filesystem, take the place of the S3 config
+    profile = load_profile(args.profile)
+    input_data = profile.input_data or config.get("S3", "INPUT_DATA")
+    output_data = profile.output_data or config.get("S3", "OUTPUT_DATA")
+
+    # journey files are measured before the session starts, so memory can be sized as well as shuffle partitions
+    input_bytes = input_size(os.path.join(input_data, JOURNEY_DATA))
+    spark = create_spark_session(profile, input_bytes)
+
+    # streaming ingestion runs on its own, over the dimension tables of an earlier batch run
+    if args.stream:
+        process_journey_stream(spark, input_data, output_data, args.available_now,
+                               config.getint('ETL', 'STREAM_TRIGGER_SECONDS', fallback=60),
+                               config.get('ETL', 'STREAM_WATERMARK', fallback='31 days'),
+                               config.getint('ETL', 'STREAM_MAX_FILES_PER_TRIGGER', fallback=4),
+                               config.getint('ETL', 'TIME_GRANULARITY_SECONDS', fallback=60))
+        return
+
+    # a resumed run picks up from the stages the last run completed, with the bucket count the run started with
+    settings = {'rental_buckets': plan_rental_buckets(profile, input_bytes)} if mode == 'full' else {}
+    run = start_run(spark, output_data, 'etl', {'mode': mode, 'backfill': args.backfill, 'force': args.force},
+                    args.resume, settings)
+    if run is None:
+        return
+
+    # a full run sets the journey tables' bucket count, other runs keep the count the tables were written with
+    if mode == 'full':
+        spark.conf.set(RENTAL_BUCKETS_SETTING, str(run['settings']['rental_buckets']))
+
+    # stages are only instrumented when a report is requested
+    recorder = RunRecorder(spark, enabled=bool(args.run_report or args.prometheus_textfile))
+    memory_budget_mb = config.getint('ETL', 'STAGING_MEMORY_BUDGET_MB', fallback=2048)
+    time_granularity_seconds = config.getint('ETL', 'TIME_GRANULARITY_SECONDS', fallback=60)
+
+    # persisted journeys are shared by the journey distance and rollup stages, and released once the run is over,
+    # a resumed run that skips the journey stage reads the written journeys instead
+    journeys = {'df': None}
+
+    def journey_stage(results):
+        print(f'Processing journey data ({mode})...')
+        partitions, manifest_rows, journeys['df'] = process_journey_data(
+            spark, input_data, output_data, mode, args.backfill, memory_budget_mb, time_granularity_seconds)
+        return {'partitions': None if partitions is None else sorted(partitions),
+                'manifest_rows': manifest_rows, 'written': journeys['df'] is not None}
+
+    def journey_partitions(results):
+        partitions = results['process_journey_data']['partitions']
+        return None if partitions is None else {tuple(partition) for partition in partitions}
+
+    def journey_distance_stage(results):
+        if results['process_journey_data']['written']:
+            journey_distance(spark, output_data, output_data, journey_partitions(results), journeys['df'],
+                             bucket_partitioned=journeys['df'] is not None)
+            # both journey tables now hold the full run's buckets
+            if mode == 'full':
+                record_rental_buckets(spark, output_data, run['settings']['rental_buckets'])
+
+    def station_pair_stage(results):
+        # station pairs only change with the docking stations
+        if results['process_docking_station_data'] or \
+                not list_files(spark, output_data + 'infrastructure/station_pair_distances'):
+            process_station_pair_distances(spark, output_data)
+
+    def rollup_stage(results):
+        if results['process_journey_data']['written']:
+            process_rollups(spark, output_data, journey_partitions(results), journeys['df'])
 
-    print('Processing docking station data...')
-    process_docking_station_data(spark, input_data, output_data)
-    print('Docking station data processing complete!')
+    # the journey stages are the critical path, the dimension stages run alongside them in their own pool
+    stages = [
+        Stage('process_journey_data', journey_stage, pool='journeys'),
+        Stage('process_docking_station_data',
+              lambda results: process_docking_station_data(spark, input_data, output_data, args.force),
+              pool='dimensions'),
+        Stage('process_station_pair_distances', station_pair_stage, ['process_docking_station_data'], 'dimensions'),
+        Stage('process_weather_data',
+              lambda results: process_weather_data(spark, input_data, output_data, args.weather_json_lines,
+                                                   args.force),
+              pool='dimensions'),
+        Stage('journey_distance', journey_distance_stage, ['process_journey_data', 'process_station_pair_distances'],
+              'journeys'),
+        Stage('process_rollups', rollup_stage, ['journey_distance', 'process_weather_data'], 'journeys'),
+    ]
 
-    print('Processing journey data...')
-    process_journey_data(spark, input_data, output_data)
-    print('Journey data processing complete!')
+    # each stage commits a marker once its outputs are in place, a resumed run skips the stages with one
+    sources = {'process_journey_data': os.path.join(input_data, JOURNEY_DATA),
+               'process_docking_station_data': os.path.join(input_data, DIMENSION_SOURCES['dim_docking_stations']),
+               'process_weather_data': os.path.join(input_data, DIMENSION_SOURCES['dim_daily_weather'])}
+    stages = checkpoint_stages(spark, output_data, 'etl', run, stages, sources, STAGE_OUTPUTS)
 
-    print('Calculating journey distances...')
-    journey_distance(spark, output_data, output_data)
-    print('Journey distance calculations complete!')
+    try:
+        try:
+            results = run_stages(spark, stages, args.stage_workers, STAGE_POOL_LIMITS, recorder.stage)
+        finally:
+            if journeys['df'] is not None:
+                journeys['df'].unpersist(blocking=True)
 
-    print('Processing weather data...')
-    process_weather_data(spark, input_data, output_data)
-    print('Weather data processing complete!')
+        # new files without a staged row are recorded too, though no journeys were written
+        journey_result = results['process_journey_data']
+        if (journey_result['written'] or journey_result['manifest_rows']) and mode != 'backfill':
+            write_journey_manifest(spark, output_data, journey_result['manifest_rows'],
+                                   'overwrite' if mode == 'full' else 'append')
+        finish_run(spark, output_data, 'etl', run)
+    finally:
+        # a failed run is reported too, with its failed stages marked
+        if recorder.enabled:
+            report = recorder.report(profile=profile.name, mode=mode, input_data=input_data, output_data=output_data)
+            if args.run_report:
+                write_run_report(report, args.run_report)
+            if args.prometheus_textfile:
+                write_prometheus_textfile(report, args.prometheus_textfile)
 
     print('Woo... All Data Processed!')
 
@@ -0,0 +1,248 @@
+import argparse
+import calendar
+import json
+import math
+import random
+from datetime import date, timedelta
+
+from pyspark.sql.functions import col, lit, when, rand, randn, floor, least, greatest, pow as spark_pow, log, concat, \
+    date_format
+from pyspark.sql.types import TimestampType
+
+from etl import create_spark_session, JOURNEY_DATA
+from lake_fs import hadoop_path, list_files
+from spark_profiles import load_profile
+
+# generated journeys are for the year read by etl.py, in the layout of the TfL journey extracts
+YEAR = 2012
+FIRST_RENTAL_ID = 9000000
+SOURCE_TIMESTAMP_FORMAT = 'dd/MM/yyyy HH:mm'
+
+# share of journeys starting in the morning or evening commuter peak, the rest spread over the day
+PEAK_FRACTION = 0.45
+PEAK_HOURS = (8.0, 17.5)
+MEAN_DURATION_SECONDS = 1100
+
+# London docking station coordinate bounds
+LATITUDES = (51.45, 51.55)
+LONGITUDES = (-0.24, 0.02)
+
+# weather conditions, with their chance on a winter and a summer day
+WEATHER_CONDITIONS = {
+    'Clear': (0.15, 0.35),
+    'Partially cloudy': (0.30, 0.35),
+    'Overcast': (0.20, 0.10),
+    'Rain': (0.10, 0.10),
+    'Rain, Partially cloudy': (0.18, 0.10),
+    'Snow': (0.07, 0.00),
+}
+
+
+def station_name(station_id):
+    """Builds a synthetic docking station name from its id, quoted by the csv writer as the real names are"""
+
+    return concat(lit('Synthetic Street '), station_id.cast('string'), lit(', Area '), (station_id % 40).cast('string'))
+
+
+def skewed_station(seed, stations, skew):
+    """Picks a docking station id, low ids picked more often as skew rises above 1, uniformly at 1"""
+
+    return (floor(spark_pow(rand(seed), skew) * stations) + 1).cast('int')
+
+
+def generate_stations(spark, stations, seed=0):
+    """Generates docking stations in the layout of the FOI-0689-2122.csv station file
+
+    :param spark: (object): Built spark session instance
+    :param stations: (int): No. of docking stations
+    :param seed: (int): Random seed
+    :return: (object): Docking station dataframe, with the station file header names
+    """
+
+    return spark.range(1, stations + 1, numPartitions=1) \
+        .select(date_format(lit(f'{YEAR - 2}-07-01').cast('date'), 'MMM-yy').alias('Go live'),
+                station_name(col('id')).alias('Docking Station'),
+                col('id').cast('int').alias('Docking station ID'),
+                (floor(rand(seed) * 30) + 10).cast('int').alias('Docking points'),
+                (LATITUDES[0] + rand(seed + 1) * (LATITUDES[1] - LATITUDES[0])).alias('Latitude'),
+                (LONGITUDES[0] + rand(seed + 2) * (LONGITUDES[1] - LONGITUDES[0])).alias('Longitude'))
+
+
+def generate_journeys(spark, rows, stations, skew=1.0, bikes=12000, seed=0):
+    """Generates journeys in the layout of the TfL journey extracts
+
+    - Start times are spread over the year, with a share in the morning and evening commuter peaks.
+    - Durations are exponentially distributed, end times follow from them, both at minute resolution as extracted.
+    - Start and end stations are picked with the given skew, so popular stations can be modelled.
+
+    :param spark: (object): Built spark session instance
+    :param rows: (int): No. of journeys
+    :param stations: (int): No. of docking stations
+    :param skew: (float): Station popularity skew, 1 for uniform
+    :param bikes: (int): No. of bicycles
+    :param seed: (int): Random seed
+    :return: (object): Journey dataframe, with the journey extract header names and a 'start_epoch' ordering column
+    """
+
+    year_start = calendar.timegm(date(YEAR, 1, 1).timetuple())
+    days = 366 if calendar.isleap(YEAR) else 365
+
+    peak_seconds = when(rand(seed + 1) < 0.5, lit(PEAK_HOURS[0] * 3600)).otherwise(lit(PEAK_HOURS[1] * 3600))
+    time_of_day = when(rand(seed + 2) < PEAK_FRACTION, peak_seconds + randn(seed + 3) * 3600) \
+        .otherwise(rand(seed + 4) * 86400)
+    start_epoch = lit(year_start) + floor(rand(seed + 5) * days) * 86400 + \
+        least(greatest(time_of_day, lit(0)), lit(86399))
+    duration = least(floor(-log(rand(seed + 6) + 1e-9) * MEAN_DURATION_SECONDS) + 60, lit(86400)).cast('int')
+
+    return spark.range(rows, numPartitions=max(1, math.ceil(rows / 1000000))) \
+        .select((col('id') + FIRST_RENTAL_ID).cast('int').alias('Rental Id'),
+                (floor(start_epoch / 60) * 60).cast('long').alias('start_epoch'),
+                duration.alias('Duration'),
+                (floor(rand(seed + 7) * bikes) + 1).cast('int').alias('Bike Id'),
+                skewed_station(seed + 8, stations, skew).alias('StartStation Id'),
+                skewed_station(seed + 9, stations, skew).alias('EndStation Id')) \
+        .select('Rental Id', 'Duration', 'Bike Id',
+                date_format((col('start_epoch') + col('Duration')).cast(TimestampType()),
+                            SOURCE_TIMESTAMP_FORMAT).alias('End Date'),
+                'EndStation Id',
+                station_name(col('EndStation Id')).alias('EndStation Name'),
+                date_format(col('start_epoch').cast(TimestampType()), SOURCE_TIMESTAMP_FORMAT).alias('Start Date'),
+                'StartStation Id',
+                station_name(col('StartStation Id')).alias('StartStation Name'),
+                'start_epoch')
+
+
+def generate_weather(seed=0):
+    """Generates a year of London daily weather, in the layout of a Visual Crossing API response
+
+    :param seed: (int): Random seed
+    :return: (dict): Weather document with a 'days' array
+    """
+
+    rng = random.Random(seed)
+    days = []
+    day = date(YEAR, 1, 1)
+    while day.year == YEAR:
+        # 0 in mid winter, 1 in mid summer
+        season = (1 - math.cos(2 * math.pi * (day.timetuple().tm_yday - 15) / 365)) / 2
+        weights = [winter + (summer - winter) * season for winter, summer in WEATHER_CONDITIONS.values()]
+        conditions = rng.choices(list(WEATHER_CONDITIONS), weights)[0]
+        temp = round(4 + 14 * season + rng.gauss(0, 2.5), 1)
+        daylight_hours = 8 + 8.5 * season
+        sunrise = 12 - daylight_hours / 2
+        epoch = calendar.timegm(day.timetuple())
+
+        days.append({
+            'datetime': day.isoformat(),
+            'datetimeEpoch': epoch,
+            'tempmax': round(temp + rng.uniform(2, 6), 1),
+            'tempmin': round(temp - rng.uniform(2, 6), 1),
+            'temp': temp,
+            'humidity': round(rng.uniform(55, 95), 2),
+            'precip': round(rng.expovariate(0.4), 2) if 'Rain' in conditions or conditions == 'Snow' else 0.0,
+            'snow': 0.0 if conditions != 'Snow' else round(rng.uniform(0.5, 5), 1),
+            'windspeed': round(rng.uniform(5, 35), 1),
+            'pressure': round(rng.gauss(1013, 9), 1),
+            'cloudcover': round(rng.uniform(0, 100), 1),
+            'sunrise': f'{int(sunrise):02d}:{int(sunrise % 1 * 60):02d}:00',
+            'sunriseEpoch': epoch + int(sunrise * 3600),
+            'sunset': f'{int(sunrise + daylight_hours):02d}:{int((sunrise + daylight_hours) % 1 * 60):02d}:00',
+            'sunsetEpoch': epoch + int((sunrise + daylight_hours) * 3600),
+            'conditions': conditions,
+            'description': f'Synthetic {conditions.lower()} conditions throughout the day.',
+            'source': 'obs',
+        })
+        day += timedelta(days=1)
+
+    return {
+        'queryCost': len(days),
+        'latitude': 51.5064,
+        'longitude': -0.12721,
+        'resolvedAddress': 'London, England, United Kingdom',
+        'address': 'London',
+        'timezone': 'Europe/London',
+        'tzoffset': 0.0,
+        'days': days,
+    }
+
+
+def move_part_files(spark, temp_dir, target_paths):
+    """Renames the part files Spark wrote to a temporary directory to the given file paths, then removes the directory
+
+    :param spark: (object): Built spark session instance
+    :param temp_dir: (str): Directory Spark wrote to
+    :param target_paths: (list): File paths, in part file order
+    """
+
+    part_files = sorted(path for path, size in list_files(spark, temp_dir))
+    for part_file, target_path in zip(part_files, target_paths):
+        fs, target = hadoop_path(spark, target_path)
+        fs.mkdirs(target.getParent())
+        fs.delete(target, False)
+        fs.rename(hadoop_path(spark, part_file)[1], target)
+
+    fs, temp = hadoop_path(spark, temp_dir)
+    fs.delete(temp, True)
+
+
+def write_source_data(spark, input_data, rows, stations, skew=1.0, files=18, seed=0):
+    """Writes synthetic journey, docking station and weather source files, read by etl.py as the real ones
+
+    :param spark: (object): Built spark session instance
+    :param input_data: (str): Source data path, eg. 'data/source_data/'
+    :param rows: (int): No. of journeys
+    :param stations: (int): No. of docking stations
+    :param skew: (float): Station popularity skew, 1 for uniform
+    :param files: (int): No. of journey extract files, each covering a run of dates
+    :param seed: (int): Random seed
+    """
+
+    temp_dir = input_data + '_generating'
+    journey_dir = JOURNEY_DATA.rsplit('/', 1)[0]
+
+    # journeys, range partitioned on start time so each extract file covers a run of dates
+    journeys_df = generate_journeys(spark, rows, stations, skew, seed=seed)
+    files = max(1, min(files, rows))
+    journeys_df.repartitionByRange(files, 'start_epoch').sortWithinPartitions('start_epoch').drop('start_epoch') \
+        .write.mode('overwrite').option('header', True).csv(temp_dir)
+    move_part_files(spark, temp_dir, [f'{input_data}{journey_dir}/{index + 1:02d}. Journey Data Extract.csv'
+                                      for index in range(files)])
+
+    generate_stations(spark, stations, seed).coalesce(1) \
+        .write.mode('overwrite').option('header', True).csv(temp_dir)
+    move_part_files(spark, temp_dir, [f'{input_data}infrastructure/FOI-0689-2122.csv'])
+
+    spark.sparkContext.parallelize([json.dumps(generate_weather(seed), indent=4)], 1).saveAsTextFile(temp_dir)
+    move_part_files(spark, temp_dir, [f'{input_data}weather/london_weather_{YEAR}.json'])
+
+    print(f'Generated {rows} journeys in {files} files, {stations} docking stations and {YEAR} weather '
+          f'to {input_data}')
+
+
+def main():
+    """Synthetic data generator script function"""
+
+    parser = argparse.ArgumentParser(description='Generate synthetic LndBikeHire source data files')
+    parser.add_argument('--rows', type=int, default=1000000, help='No. of journeys, eg. 100000 to 100000000')
+    parser.add_argument('--stations', type=int, default=800)
+    parser.add_argument('--skew', type=float, default=1.0, help='station popularity skew, 1 for uniform')
+    parser.add_argument('--files', type=int, default=18, help='No. of journey extract files')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--profile', default='local-dev', help='Spark run profile, its input data path is written')
+    parser.add_argument('--output', help='source data path to write, defaults to the profile input data path')
+    args = parser.parse_args()
+
+    profile = load_profile(args.profile)
+    input_data = args.output or profile.input_data
+    if not input_data:
+        parser.error(f"profile '{args.profile}' has no input_data path, give --output")
+    if not input_data.endswith('/'):
+        input_data += '/'
+
+    spark = create_spark_session(profile)
+    write_source_data(spark, input_data, args.rows, args.stations, args.skew, args.files, args.seed)
+    spark.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import hashlib
+import json
+
+
+def hadoop_path(spark, path):
+    """Resolves a path to its Hadoop FileSystem and Path, so S3 and local paths are handled alike
+
+    :param spark: (object): Built spark session instance
+    :param path: (str): File or directory path, eg. 's3a://lnd-bikehire/journeys'
+    :return: (tuple): Hadoop FileSystem and Path java objects
+    """
+
+    jvm = spark.sparkContext._jvm
+    jpath = jvm.org.apache.hadoop.fs.Path(path)
+    return jpath.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration()), jpath
+
+
+def total_size(spark, paths):
+    """Sums the size of a list of files
+
+    :param spark: (object): Built spark session instance
+    :param paths: (list): File paths
+    :return: (int): Total size in bytes
+    """
+
+    total = 0
+    for path in paths:
+        fs, jpath = hadoop_path(spark, path)
+        total += fs.getFileStatus(jpath).getLen()
+    return total
+
+
+def list_files(spark, path):
+    """Recursively lists data files under a directory, skipping hidden and marker files such as '_SUCCESS'
+
+    :param spark: (object): Built spark session instance
+    :param path: (str): Directory path
+    :return: (list): (file path, size in bytes) tuples
+    """
+
+    fs, jpath = hadoop_path(spark, path)
+    if not fs.exists(jpath):
+        return []
+
+    files = []
+    iterator = fs.listFiles(jpath, True)
+    while iterator.hasNext():
+        status = iterator.next()
+        name = status.getPath().getName()
+        if not name.startswith(('_', '.')):
+            files.append((status.getPath().toString(), status.getLen()))
+    return files
+
+
+def read_text(spark, path):
+    """Reads a small text file, eg. a JSON record kept with the data lake
+
+    :param spark: (object): Built spark session instance
+    :param path: (str): File path
+    :return: (str): File text, None when the file doesn't exist
+    """
+
+    fs, jpath = hadoop_path(spark, path)
+    if not fs.exists(jpath):
+        return None
+    stream = fs.open(jpath)
+    try:
+        return spark.sparkContext._jvm.org.apache.commons.io.IOUtils.toString(stream, 'UTF-8')
+    finally:
+        stream.close()
+
+
+def write_text(spark, path, text):
+    """Writes a small text file, replacing any existing file
+
+    :param spark: (object): Built spark session instance
+    :param path: (str): File path
+    :param text: (str): File text
+    """
+
+    fs, jpath = hadoop_path(spark, path)
+    temporary = jpath.suffix('.tmp')
+    stream = fs.create(temporary, True)
+    try:
+        stream.write(bytearray(text.encode('utf-8')))
+    finally:
+        stream.close()
+
+    # the finished file replaces the old one, so a reader never sees a partly written file
+    if fs.exists(jpath):
+        fs.delete(jpath, False)
+    if not fs.rename(temporary, jpath):
+        raise OSError(f'Could not move {temporary.toString()} to {path}')
+
+
+def delete_path(spark, path):
+    """Deletes a file or directory and everything under it, if it exists
+
+    :param spark: (object): Built spark session instance
+    :param path: (str): File or directory path
+    """
+
+    fs, jpath = hadoop_path(spark, path)
+    if fs.exists(jpath):
+        fs.delete(jpath, True)
+
+
+def promote_staged(spark, staging_path, path, partitions_only=False):
+    """Moves a completely written staging directory into place, replacing the files it supersedes
+
+    - Files are only moved once every file is written, so a failed write leaves the existing files as they were.
+    - The whole directory is replaced, or with partitions_only each staged partition directory replaces its own, and
+      the table's other partitions are kept.
+    - Each destination directory is deleted, then the staged directory renamed into its place. Renames are atomic for
+      each directory on HDFS and local filesystems. On S3 a rename copies each file, so while a directory is moved
+      readers see it missing or part copied, and a failure part way through leaves it so until the table is
+      rewritten, eg. by resuming the run.
+
+    :param spark: (object): Built spark session instance
+    :param staging_path: (str): Staging directory, on the same filesystem as the destination
+    :param path: (str): Destination directory
+    :param partitions_only: (bool): Replace only the partition directories staged, eg. 'year_=2012/month_=5'
+    """
+
+    fs, staging = hadoop_path(spark, staging_path)
+    _, target = hadoop_path(spark, path)
+    jvm_path = spark.sparkContext._jvm.org.apache.hadoop.fs.Path
+
+    if partitions_only:
+        staging_root = fs.makeQualified(staging).toString().rstrip('/')
+        partition_dirs = set()
+        for file_path, _ in list_files(spark, staging_path):
+            relative_path = file_path[len(staging_root) + 1:]
+            if '/' in relative_path:
+                partition_dirs.add(relative_path.rsplit('/', 1)[0])
+        moves = [(jvm_path(staging, partition_dir), jvm_path(target, partition_dir))
+                 for partition_dir in sorted(partition_dirs)]
+    else:
+        moves = [(staging, target)]
+
+    for source, destination in moves:
+        if fs.exists(destination):
+            fs.delete(destination, True)
+        fs.mkdirs(destination.getParent())
+        if not fs.rename(source, destination):
+            raise OSError(f'Could not move {source.toString()} to {destination.toString()}')
+    if fs.exists(staging):
+        fs.delete(staging, True)
+
+
+def source_fingerprint(spark, pattern):
+    """Fingerprints the files matching a path pattern from their listing, no file contents are read
+
+    - Each file is identified by its path, size and the filesystem's checksum where it keeps one, eg. the S3 ETag with
+      fs.s3a.etag.checksum.enabled, or its modification time where it doesn't.
+    - The digest changes when a file is added, removed or changed.
+
+    :param spark: (object): Built spark session instance
+    :param pattern: (str): File path or glob pattern, eg. 's3a://lnd-bikehire/source_data/weather/*.json'
+    :return: (dict): Digest of the listing, and the files fingerprinted
+    """
+
+    fs, jpath = hadoop_path(spark, pattern)
+    files = []
+    for status in fs.globStatus(jpath) or []:
+        if not status.isFile():
+            continue
+        checksum = fs.getFileChecksum(status.getPath())
+        files.append({'path': status.getPath().toString(),
+                      'size': status.getLen(),
+                      'checksum': checksum.toString() if checksum is not None else None,
+                      'modified': status.getModificationTime() if checksum is None else None})
+
+    files.sort(key=lambda file: file['path'])
+    digest = hashlib.sha256(json.dumps(files, sort_keys=True).encode('utf-8')).hexdigest()
+    return {'digest': digest, 'files': files}
@@ -0,0 +1,197 @@
+import argparse
+import configparser
+import os
+import posixpath
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+
+import pyarrow.parquet as pq
+from pyarrow import fs
+
+from spark_profiles import DEFAULT_PROFILE, profile_names, load_profile
+from table_definitions import TABLES, partition_key
+
+config = configparser.ConfigParser()
+config.read('aws/dl.cfg')
+
+
+def lake_filesystem(lake_data):
+    """Resolves the data lake location to an arrow filesystem and root path
+
+    :param lake_data: (str): Data lake path, eg. 's3a://lnd-bikehire/' or a local directory
+    :return: (tuple): Arrow filesystem, root path within it
+    """
+
+    if '://' in lake_data:
+        return fs.FileSystem.from_uri(re.sub(r'^s3a://', 's3://', lake_data))
+    return fs.LocalFileSystem(), os.path.abspath(lake_data)
+
+
+def parquet_files(filesystem, path):
+    """Lists the parquet data files under a table directory, skipping hidden and marker files such as '_SUCCESS'"""
+
+    return sorted(info.path for info in filesystem.get_file_info(fs.FileSelector(path, allow_not_found=True,
+                                                                                 recursive=True))
+                  if info.type == fs.FileType.File and not posixpath.basename(info.path).startswith(('_', '.')))
+
+
+def file_metadata(filesystem, path):
+    """Reads a parquet file's footer, no data pages are read"""
+
+    with filesystem.open_input_file(path) as file:
+        return pq.ParquetFile(file).metadata
+
+
+def partition_row_counts(filesystem, path, lake_partitions, workers=16):
+    """Counts the rows in each (year, month) partition of a table from its parquet file footers, no data is read
+
+    Footers are read concurrently, so a data lake on S3 is counted in a few round trips of its files.
+
+    :param filesystem: (object): Arrow filesystem of the data lake
+    :param path: (str): Table directory path
+    :param lake_partitions: (tuple): Year and month partition directory columns, eg. ('year_', 'month_')
+    :param workers: (int): No. of footers read at once
+    :return: (dict): Rows by partition key, as per table_definitions.partition_key
+    """
+
+    def partition_of(file_path):
+        values = [re.search(f'/{column}=(\\d+)/', file_path) for column in lake_partitions]
+        return partition_key(*(int(value.group(1)) if value else None for value in values))
+
+    file_paths = parquet_files(filesystem, path)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        file_rows = executor.map(lambda file_path: file_metadata(filesystem, file_path).num_rows, file_paths)
+
+        counts = {}
+        for file_path, rows in zip(file_paths, file_rows):
+            key = partition_of(file_path)
+            counts[key] = counts.get(key, 0) + rows
+    return counts
+
+
+def compression_report(filesystem, path):
+    """Reports the size of a table's parquet files against their uncompressed column data, from the file footers
+
+    :param filesystem: (object): Arrow filesystem of the data lake
+    :param path: (str): Table directory path
+    :return: (dict): File, row group and row counts, compressed and uncompressed bytes, compression ratio, codecs and
+        share of dictionary encoded column chunks
+    """
+
+    report = {'path': path, 'files': 0, 'row_groups': 0, 'rows': 0, 'compressed_bytes': 0, 'uncompressed_bytes': 0}
+    codecs = set()
+    column_chunks = dictionary_chunks = 0
+    for file_path in parquet_files(filesystem, path):
+        metadata = file_metadata(filesystem, file_path)
+        report['files'] += 1
+        report['row_groups'] += metadata.num_row_groups
+        report['rows'] += metadata.num_rows
+        for group_index in range(metadata.num_row_groups):
+            row_group = metadata.row_group(group_index)
+            for column_index in range(row_group.num_columns):
+                column = row_group.column(column_index)
+                report['compressed_bytes'] += column.total_compressed_size
+                report['uncompressed_bytes'] += column.total_uncompressed_size
+                codecs.add(column.compression)
+                column_chunks += 1
+                dictionary_chunks += int(column.has_dictionary_page)
+
+    report['compression_ratio'] = round(report['uncompressed_bytes'] / report['compressed_bytes'], 2) \
+        if report['compressed_bytes'] else None
+    report['codecs'] = sorted(codecs)
+    report['dictionary_chunk_share'] = round(dictionary_chunks / column_chunks, 2) if column_chunks else None
+    return report
+
+
+def comparable(value, bound):
+    """Brings a row group statistic to the type of a query bound, timestamps as naive UTC"""
+
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    if isinstance(bound, datetime) and not isinstance(value, datetime) and isinstance(value, date):
+        value = datetime(value.year, value.month, value.day)
+    return value
+
+
+def row_group_pruning(filesystem, path, predicates):
+    """Counts the row groups of a table a range query reads and skips, from the min/max statistics in file footers
+
+    A row group is skipped when, for any predicate column, its statistics hold no value in the predicate's range. A
+    row group without statistics for a column, eg. INT96 timestamps, is always read.
+
+    :param filesystem: (object): Arrow filesystem of the data lake
+    :param path: (str): Table directory path
+    :param predicates: (dict): Inclusive (low, high) range by column name
+    :return: (dict): Row groups and rows in total and skipped, and the share of row groups skipped
+    """
+
+    report = {'path': path, 'row_groups': 0, 'row_groups_skipped': 0, 'rows': 0, 'rows_skipped': 0}
+    for file_path in parquet_files(filesystem, path):
+        metadata = file_metadata(filesystem, file_path)
+        column_indexes = {metadata.schema.column(index).path: index for index in range(metadata.num_columns)}
+        for group_index in range(metadata.num_row_groups):
+            row_group = metadata.row_group(group_index)
+            skipped = False
+            for column_name, (low, high) in predicates.items():
+                if column_name not in column_indexes:
+                    continue
+                statistics = row_group.column(column_indexes[column_name]).statistics
+                if statistics is None or not statistics.has_min_max:
+                    continue
+                if comparable(statistics.max, low) < low or comparable(statistics.min, high) > high:
+                    skipped = True
+                    break
+            report['row_groups'] += 1
+            report['rows'] += row_group.num_rows
+            if skipped:
+                report['row_groups_skipped'] += 1
+                report['rows_skipped'] += row_group.num_rows
+
+    report['skipped_share'] = round(report['row_groups_skipped'] / report['row_groups'], 3) \
+        if report['row_groups'] else None
+    return report
+
+
+def main():
+    """Data lake parquet layout report script function"""
+
+    parser = argparse.ArgumentParser(description='Report compression and row group pruning of data lake tables')
+    parser.add_argument('--profile', choices=profile_names(),
+                        default=config.get('ETL', 'PROFILE', fallback=DEFAULT_PROFILE),
+                        help='Spark run profile, its output data path is reported on')
+    parser.add_argument('--tables', nargs='+', choices=list(TABLES), default=list(TABLES))
+    parser.add_argument('--query-table', choices=list(TABLES), default='fact_journeys',
+                        help='table of the sample station and date range query')
+    parser.add_argument('--station', type=int, default=1, help='sample query start station id')
+    parser.add_argument('--start', default='2012-05-01', help='sample query first date, YYYY-MM-DD')
+    parser.add_argument('--end', default='2012-05-07', help='sample query last date, YYYY-MM-DD')
+    args = parser.parse_args()
+
+    lake_data = load_profile(args.profile).output_data or config.get('S3', 'OUTPUT_DATA')
+    filesystem, root = lake_filesystem(lake_data)
+
+    mb = 1024 * 1024
+    for name in args.tables:
+        report = compression_report(filesystem, posixpath.join(root, TABLES[name].lake_path))
+        if report['files']:
+            print(f"{name:<30} {report['files']:>5} files {report['row_groups']:>6} row groups "
+                  f"{report['compressed_bytes'] / mb:>9.1f}MB, compression x{report['compression_ratio']} "
+                  f"{'/'.join(report['codecs'])}, {report['dictionary_chunk_share']:.0%} of column chunks dictionary "
+                  f"encoded")
+
+    # the query's date column is the table's first timestamp or date column
+    table = TABLES[args.query_table]
+    predicates = {'start_station_id': (args.station, args.station)}
+    date_column = next((column.name for column in table.columns if column.sql_type in ('TIMESTAMP', 'DATE')), None)
+    if date_column:
+        predicates[date_column] = (datetime.strptime(args.start, '%Y-%m-%d'),
+                                   datetime.strptime(args.end, '%Y-%m-%d').replace(hour=23, minute=59, second=59))
+    report = row_group_pruning(filesystem, posixpath.join(root, table.lake_path), predicates)
+    print(f"Sample query of {args.query_table}, {' and '.join(predicates)} in range: "
+          f"{report['row_groups_skipped']} of {report['row_groups']} row groups skipped, "
+          f"{report['rows'] - report['rows_skipped']} of {report['rows']} rows read")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import argparse
+import configparser
+import os
+import posixpath
+import re
+import time
+
+import duckdb
+
+from lake_metadata import lake_filesystem, parquet_files
+from spark_profiles import DEFAULT_PROFILE, profile_names, load_profile
+from table_definitions import TABLES
+
+config = configparser.ConfigParser()
+config.read('aws/dl.cfg')
+
+# the README queries on the data model, run unchanged over the data lake, and a star schema query of a single month
+SAMPLE_QUERIES = {
+    'rentals_per_month': """
+        SELECT f.rental_start_month,
+            COUNT(f.rental_id) AS "Rentals",
+            AVG(f.rental_duration_seconds/60) AS "Average Journey Duration (Mins)"
+        FROM fact_journeys f
+            WHERE f.rental_duration_seconds > 60
+        GROUP BY f.rental_start_month
+        ORDER BY f.rental_start_month""",
+    'distance_by_weather': """
+        SELECT f.rental_start_month AS "Rental Month",
+                ddw.conditions AS "Weather Condition",
+                ROUND(AVG(djd.journey_distance_km),1) AS "Average Journey Distance KM"
+        FROM fact_journeys f
+            LEFT JOIN dim_journey_distances djd ON f.rental_id = djd.rental_id
+            LEFT JOIN dim_daily_weather ddw ON f.rental_start_month = ddw.month AND f.rental_start_day = ddw.day_of_month
+        GROUP BY f.rental_start_month, ddw.conditions
+        ORDER BY f.rental_start_month""",
+    'distance_by_weather_rollup': """
+        SELECT rental_start_month AS "Rental Month",
+                conditions AS "Weather Condition",
+                ROUND(SUM(total_distance_km) / SUM(distance_journeys),1) AS "Average Journey Distance KM"
+        FROM rollup_daily_weather_demand
+        GROUP BY rental_start_month, conditions
+        ORDER BY rental_start_month""",
+    'busiest_stations_in_may': """
+        SELECT dds.docking_station_name AS "Docking Station",
+                COUNT(*) AS "Rentals",
+                ROUND(AVG(djd.journey_distance_km),1) AS "Average Journey Distance KM"
+        FROM fact_journeys f
+            JOIN dim_docking_stations dds ON f.start_station_id = dds.docking_station_id
+            LEFT JOIN dim_journey_distances djd ON f.rental_id = djd.rental_id
+                AND djd.rental_start_year = 2012 AND djd.rental_start_month = 5
+        WHERE f.rental_start_year = 2012 AND f.rental_start_month = 5
+        GROUP BY dds.docking_station_name
+        ORDER BY COUNT(*) DESC
+        LIMIT 10""",
+}
+
+
+def lake_uri(lake_data):
+    """Resolves the data lake location to a path DuckDB reads, eg. 's3://lnd-bikehire' or an absolute directory"""
+
+    if '://' in lake_data:
+        return re.sub(r'^s3a://', 's3://', lake_data).rstrip('/')
+    return os.path.abspath(lake_data)
+
+
+def table_view_sql(table, table_uri):
+    """Generates a view of a table over its parquet files, with the table's columns in table order
+
+    The table's year and month columns are read from the partition directory names, so a filter on them prunes whole
+    partitions before any file is opened. Other filters are pushed down to the parquet reader, which skips row groups
+    on their min/max statistics.
+
+    :param table: (object): Table definition
+    :param table_uri: (str): Directory of the table's parquet files
+    :return: (str): CREATE VIEW statement
+    """
+
+    lake_partitions = dict(zip(table.partitions, table.lake_partitions))
+    if lake_partitions:
+        source = f"read_parquet('{table_uri}/*/*/*.parquet', hive_partitioning = true)"
+    else:
+        source = f"read_parquet('{table_uri}/*.parquet')"
+    columns = ', '.join(f'CAST({lake_partitions[column.name]} AS INTEGER) AS {column.name}'
+                        if column.name in lake_partitions else column.name for column in table.columns)
+    return f'CREATE OR REPLACE VIEW {table.name} AS SELECT {columns} FROM {source}'
+
+
+def connect(lake_data, threads=None):
+    """Opens an in-memory DuckDB database with a view of each data lake table written by etl.py
+
+    No data is copied, queries read the parquet files where they are. Tables without files yet get no view.
+
+    :param lake_data: (str): Data lake path, eg. 's3a://lnd-bikehire/' or a local directory
+    :param threads: (int): Query threads, defaults to the No. of cores
+    :return: (object): DuckDB connection
+    """
+
+    con = duckdb.connect()
+    if threads:
+        con.execute(f'SET threads = {int(threads)}')
+
+    if '://' in lake_data:
+        con.execute('INSTALL httpfs')
+        con.execute('LOAD httpfs')
+        for setting, variable in (('s3_access_key_id', 'AWS_ACCESS_KEY_ID'),
+                                  ('s3_secret_access_key', 'AWS_SECRET_ACCESS_KEY'),
+                                  ('s3_region', 'AWS_DEFAULT_REGION')):
+            if os.environ.get(variable):
+                value = os.environ[variable].replace("'", "''")
+                con.execute(f"SET {setting} = '{value}'")
+
+    filesystem, root = lake_filesystem(lake_data)
+    for table in TABLES.values():
+        if not parquet_files(filesystem, posixpath.join(root, table.lake_path)):
+            print(f'No parquet files for {table.name}, no view created')
+            continue
+        con.execute(table_view_sql(table, f'{lake_uri(lake_data)}/{table.lake_path}'))
+    return con
+
+
+def query(con, sql, parameters=None):
+    """Runs a query, returning its result as an Arrow table
+
+    :param con: (object): DuckDB connection, as per connect
+    :param sql: (str): Query, with '?' or '$name' placeholders for parameters
+    :param parameters: (list): Query parameters
+    :return: (object): pyarrow Table
+    """
+
+    return con.execute(sql, parameters or []).arrow()
+
+
+def query_df(con, sql, parameters=None):
+    """Runs a query, returning its result as a pandas dataframe
+
+    The Arrow result is converted without copying where the column types allow, and its buffers are released as each
+    column is converted, so peak memory stays near one copy of the result.
+    """
+
+    return query(con, sql, parameters).to_pandas(split_blocks=True, self_destruct=True)
+
+
+def main():
+    """Data lake query script function"""
+
+    parser = argparse.ArgumentParser(description='Query the LndBikeHire parquet data lake, no warehouse required')
+    parser.add_argument('--profile', choices=profile_names(),
+                        default=config.get('ETL', 'PROFILE', fallback=DEFAULT_PROFILE),
+                        help='Spark run profile, its output data path is queried')
+    query_choice = parser.add_mutually_exclusive_group(required=True)
+    query_choice.add_argument('--sample', choices=list(SAMPLE_QUERIES), help='README sample query')
+    query_choice.add_argument('--sql', help='query over the fact, dimension and rollup tables')
+    parser.add_argument('--threads', type=int)
+    args = parser.parse_args()
+
+    if config.has_section('AWS'):
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', config['AWS']['AWS_ACCESS_KEY_ID'])
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', config['AWS']['AWS_SECRET_ACCESS_KEY'])
+
+    con = connect(load_profile(args.profile).output_data or config.get('S3', 'OUTPUT_DATA'), args.threads)
+    start = time.perf_counter()
+    result = query_df(con, SAMPLE_QUERIES[args.sample] if args.sample else args.sql)
+    elapsed = time.perf_counter() - start
+
+    print(result.to_string(index=False))
+    print(f'{len(result)} rows in {elapsed:.2f}s')
+    con.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+from statistics import median
+
+from pyspark.sql.functions import broadcast, col, ceil as spark_ceil, hash as spark_hash, pmod
+
+from lake_fs import list_files
+
+DEFAULT_TARGET_FILE_BYTES = 128 * 1024 * 1024
+DEFAULT_MAX_RECORDS_PER_FILE = 5000000
+
+# approximate uncompressed size of a value by spark type name, strings are a guess at typical length
+TYPE_BYTES = {
+    'boolean': 1,
+    'short': 2,
+    'integer': 4,
+    'date': 4,
+    'float': 4,
+    'long': 8,
+    'double': 8,
+    'timestamp': 8,
+    'string': 20,
+}
+
+# assumed parquet size relative to uncompressed values, only used to pick a file count
+ASSUMED_COMPRESSION_RATIO = 0.5
+
+
+def layout_options(layout):
+    """Builds parquet writer options from a table's file layout
+
+    :param layout: (object): ParquetLayout, None for Spark's defaults
+    :return: (dict): DataFrameWriter options
+    """
+
+    if layout is None:
+        return {}
+    return {
+        'compression': layout.codec,
+        'parquet.block.size': layout.row_group_mb * 1024 * 1024,
+        'parquet.page.size': layout.page_kb * 1024,
+        'parquet.enable.dictionary': str(layout.dictionary).lower(),
+    }
+
+
+def estimate_row_bytes(fields, compression_ratio=ASSUMED_COMPRESSION_RATIO):
+    """Estimates the written parquet size of a row from its column types
+
+    :param fields: (list): Spark StructFields written to the data files
+    :param compression_ratio: (float): Assumed parquet size relative to uncompressed values
+    :return: (int): Estimated bytes per row
+    """
+
+    raw_bytes = sum(TYPE_BYTES.get(field.dataType.typeName(), 8) for field in fields)
+    return max(1, int(raw_bytes * compression_ratio))
+
+
+def output_file_report(spark, path, partition_dirs, target_file_bytes):
+    """Reports the No. and size distribution of data files in written partitions
+
+    :param spark: (object): Built spark session instance
+    :param path: (str): Table directory path
+    :param partition_dirs: (set): Written partition directories relative to the table, eg. 'year_=2012/month_=5'
+    :param target_file_bytes: (int): Target file size in bytes
+    :return: (dict): File count, total, min, median and max size in bytes, No. of files under a quarter of target
+    """
+
+    sizes = [size for file_path, size in list_files(spark, path)
+             if any(f'/{partition_dir}/' in file_path for partition_dir in partition_dirs)]
+
+    report = {
+        'path': path,
+        'partitions': len(partition_dirs),
+        'files': len(sizes),
+        'total_bytes': sum(sizes),
+        'min_bytes': min(sizes, default=0),
+        'median_bytes': int(median(sizes)) if sizes else 0,
+        'max_bytes': max(sizes, default=0),
+        'small_files': sum(1 for size in sizes if size < target_file_bytes / 4),
+    }
+
+    mb = 1024 * 1024
+    print(f"Wrote {report['files']} files to {report['partitions']} partitions of {path}, "
+          f"{report['total_bytes'] / mb:.1f}MB total, file size min {report['min_bytes'] / mb:.1f}MB "
+          f"median {report['median_bytes'] / mb:.1f}MB max {report['max_bytes'] / mb:.1f}MB, "
+          f"{report['small_files']} under a quarter of the {target_file_bytes / mb:.0f}MB target")
+    return report
+
+
+def write_partitioned_parquet(spark, df, path, partition_columns, overwrite_mode='static',
+                              target_file_bytes=DEFAULT_TARGET_FILE_BYTES,
+                              max_records_per_file=DEFAULT_MAX_RECORDS_PER_FILE, layout=None):
+    """Writes a dataframe to partitioned parquet files, sized to a target file size
+
+    - Counts the rows of each output partition and estimates its written size from the column types.
+    - Spreads each partition's rows over just enough files to stay under the target file size, so small months get a
+      single file and large months get several, instead of a fixed repartition for every partition.
+    - Caps records per file, in case the size estimate is low for a partition.
+    - Sorts each file's rows by the layout's sort columns, and writes with its codec, row group, page size and
+      dictionary settings.
+    - Reports the No. and size distribution of the files produced.
+
+    :param spark: (object): Built spark session instance
+    :param df: (object): Dataframe to write, including partition columns
+    :param path: (str): Path of written partitioned parquet files
+    :param partition_columns: (list): Partition column names
+    :param overwrite_mode: (str): 'static' to replace the whole table, 'dynamic' to replace only partitions written,
+        'append' to add files to the partitions written
+    :param target_file_bytes: (int): Target file size in bytes
+    :param max_records_per_file: (int): Maximum records per file
+    :param layout: (object): ParquetLayout of the written files, None for Spark's defaults
+    :return: (dict): Output file report
+    """
+
+    data_fields = [field for field in df.schema.fields if field.name not in partition_columns]
+    rows_per_file = max(1, min(max_records_per_file, target_file_bytes // estimate_row_bytes(data_fields)))
+
+    # No. of files for each output partition
+    file_counts_df = df.groupBy(*partition_columns).count() \
+        .select(*[col(column).alias(f'_fc_{column}') for column in partition_columns],
+                spark_ceil(col('count') / rows_per_file).cast('int').alias('_file_count')) \
+        .cache()
+    file_counts = file_counts_df.collect()
+    total_files = sum(row['_file_count'] for row in file_counts)
+
+    # deterministic file number within each partition, hashed from the row values so task retries give the same split
+    join_condition = [df[column].eqNullSafe(file_counts_df[f'_fc_{column}']) for column in partition_columns]
+    sized_df = df.join(broadcast(file_counts_df), join_condition) \
+        .withColumn('_file_id', pmod(spark_hash(*[field.name for field in data_fields]), col('_file_count'))) \
+        .drop('_file_count', *[f'_fc_{column}' for column in partition_columns])
+
+    # sorted by partition first, so the sort also meets the partitioned write's ordering and rows are sorted once
+    sort_columns = list(layout.sort_columns) if layout else []
+    writer = sized_df.repartition(max(1, total_files), *partition_columns, '_file_id') \
+        .drop('_file_id') \
+        .sortWithinPartitions(*partition_columns, *sort_columns) \
+        .write.partitionBy(*partition_columns) \
+        .options(**layout_options(layout)) \
+        .option("maxRecordsPerFile", max_records_per_file)
+    if overwrite_mode == 'append':
+        writer = writer.mode("append")
+    else:
+        writer = writer.mode("overwrite").option("partitionOverwriteMode", overwrite_mode)
+    writer.parquet(path)
+
+    file_counts_df.unpersist()
+
+    partition_dirs = {'/'.join(f'{column}={row[f"_fc_{column}"]}' for column in partition_columns)
+                      for row in file_counts}
+    return output_file_report(spark, path, partition_dirs, target_file_bytes)
+
+
+def table_exists(spark, table_name):
+    """Checks the Spark catalog for a table"""
+
+    return any(table.name == table_name for table in spark.catalog.listTables())
+
+
+def register_bucketed_table(spark, table_name, path, schema, partition_columns, bucket_column, buckets,
+                            sort_columns=None, options=None):
+    """Registers bucketed parquet files written by an earlier session as a Spark table
+
+    - Spark keeps a table's bucketing in the catalog, not in its files, so each session registers the table over the
+      existing files before reading them as buckets or inserting into them.
+    - The bucket count and sort columns must be the ones the files were written with, changing them needs a full
+      rewrite.
+
+    :param spark: (object): Built spark session instance
+    :param table_name: (str): Spark table name
+    :param path: (str): Table directory path
+    :param schema: (object): StructType of the data files, partition columns last
+    :param partition_columns: (list): Partition column names
+    :param bucket_column: (str): Column the files are bucketed by
+    :param buckets: (int): No. of buckets
+    :param sort_columns: (list): Columns each bucket file is sorted by, defaults to the bucket column
+    :param options: (dict): Table options applied to inserts, eg. writer options of the layout
+    :return: (bool): True when the table is registered, False when no files have been written yet
+    """
+
+    if table_exists(spark, table_name):
+        return True
+    if not list_files(spark, path):
+        return False
+
+    columns = ', '.join(f'`{field.name}` {field.dataType.simpleString()}' for field in schema.fields)
+    sort_columns = sort_columns or [bucket_column]
+    table_options = ', '.join(f"'{key}' '{value}'" for key, value in (options or {}).items())
+    spark.sql(f"CREATE TABLE {table_name} ({columns}) USING parquet "
+              f"{f'OPTIONS ({table_options}) ' if table_options else ''}"
+              f"PARTITIONED BY ({', '.join(partition_columns)}) "
+              f"CLUSTERED BY ({bucket_column}) SORTED BY ({', '.join(sort_columns)}) INTO {buckets} BUCKETS "
+              f"LOCATION '{path}'")
+    spark.sql(f'ALTER TABLE {table_name} RECOVER PARTITIONS')
+    return True
+
+
+def write_bucketed_parquet(spark, df, path, table_name, partition_columns, bucket_column, buckets,
+                           overwrite_mode='static', bucket_partitioned=False,
+                           target_file_bytes=DEFAULT_TARGET_FILE_BYTES, layout=None):
+    """Writes a dataframe to partitioned parquet files bucketed by a key column, as a Spark table
+
+    - Within each partition, rows are hashed to a fixed No. of bucket files by the key, so Spark jobs reading two
+      tables bucketed alike by the same key join and aggregate on it bucket by bucket, with no shuffle.
+    - Each bucket file is sorted by the key, so joins on it skip the sort as well as the shuffle, and written with the
+      layout's codec, row group, page size and dictionary settings. A layout with sort columns opts in to sorting by
+      them instead, eg. station and date so row group statistics prune station and date range queries, at the cost
+      of Spark sorting every bucket again before a sort merge join on the key.
+    - Rows are hash partitioned into the buckets before the write, so each task writes one bucket's file per
+      partition. A dataframe already hash partitioned by the key into the bucket count is written as it is.
+    - Dynamic and append writes insert into the table registered afresh over the existing files, so the table's
+      bucketing is kept, and inserts take the layout and dynamic partition overwrite from the table's options.
+    - Reports the No. and size distribution of the files produced.
+
+    :param spark: (object): Built spark session instance
+    :param df: (object): Dataframe to write, including partition columns last
+    :param path: (str): Path of written partitioned parquet files
+    :param table_name: (str): Spark table name
+    :param partition_columns: (list): Partition column names
+    :param bucket_column: (str): Column the files are bucketed by
+    :param buckets: (int): No. of buckets
+    :param overwrite_mode: (str): 'static' to replace the whole table, 'dynamic' to replace only partitions written,
+        'append' to add files to the partitions written
+    :param bucket_partitioned: (bool): Dataframe is already hash partitioned by the bucket column into the buckets
+    :param target_file_bytes: (int): Target file size in bytes, only used by the file report
+    :param layout: (object): ParquetLayout of the written files, None for Spark's defaults
+    :return: (dict): Output file report
+    """
+
+    sort_columns = list(layout.sort_columns) if layout and layout.sort_columns else [bucket_column]
+
+    if not bucket_partitioned:
+        df = df.repartition(buckets, bucket_column)
+
+    partition_dirs = {'/'.join(f'{column}={row[column]}' for column in partition_columns)
+                      for row in df.select(*partition_columns).distinct().collect()}
+
+    registered = False
+    if overwrite_mode != 'static':
+        # inserts don't take writer options, so the table is registered afresh with them, dropping it keeps its files
+        spark.sql(f'DROP TABLE IF EXISTS {table_name}')
+        registered = register_bucketed_table(spark, table_name, path, df.schema, partition_columns, bucket_column,
+                                             buckets, sort_columns,
+                                             {**layout_options(layout), 'partitionOverwriteMode': 'dynamic'})
+    if registered:
+        df.write.insertInto(table_name, overwrite=overwrite_mode == 'dynamic')
+    else:
+        df.write.partitionBy(*partition_columns) \
+            .bucketBy(buckets, bucket_column) \
+            .sortBy(*sort_columns) \
+            .options(**layout_options(layout)) \
+            .mode("overwrite") \
+            .option("path", path) \
+            .saveAsTable(table_name)
+
+    return output_file_report(spark, path, partition_dirs, target_file_bytes)
@@ -0,0 +1,483 @@
+import hashlib
+import json
+import posixpath
+import struct
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from itertools import chain, repeat
+
+import psycopg2
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from pyarrow import fs
+from psycopg2.pool import ThreadedConnectionPool
+
+from lake_metadata import lake_filesystem
+from sql_queries import ARN, load_fingerprint_table_create, load_run_table_creates
+from table_definitions import TABLES, FINGERPRINT_DIR, copy_sql, lake_location
+
+# PostgreSQL binary COPY framing
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('!h', -1)
+NULL_FIELD = struct.pack('!i', -1)
+
+# PostgreSQL timestamps and dates count from 2000-01-01
+POSTGRES_EPOCH_MICROSECONDS = 946684800 * 1000000
+POSTGRES_EPOCH_DAYS = 10957
+
+# fixed width column types: arrow type values are cast to, struct format of field length and value
+FIXED_WIDTH_TYPES = {
+    'smallint': (pa.int16(), '!ih'),
+    'integer': (pa.int32(), '!ii'),
+    'bigint': (pa.int64(), '!iq'),
+    'real': (pa.float32(), '!if'),
+    'double precision': (pa.float64(), '!id'),
+    'boolean': (pa.bool_(), '!i?'),
+    'timestamp without time zone': (pa.timestamp('us'), '!iq'),
+    'date': (pa.date32(), '!ii'),
+}
+TEXT_TYPES = {'character varying', 'character', 'text'}
+
+DEFAULT_BATCH_ROWS = 65536
+COPY_READ_BYTES = 1024 * 1024
+
+
+def connection_dsn(config, section):
+    """Builds a psycopg2 connection string from a config file section
+
+    :param config: (object): ConfigParser with HOST, DB_NAME, DB_USER, DB_PASSWORD and DB_PORT in the section
+    :param section: (str): Config section, eg. 'CLUSTER' for Redshift or 'POSTGRES' for a local database
+    :return: (str): Connection string
+    """
+
+    return "host={} dbname={} user={} password={} port={}".format(
+        *(config.get(section, key) for key in ('HOST', 'DB_NAME', 'DB_USER', 'DB_PASSWORD', 'DB_PORT')))
+
+
+def encode_column(array, data_type):
+    """Encodes an arrow array as PostgreSQL binary COPY fields
+
+    :param array: (object): Arrow array of column values
+    :param data_type: (str): PostgreSQL column data type, as per information_schema.columns
+    :return: (list): Encoded field, length prefixed, for each value
+    """
+
+    if data_type in FIXED_WIDTH_TYPES:
+        arrow_type, field_format = FIXED_WIDTH_TYPES[data_type]
+        array = array.cast(arrow_type)
+        if data_type == 'timestamp without time zone':
+            array = pc.subtract(array.cast(pa.int64()), POSTGRES_EPOCH_MICROSECONDS)
+        elif data_type == 'date':
+            array = pc.subtract(array.cast(pa.int32()), POSTGRES_EPOCH_DAYS)
+
+        pack = struct.Struct(field_format).pack
+        value_size = struct.calcsize(field_format) - 4
+        return [NULL_FIELD if value is None else pack(value_size, value) for value in array.to_pylist()]
+
+    if data_type in TEXT_TYPES:
+        fields = []
+        for value in array.cast(pa.string()).to_pylist():
+            if value is None:
+                fields.append(NULL_FIELD)
+            else:
+                encoded = value.encode('utf-8')
+                fields.append(struct.pack('!i', len(encoded)) + encoded)
+        return fields
+
+    raise ValueError(f'Unsupported column type for binary COPY: {data_type}')
+
+
+class BinaryCopyStream:
+    """File-like stream of arrow record batches in PostgreSQL binary COPY format
+
+    Batches are encoded one at a time as the database reads the stream, so memory use is bounded by the batch size
+    rather than the table size.
+    """
+
+    def __init__(self, batches, data_types):
+        self.rows = 0
+        self._chunks = self._encode(batches, data_types)
+        self._chunk = b''
+        self._offset = 0
+
+    def _encode(self, batches, data_types):
+        yield PGCOPY_HEADER
+        field_count = struct.pack('!h', len(data_types))
+        for batch in batches:
+            columns = [encode_column(batch.column(index), data_type) for index, data_type in enumerate(data_types)]
+            self.rows += batch.num_rows
+            yield b''.join(chain.from_iterable(zip(repeat(field_count, batch.num_rows), *columns)))
+        yield PGCOPY_TRAILER
+
+    def read(self, size=-1):
+        while self._offset >= len(self._chunk):
+            self._chunk = next(self._chunks, None)
+            self._offset = 0
+            if self._chunk is None:
+                self._chunk = b''
+                return b''
+
+        if size < 0:
+            size = len(self._chunk) - self._offset
+        data = self._chunk[self._offset:self._offset + size]
+        self._offset += len(data)
+        return data
+
+
+def table_columns(cur, table):
+    """Gets a table's column names and data types, in table order"""
+
+    cur.execute("SELECT column_name, data_type FROM information_schema.columns "
+                "WHERE table_schema = 'public' AND table_name = %s ORDER BY ordinal_position", (table,))
+    return cur.fetchall()
+
+
+def partition_dirs(partition_columns, partitions):
+    """Lists the hive style directories of (year, month) partitions, eg. 'year_=2012/month_=5'
+
+    :param partition_columns: (tuple): Lake year and month partition column names
+    :param partitions: (set): (year, month) tuples
+    :return: (list): Partition directories relative to the table directory
+    """
+
+    year_column, month_column = partition_columns
+    return [f'{year_column}={partition_year}/{month_column}={partition_month}'
+            for partition_year, partition_month in sorted(partitions)]
+
+
+def redshift_backend(copy_queries, lake_data=None, table_paths=None, table_partitions=None):
+    """Builds a loader that runs Redshift COPY queries of S3 hosted parquet files
+
+    - Whole tables are loaded with the table's COPY query.
+    - Changed partitions are loaded with a COPY of each existing partition directory, into a given target table.
+
+    :param copy_queries: (dict): COPY query for each table
+    :param lake_data: (str): Data lake path, eg. 's3a://lnd-bikehire/', partition loads only
+    :param table_paths: (dict): Data lake directory of each table, partition loads only
+    :param table_partitions: (dict): Partition spec of each partitioned table, partition loads only
+    :return: (callable): Loader of a single table, given a cursor, table name, optional target table and partitions
+    """
+
+    def copy_table(cur, table, target=None, partitions=None):
+        if partitions is None:
+            cur.execute(copy_queries[table])
+            return cur.rowcount
+
+        filesystem, root = lake_filesystem(lake_data)
+        location = lake_location(lake_data)
+        rows = 0
+        for partition_dir in partition_dirs(table_partitions[table]['lake_columns'], partitions):
+            partition_path = posixpath.join(table_paths[table], partition_dir)
+            if filesystem.get_file_info(posixpath.join(root, partition_path)).type == fs.FileType.NotFound:
+                continue
+            cur.execute(copy_sql(TABLES[table], location, ARN, target, partition_dir))
+            rows += max(cur.rowcount, 0)
+        return rows
+
+    return copy_table
+
+
+def postgres_backend(lake_data, table_paths, table_partitions=None, batch_rows=DEFAULT_BATCH_ROWS):
+    """Builds a loader that streams partitioned parquet files into PostgreSQL with binary COPY FROM STDIN
+
+    Each table's parquet dataset is read in arrow record batches of the table's columns, no intermediate csv. Changed
+    partitions are loaded by pruning the dataset's hive style partition directories.
+
+    :param lake_data: (str): Data lake path, eg. 's3a://lnd-bikehire/' or a local directory
+    :param table_paths: (dict): Data lake directory of each table
+    :param table_partitions: (dict): Partition spec of each partitioned table, partition loads only
+    :param batch_rows: (int): Rows per record batch, bounding memory use per table
+    :return: (callable): Loader of a single table, given a cursor, table name, optional target table and partitions
+    """
+
+    filesystem, root = lake_filesystem(lake_data)
+
+    def copy_table(cur, table, target=None, partitions=None):
+        columns = table_columns(cur, table)
+        names = [name for name, _ in columns]
+
+        dataset = ds.dataset(posixpath.join(root, table_paths[table]), format='parquet',
+                             partitioning='hive', filesystem=filesystem)
+
+        partition_expression = None
+        if partitions is not None:
+            year_column, month_column = table_partitions[table]['lake_columns']
+            partition_expression = ds.scalar(False)
+            for partition_year, partition_month in sorted(partitions):
+                partition_expression = partition_expression | ((ds.field(year_column) == partition_year) &
+                                                               (ds.field(month_column) == partition_month))
+
+        batches = dataset.to_batches(columns=names, filter=partition_expression, batch_size=batch_rows)
+
+        stream = BinaryCopyStream(batches, [data_type for _, data_type in columns])
+        cur.copy_expert(f"COPY {target or table} ({', '.join(names)}) FROM STDIN WITH (FORMAT binary)", stream,
+                        size=COPY_READ_BYTES)
+        return stream.rows
+
+    return copy_table
+
+
+def upsert_backend(copy_table, table_partitions, partitions):
+    """Builds a loader merging changed partitions into a table, instead of a full reload
+
+    - Loads the changed partitions into a temporary staging table, like the target table.
+    - Deletes target rows with a staged key, and target rows in the changed partitions, then inserts the staged rows.
+    - Runs as a single transaction, committed by the caller, so readers never see a partly merged table.
+    - Table definitions are untouched, the work done scales with the changed partitions rather than the table.
+
+    :param copy_table: (callable): Loader of a single table from a redshift or postgres backend
+    :param table_partitions: (dict): Partition spec of each partitioned table, lake and table year and month columns
+        and key columns
+    :param partitions: (set): Changed (year, month) tuples
+    :return: (callable): Loader of a single table, given a cursor and table name
+    """
+
+    def upsert_table(cur, table):
+        spec = table_partitions[table]
+        stage = f'stage_{table}'
+
+        cur.execute(f'DROP TABLE IF EXISTS {stage}')
+        cur.execute(f'CREATE TEMP TABLE {stage} (LIKE {table})')
+        rows = copy_table(cur, table, stage, partitions)
+
+        key_match = ' AND '.join(f'{table}.{key} = {stage}.{key}' for key in spec['keys'])
+        cur.execute(f'DELETE FROM {table} USING {stage} WHERE {key_match}')
+
+        year_column, month_column = spec['columns']
+        partition_match = ' OR '.join(f'({year_column} = {partition_year} AND {month_column} = {partition_month})'
+                                      for partition_year, partition_month in sorted(partitions))
+        cur.execute(f'DELETE FROM {table} WHERE {partition_match}')
+
+        cur.execute(f'INSERT INTO {table} SELECT * FROM {stage}')
+        cur.execute(f'DROP TABLE {stage}')
+        return rows
+
+    return upsert_table
+
+
+def run_pooled(dsn, task, tables, workers=4, on_result=None):
+    """Runs a task for each table concurrently over a small connection pool, committing each table as it completes
+
+    :param dsn: (str): psycopg2 connection string
+    :param task: (callable): Task for a single table, given a cursor and table name
+    :param tables: (list): Table names
+    :param workers: (int): No. of tables run at once, and pooled connections
+    :param on_result: (callable): Optional callback given each table name and task result as it completes
+    :return: (dict): Task result for each table
+    """
+
+    pool = ThreadedConnectionPool(1, workers, dsn)
+
+    def run_table(table):
+        conn = pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                result = task(cur, table)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn)
+
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(run_table, table): table for table in tables}
+            for future in as_completed(futures):
+                table = futures[future]
+                results[table] = future.result()
+                if on_result:
+                    on_result(table, results[table])
+    finally:
+        pool.closeall()
+    return results
+
+
+def lake_fingerprints(lake_data, tables):
+    """Fingerprints the data lake's dimension tables from the source fingerprints etl.py recorded as it wrote them
+
+    The digest is of the whole record, written time included, so a table rewritten by etl.py is loaded again even when
+    its sources are unchanged, eg. after a forced run.
+
+    :param lake_data: (str): Data lake path, eg. 's3a://lnd-bikehire/' or a local directory
+    :param tables: (list): Table names
+    :return: (dict): Fingerprint digest of each table that has one
+    """
+
+    filesystem, root = lake_filesystem(lake_data)
+    digests = {}
+    for table in tables:
+        path = posixpath.join(root, FINGERPRINT_DIR, f'{table}.json')
+        if filesystem.get_file_info(path).type != fs.FileType.File:
+            continue
+        with filesystem.open_input_stream(path) as stream:
+            digests[table] = hashlib.sha256(stream.read()).hexdigest()
+    return digests
+
+
+def loaded_fingerprints(dsn):
+    """Gets the fingerprint digest of the data lake files last loaded to each table
+
+    :param dsn: (str): psycopg2 connection string
+    :return: (dict): Digest of each table loaded with a fingerprint, the record table is created if missing
+    """
+
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(load_fingerprint_table_create)
+            cur.execute("SELECT table_name, digest FROM load_fingerprints")
+            digests = dict(cur.fetchall())
+        conn.commit()
+    finally:
+        conn.close()
+    return digests
+
+
+def fingerprint_backend(copy_table, digests):
+    """Builds a loader replacing a fingerprinted table's rows and recording the fingerprint loaded
+
+    - The table's rows are deleted and its files copied in one transaction, committed by the caller, so a changed
+      dimension is replaced rather than appended to, and readers never see it empty.
+    - Tables without a fingerprint are loaded as they are.
+
+    :param copy_table: (callable): Loader of a single table from a redshift or postgres backend
+    :param digests: (dict): Fingerprint digest of each fingerprinted table's data lake files
+    :return: (callable): Loader of a single table, given a cursor and table name
+    """
+
+    def load_table(cur, table):
+        if table not in digests:
+            return copy_table(cur, table)
+
+        cur.execute(f'DELETE FROM {table}')
+        rows = copy_table(cur, table)
+        cur.execute("DELETE FROM load_fingerprints WHERE table_name = %s", (table,))
+        cur.execute("INSERT INTO load_fingerprints (table_name, digest, loaded_at) VALUES (%s, %s, %s)",
+                    (table, digests[table], datetime.utcnow()))
+        return rows
+
+    return load_table
+
+
+def lake_table_digests(lake_data, table_paths, tables):
+    """Fingerprints tables' data lake files from their listing, no file contents are read
+
+    :param lake_data: (str): Data lake path, eg. 's3a://lnd-bikehire/' or a local directory
+    :param table_paths: (dict): Data lake directory of each table
+    :param tables: (list): Table names
+    :return: (dict): Digest of each table's file paths, sizes and modification times
+    """
+
+    filesystem, root = lake_filesystem(lake_data)
+    digests = {}
+    for table in tables:
+        selector = fs.FileSelector(posixpath.join(root, table_paths[table]), allow_not_found=True, recursive=True)
+        files = sorted((info.path, info.size, info.mtime_ns) for info in filesystem.get_file_info(selector)
+                       if info.type == fs.FileType.File and not posixpath.basename(info.path).startswith(('_', '.')))
+        digests[table] = hashlib.sha256(json.dumps(files).encode('utf-8')).hexdigest()
+    return digests
+
+
+def start_load_run(dsn, arguments, resume=False):
+    """Starts a load run, or resumes the last one where it stopped
+
+    A resumed run keeps its run id and the tables it committed. It must be given the same arguments, so the committed
+    tables hold what it would have loaded.
+
+    :param dsn: (str): psycopg2 connection string
+    :param arguments: (dict): Load arguments that decide what is loaded, eg. backend, mode and partitions
+    :param resume: (bool): Resume the last run, a new run is started when there isn't one
+    :return: (tuple): Run id, and the data lake digest each table the run committed was loaded from. None when the
+        run resumed had already completed
+    """
+
+    arguments = json.dumps(arguments, sort_keys=True)
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            for query in load_run_table_creates:
+                cur.execute(query)
+            last_run = None
+            if resume:
+                cur.execute("SELECT run_id, arguments, completed_at FROM load_runs ORDER BY started_at DESC LIMIT 1")
+                last_run = cur.fetchone()
+                if last_run is None:
+                    print('No load to resume, starting a new load')
+
+            if last_run is None:
+                run = uuid.uuid4().hex, {}
+                cur.execute("INSERT INTO load_runs (run_id, arguments, started_at) VALUES (%s, %s, %s)",
+                            (run[0], arguments, datetime.utcnow()))
+            elif last_run[2] is not None:
+                print(f'Load {last_run[0]} completed at {last_run[2]}, nothing to resume')
+                run = None
+            elif last_run[1] != arguments:
+                raise ValueError(f'Load {last_run[0]} was started with {last_run[1]}, resume it with the same '
+                                 f'arguments, not {arguments}')
+            else:
+                cur.execute("SELECT table_name, digest FROM load_run_tables WHERE run_id = %s", (last_run[0],))
+                run = last_run[0], dict(cur.fetchall())
+                print(f'Resuming load {run[0]}, {len(run[1])} tables loaded')
+        conn.commit()
+    finally:
+        conn.close()
+    return run
+
+
+def finish_load_run(dsn, run_id):
+    """Records a load run as complete, so it isn't resumed"""
+
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("UPDATE load_runs SET completed_at = %s WHERE run_id = %s", (datetime.utcnow(), run_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def run_state_backend(load_table, run_id, digests, loaded=None):
+    """Builds a loader recording each table a load run commits, so a resumed run skips it
+
+    - The record is written in the table's load transaction, committed with the loaded rows or not at all.
+    - A table loaded earlier in the run, from data lake files that have since changed, has its rows deleted first, so
+      it is replaced rather than appended to.
+
+    :param load_table: (callable): Loader of a single table, given a cursor and table name
+    :param run_id: (str): Load run id, as per start_load_run
+    :param digests: (dict): Data lake digest of each table's files, as per lake_table_digests
+    :param loaded: (dict): Data lake digest of each table loaded earlier in the run, whose rows are replaced
+    :return: (callable): Loader of a single table, given a cursor and table name
+    """
+
+    loaded = loaded or {}
+
+    def load_run_table(cur, table):
+        if table in loaded:
+            cur.execute(f'DELETE FROM {table}')
+        rows = load_table(cur, table)
+        cur.execute("DELETE FROM load_run_tables WHERE run_id = %s AND table_name = %s", (run_id, table))
+        cur.execute("INSERT INTO load_run_tables (run_id, table_name, digest, loaded_at) VALUES (%s, %s, %s, %s)",
+                    (run_id, table, digests[table], datetime.utcnow()))
+        return rows
+
+    return load_run_table
+
+
+def load_tables(dsn, copy_table, tables, workers=4):
+    """Loads tables concurrently over a small connection pool, committing each table as it completes
+
+    :param dsn: (str): psycopg2 connection string
+    :param copy_table: (callable): Loader of a single table, given a cursor and table name
+    :param tables: (list): Table names
+    :param workers: (int): No. of tables loaded at once, and pooled connections
+    :return: (dict): Rows loaded to each table, -1 where the database doesn't report it
+    """
+
+    return run_pooled(dsn, copy_table, tables, workers,
+                      lambda table, rows: print(f'Success, {table} table data loaded! {rows} rows'))
@@ -0,0 +1,174 @@
+import argparse
+import configparser
+import json
+import posixpath
+import time
+
+import psycopg2
+from pyarrow import fs
+
+from lake_metadata import lake_filesystem, partition_row_counts
+from loaders import connection_dsn
+from spark_profiles import DEFAULT_PROFILE, profile_names, load_profile
+from sql_queries import table_statistics_queries
+from table_definitions import TABLES, INGEST_COUNT_DIR
+
+config = configparser.ConfigParser()
+config.read('aws/dl.cfg')
+
+# partitioned tables reconciled, and the ingest count of rows each table's lake partitions should hold
+RECONCILED_TABLES = {
+    'fact_journeys': 'deduplicated_rows',
+    'dim_time': 'rows',
+    'dim_journey_distances': 'rows',
+    'dim_daily_weather': 'rows',
+}
+
+
+def ingest_counts(filesystem, root, table):
+    """Reads the partition row counts etl.py recorded as it ingested a table, an empty dict when there are none
+
+    :param filesystem: (object): Arrow filesystem of the data lake
+    :param root: (str): Data lake root path
+    :param table: (str): Table name
+    :return: (dict): Counts by count name, by partition key
+    """
+
+    path = posixpath.join(root, INGEST_COUNT_DIR, f'{table}.json')
+    if filesystem.get_file_info(path).type != fs.FileType.File:
+        return {}
+    with filesystem.open_input_stream(path) as stream:
+        return json.loads(stream.read())['partitions']
+
+
+def reconcile_table(filesystem, root, table, workers=16):
+    """Diffs the rows in each partition of a table's parquet files against the rows counted as it was ingested
+
+    - Lake rows are read from parquet file footers, no data pages are read.
+    - A partition counted at ingest without files, or with files but not counted, is a difference too.
+
+    :param filesystem: (object): Arrow filesystem of the data lake
+    :param root: (str): Data lake root path
+    :param table: (str): Table name, as per RECONCILED_TABLES
+    :param workers: (int): No. of footers read at once
+    :return: (list): Dict of each partition; table, partition, ingested and lake rows, their difference, and every
+        count recorded at ingest
+    """
+
+    ingested = ingest_counts(filesystem, root, table)
+    lake = partition_row_counts(filesystem, posixpath.join(root, TABLES[table].lake_path),
+                                TABLES[table].lake_partitions, workers)
+
+    partitions = []
+    for key in sorted(set(ingested) | set(lake)):
+        counts = ingested.get(key)
+        expected = counts.get(RECONCILED_TABLES[table], 0) if counts is not None else None
+        lake_rows = lake.get(key, 0)
+        partitions.append({'table': table, 'partition': key, 'ingested': expected, 'lake': lake_rows,
+                           'diff': None if expected is None else lake_rows - expected, 'counts': counts or {}})
+    return partitions
+
+
+def journey_distance_inputs(partitions):
+    """Checks the journeys read by the journey distance stage against the journeys the journey stage wrote
+
+    :param partitions: (list): Reconciled partitions of the journeys and journey distances tables
+    :return: (list): (partition, journeys with an end station, journey distance stage input rows) of each differing
+        partition
+    """
+
+    journeys = {partition['partition']: partition['counts'] for partition in partitions
+                if partition['table'] == 'fact_journeys'}
+    differences = []
+    for partition in partitions:
+        if partition['table'] != 'dim_journey_distances' or partition['partition'] not in journeys:
+            continue
+        counts = journeys[partition['partition']]
+        with_end_station = counts.get('deduplicated_rows', 0) - counts.get('end_station_dropped', 0)
+        if with_end_station != partition['counts'].get('station_rows', 0):
+            differences.append((partition['partition'], with_end_station, partition['counts'].get('station_rows', 0)))
+    return differences
+
+
+def warehouse_statistics(dsn, backend, tables):
+    """Reads the planner's row estimate of each table from the warehouse catalog, no table is scanned
+
+    Estimates are as of each table's last ANALYZE, Redshift also reports how stale they are.
+
+    :param dsn: (str): psycopg2 connection string
+    :param backend: (str): 'redshift' or 'postgres'
+    :param tables: (list): Table names
+    :return: (dict): (estimated rows, % stale or None) of each table found, rows None when never analyzed
+    """
+
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(table_statistics_queries[backend], (tuple(tables),))
+            return {table: (rows if rows is not None and rows >= 0 else None,
+                            float(stats_off) if stats_off is not None else None)
+                    for table, rows, stats_off in cur.fetchall()}
+    finally:
+        conn.close()
+
+
+def main():
+    """Reconciliation script function"""
+
+    parser = argparse.ArgumentParser(description='Reconcile ingested, data lake and warehouse row counts from metadata')
+    parser.add_argument('--profile', choices=profile_names(),
+                        default=config.get('ETL', 'PROFILE', fallback=DEFAULT_PROFILE),
+                        help='Spark run profile, its output data path is reconciled')
+    parser.add_argument('--tables', nargs='+', choices=list(RECONCILED_TABLES), default=list(RECONCILED_TABLES))
+    parser.add_argument('--backend', choices=['redshift', 'postgres'],
+                        help='also compare table totals with warehouse statistics, [CLUSTER] or [POSTGRES] database')
+    parser.add_argument('--workers', type=int, default=16, help='No. of parquet footers read at once')
+    parser.add_argument('--output', help='write the per partition differences to a JSON file')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    lake_data = load_profile(args.profile).output_data or config.get('S3', 'OUTPUT_DATA')
+    filesystem, root = lake_filesystem(lake_data)
+
+    partitions = []
+    for table in args.tables:
+        partitions += reconcile_table(filesystem, root, table, args.workers)
+
+    differences = [partition for partition in partitions if partition['diff'] != 0]
+    for partition in differences:
+        counts = ', '.join(f'{name} {value}' for name, value in partition['counts'].items())
+        print(f"{partition['table']:<24} {partition['partition']:<13} ingested {partition['ingested']} "
+              f"lake {partition['lake']} diff {partition['diff']}" + (f' | {counts}' if counts else ''))
+    print(f'{len(differences)} of {len(partitions)} partitions differ between ingest counts and the data lake')
+
+    distance_inputs = journey_distance_inputs(partitions)
+    for key, with_end_station, station_rows in distance_inputs:
+        print(f'dim_journey_distances    {key:<13} read {station_rows} journeys, '
+              f'fact_journeys holds {with_end_station} with an end station')
+
+    totals = {}
+    for partition in partitions:
+        totals[partition['table']] = totals.get(partition['table'], 0) + partition['lake']
+    warehouse = {}
+    if args.backend:
+        section = 'CLUSTER' if args.backend == 'redshift' else 'POSTGRES'
+        warehouse = warehouse_statistics(connection_dsn(config, section), args.backend, args.tables)
+        for table in args.tables:
+            rows, stats_off = warehouse.get(table, (None, None))
+            diff = rows - totals.get(table, 0) if rows is not None else None
+            stale = f', statistics {stats_off}% stale' if stats_off is not None else ''
+            print(f'{table:<24} lake {totals.get(table, 0)} warehouse estimate {rows} diff {diff}{stale}')
+
+    print(f'Reconciled in {time.perf_counter() - start:.1f}s')
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'partitions': partitions, 'journey_distance_inputs': distance_inputs, 'lake_totals': totals,
+                       'warehouse': warehouse}, file, indent=2)
+        print(f'Results written to {args.output}')
+
+    if differences or distance_inputs:
+        raise SystemExit('Data lake partitions differ from their ingest counts!')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.error import URLError
+from urllib.request import urlopen
+
+# Spark REST API stage metrics summed over every stage attempt of an ETL stage, by report name
+STAGE_METRICS = {
+    'input_records': 'inputRecords',
+    'input_bytes': 'inputBytes',
+    'output_records': 'outputRecords',
+    'output_bytes': 'outputBytes',
+    'shuffle_read_bytes': 'shuffleReadBytes',
+    'shuffle_write_bytes': 'shuffleWriteBytes',
+    'memory_spilled_bytes': 'memoryBytesSpilled',
+    'disk_spilled_bytes': 'diskBytesSpilled',
+    'executor_run_time_ms': 'executorRunTime',
+}
+
+PROMETHEUS_PREFIX = 'lndbikehire_etl_stage'
+
+
+class RunRecorder:
+    """Records wall time and Spark metrics of each ETL stage, for a machine-readable run report
+
+    - Each stage runs under its own Spark job group, so its jobs and stages are found with the status tracker.
+    - Read and written rows and bytes, shuffle, spill and task skew are fetched once per ETL stage from the Spark UI
+      REST API after the stage completes, nothing is collected per task.
+    - Disabled, a stage only runs its body, no job group is set and nothing is fetched.
+    """
+
+    def __init__(self, spark, enabled=False):
+        self.spark = spark
+        self.enabled = enabled
+        self.stages = []
+        self.started_at = datetime.utcnow()
+
+    @contextmanager
+    def stage(self, name):
+        """Runs the body of an ETL stage, recording it when enabled
+
+        :param name: (str): Stage name, eg. 'process_journey_data'
+        """
+
+        if not self.enabled:
+            yield
+            return
+
+        sc = self.spark.sparkContext
+        sc.setJobGroup(name, name)
+        start = time.perf_counter()
+        status = 'failed'
+        try:
+            yield
+            status = 'succeeded'
+        finally:
+            elapsed = time.perf_counter() - start
+            sc.setLocalProperty('spark.jobGroup.id', None)
+
+            tracker = sc.statusTracker()
+            job_ids = sorted(tracker.getJobIdsForGroup(name))
+            stage_ids = sorted({stage_id for job_id in job_ids
+                                for stage_id in (getattr(tracker.getJobInfo(job_id), 'stageIds', None) or [])})
+
+            record = {'stage': name, 'status': status, 'wall_seconds': round(elapsed, 3),
+                      'job_ids': job_ids, 'stage_ids': stage_ids}
+            record.update(self.stage_metrics(stage_ids))
+            self.stages.append(record)
+            print(f"{name} {status} in {elapsed:.1f}s, {len(job_ids)} jobs, {len(stage_ids)} stages")
+
+    def api_url(self):
+        """Gets the Spark UI REST API url of the application, None when the UI is disabled"""
+
+        ui_url = self.spark.sparkContext.uiWebUrl
+        if not ui_url:
+            return None
+        return f'{ui_url}/api/v1/applications/{self.spark.sparkContext.applicationId}'
+
+    def stage_metrics(self, stage_ids):
+        """Sums REST API metrics over the attempts of the given Spark stages, with the worst task skew
+
+        Task skew is the slowest task's run time over the median task's, of the most skewed stage.
+
+        :param stage_ids: (list): Spark stage ids
+        :return: (dict): Metric values by report name, empty when the REST API is unavailable
+        """
+
+        api_url = self.api_url()
+        if api_url is None or not stage_ids:
+            return {}
+
+        metrics = dict.fromkeys(STAGE_METRICS, 0)
+        metrics['max_task_skew'] = 1.0
+        try:
+            for stage_id in stage_ids:
+                with urlopen(f'{api_url}/stages/{stage_id}', timeout=10) as response:
+                    attempts = json.load(response)
+                for attempt in attempts:
+                    for name, field in STAGE_METRICS.items():
+                        metrics[name] += attempt.get(field, 0)
+                    if attempt.get('status') != 'COMPLETE' or attempt.get('numTasks', 0) < 2:
+                        continue
+                    with urlopen(f"{api_url}/stages/{stage_id}/{attempt['attemptId']}/taskSummary"
+                                 f"?quantiles=0.5,1.0", timeout=10) as response:
+                        median_ms, max_ms = json.load(response)['executorRunTime']
+                    if median_ms > 0:
+                        metrics['max_task_skew'] = max(metrics['max_task_skew'], round(max_ms / median_ms, 2))
+        except (URLError, OSError, ValueError, KeyError) as error:
+            print(f'Stage metrics unavailable from the Spark REST API: {error}')
+            return {}
+        return metrics
+
+    def report(self, **run_info):
+        """Builds the run report
+
+        :param run_info: Run details recorded with the stages, eg. profile and mode
+        :return: (dict): Run report
+        """
+
+        sc = self.spark.sparkContext
+        return {
+            'application_id': sc.applicationId,
+            'started_at': self.started_at.isoformat(timespec='seconds') + 'Z',
+            'wall_seconds': round((datetime.utcnow() - self.started_at).total_seconds(), 3),
+            **run_info,
+            'stages': self.stages,
+        }
+
+
+def write_atomically(path, text):
+    """Writes a file by rename, so a reader such as a metrics collector never sees a partly written file"""
+
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as file:
+        file.write(text)
+    os.replace(temp_path, path)
+
+
+def write_run_report(report, path):
+    """Writes a run report as JSON"""
+
+    write_atomically(path, json.dumps(report, indent=2, default=str) + '\n')
+    print(f'Run report written to {path}')
+
+
+def prometheus_text(report):
+    """Formats a run report's stage metrics in the Prometheus text exposition format"""
+
+    names = ['wall_seconds'] + list(STAGE_METRICS) + ['max_task_skew']
+    lines = []
+    for name in names:
+        lines += [f'# HELP {PROMETHEUS_PREFIX}_{name} ETL stage {name.replace("_", " ")} of the last run',
+                  f'# TYPE {PROMETHEUS_PREFIX}_{name} gauge']
+        lines += [f'{PROMETHEUS_PREFIX}_{name}{{stage="{stage["stage"]}"}} {stage[name]}'
+                  for stage in report['stages'] if name in stage]
+    lines += [f'# HELP {PROMETHEUS_PREFIX}_succeeded ETL stage succeeded in the last run, 1 or 0',
+              f'# TYPE {PROMETHEUS_PREFIX}_succeeded gauge']
+    lines += [f'{PROMETHEUS_PREFIX}_succeeded{{stage="{stage["stage"]}"}} {int(stage["status"] == "succeeded")}'
+              for stage in report['stages']]
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus_textfile(report, path):
+    """Writes a run report's stage metrics to a Prometheus node exporter textfile collector file"""
+
+    write_atomically(path, prometheus_text(report))
+    print(f'Prometheus metrics written to {path}')
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import uuid
+from datetime import datetime
+
+from lake_fs import list_files, read_text, write_text, delete_path, source_fingerprint
+
+# data lake directory of each pipeline's run state; '<pipeline>/run.json', and a commit marker for each completed
+# stage, '<pipeline>/stages/<stage>.json'
+RUN_STATE_DIR = 'manifests/run_state'
+
+
+def start_run(spark, output_data, pipeline, arguments, resume=False, settings=None):
+    """Starts a pipeline run, or resumes the last run where it stopped
+
+    - A new run clears the commit markers of the previous run's stages.
+    - A resumed run keeps its run id and the markers of the stages it completed. It must be given the same arguments,
+      so the completed stages' outputs are the ones it would have written.
+    - Settings planned as a run starts, eg. from the run profile, are recorded with it. A resumed run keeps the
+      settings it started with, whatever it is given, so stages it runs match the stages it completed.
+
+    :param spark: (object): Built spark session instance
+    :param output_data: (str): Path to AWS S3 bucket of written parquet files
+    :param pipeline: (str): Pipeline name, eg. 'etl'
+    :param arguments: (dict): Run arguments that decide the stages' outputs, eg. mode and backfill range
+    :param resume: (bool): Resume the last run, a new run is started when there isn't one
+    :param settings: (dict): Run settings, recorded by a new run
+    :return: (dict): Run record, with the commit markers of its completed stages by stage name, None when the run
+        resumed had already completed
+    """
+
+    state_dir = f'{output_data}{RUN_STATE_DIR}/{pipeline}/'
+    recorded = read_text(spark, state_dir + 'run.json') if resume else None
+    if resume and recorded is None:
+        print('No run to resume, starting a new run')
+
+    if recorded is not None:
+        run = json.loads(recorded)
+        if run['status'] == 'complete':
+            print(f"Run {run['run_id']} completed at {run['completed_at']}, nothing to resume")
+            return None
+        if run['arguments'] != arguments:
+            raise ValueError(f"Run {run['run_id']} was started with {run['arguments']}, resume it with the same "
+                             f"arguments, not {arguments}")
+        markers = [json.loads(read_text(spark, path)) for path, _ in list_files(spark, state_dir + 'stages')
+                   if path.endswith('.json')]
+        run.setdefault('settings', settings or {})
+        run['markers'] = {marker['stage']: marker for marker in markers if marker['run_id'] == run['run_id']}
+        print(f"Resuming run {run['run_id']}, {len(run['markers'])} stages completed")
+        return run
+
+    delete_path(spark, state_dir + 'stages')
+    run = {'run_id': uuid.uuid4().hex, 'arguments': arguments, 'settings': settings or {}, 'status': 'running',
+           'started_at': datetime.utcnow().isoformat(timespec='seconds') + 'Z', 'completed_at': None}
+    write_text(spark, state_dir + 'run.json', json.dumps(run, indent=2))
+    return {**run, 'markers': {}}
+
+
+def finish_run(spark, output_data, pipeline, run):
+    """Records a run as complete, so it isn't resumed"""
+
+    record = {key: value for key, value in run.items() if key != 'markers'}
+    record.update(status='complete', completed_at=datetime.utcnow().isoformat(timespec='seconds') + 'Z')
+    write_text(spark, f'{output_data}{RUN_STATE_DIR}/{pipeline}/run.json', json.dumps(record, indent=2))
+
+
+def checkpoint_stages(spark, output_data, pipeline, run, stages, sources, outputs):
+    """Wraps pipeline stages to commit a marker as each completes, and to skip those a resumed run already completed
+
+    - A stage's input fingerprint is of its source files' listing and the input fingerprints of the stages it depends
+      on, so a changed source reruns its stage and every stage downstream of it.
+    - A completed stage is skipped when its input fingerprint is unchanged and its outputs are present, and the result
+      recorded in its marker is returned in place of running it. Stage results must be JSON serialisable.
+    - The marker is written once the stage's outputs are in place, so a stage interrupted part way is run again.
+
+    :param spark: (object): Built spark session instance
+    :param output_data: (str): Path to AWS S3 bucket of written parquet files
+    :param pipeline: (str): Pipeline name, eg. 'etl'
+    :param run: (dict): Run record, as per start_run
+    :param stages: (list): Stage definitions
+    :param sources: (dict): Source file path or glob pattern read by a stage, by stage name
+    :param outputs: (dict): Data lake directories written by a stage relative to output data, by stage name
+    :return: (list): Checkpointed stage definitions
+    """
+
+    input_digests = {}
+
+    def checkpointed(stage):
+        marker_path = f'{output_data}{RUN_STATE_DIR}/{pipeline}/stages/{stage.name}.json'
+        stage_outputs = [output_data + output for output in outputs.get(stage.name, [])]
+
+        def action(results):
+            fingerprint = [input_digests[dependency] for dependency in stage.depends_on]
+            if stage.name in sources:
+                fingerprint.append(source_fingerprint(spark, sources[stage.name])['digest'])
+            digest = input_digests[stage.name] = hashlib.sha256('|'.join(fingerprint).encode('utf-8')).hexdigest()
+
+            marker = run['markers'].get(stage.name)
+            if marker and marker['inputs'] == digest and all(list_files(spark, path) for path in stage_outputs):
+                print(f"Stage {stage.name} completed by run {run['run_id']} at {marker['completed_at']}, skipped")
+                return marker['result']
+
+            result = stage.action(results)
+            marker = {'run_id': run['run_id'], 'stage': stage.name, 'inputs': digest, 'outputs': stage_outputs,
+                      'result': result, 'completed_at': datetime.utcnow().isoformat(timespec='seconds') + 'Z'}
+            write_text(spark, marker_path, json.dumps(marker, indent=2))
+            return result
+
+        return stage._replace(action=action)
+
+    return [checkpointed(stage) for stage in stages]
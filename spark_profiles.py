@@ -0,0 +1,174 @@
+import configparser
+import glob
+import math
+import os
+import posixpath
+import re
+from collections import namedtuple
+from fnmatch import fnmatch
+
+PROFILE_FILES = ['spark_profiles.cfg', 'aws/dl.cfg']
+DEFAULT_PROFILE = 'emr-small'
+
+MB = 1024 * 1024
+
+# spark.* settings naming a file read by the driver, a relative path is resolved as per resolve_driver_file
+DRIVER_FILE_SETTINGS = ['spark.scheduler.allocation.file']
+
+# A named Spark run profile
+#   master, app_name: Spark master, None to leave it to spark-submit, and application name
+#   input_data, output_data: source and data lake paths, None to use the [S3] config
+#   sizing: dict of input size driven sizing options
+#   settings: dict of spark.* settings passed to the session as they are
+SparkProfile = namedtuple('SparkProfile', ['name', 'master', 'app_name', 'input_data', 'output_data', 'sizing',
+                                           'settings'])
+
+
+def read_profiles(profile_files=None):
+    """Reads the profile files, later files overriding earlier ones, keeping the case of spark.* keys"""
+
+    parser = configparser.ConfigParser(inline_comment_prefixes=('#',))
+    parser.optionxform = str
+    parser.read(profile_files or PROFILE_FILES)
+    return parser
+
+
+def profile_names(profile_files=None):
+    """Lists the names of the defined run profiles"""
+
+    return [section[len('profile:'):] for section in read_profiles(profile_files).sections()
+            if section.startswith('profile:')]
+
+
+def resolve_driver_file(path):
+    """Resolves a relative driver file path to the file next to this module, so the driver can run from any directory
+
+    A path with no file next to this module is left as it is, eg. a file shipped to the driver's working directory
+    with spark-submit --files in cluster mode.
+    """
+
+    local_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    if os.path.isabs(path) or '://' in path or not os.path.isfile(local_path):
+        return path
+    return local_path
+
+
+def load_profile(name, profile_files=None):
+    """Loads a named run profile
+
+    :param name: (str): Profile name, eg. 'local-dev'
+    :param profile_files: (list): Profile files, defaults to spark_profiles.cfg then aws/dl.cfg
+    :return: (object): SparkProfile
+    """
+
+    parser = read_profiles(profile_files)
+    section = f'profile:{name}'
+    if not parser.has_section(section):
+        raise ValueError(f"Unknown Spark profile '{name}', expected one of {', '.join(profile_names(profile_files))}")
+
+    options = parser[section]
+    return SparkProfile(
+        name=name,
+        master=options.get('master'),
+        app_name=options.get('app_name'),
+        input_data=options.get('input_data'),
+        output_data=options.get('output_data'),
+        sizing={key: options.getfloat(key) for key in ['shuffle_partition_mb', 'min_shuffle_partitions',
+                                                       'max_shuffle_partitions', 'memory_per_input_mb',
+                                                       'min_memory_mb', 'max_memory_mb', 'executors']},
+        settings={key: resolve_driver_file(value) if key in DRIVER_FILE_SETTINGS else value
+                  for key, value in options.items() if key.startswith('spark.')},
+    )
+
+
+def input_size(path):
+    """Measures the total bytes of the files matching a path, before any Spark session exists
+
+    - Local paths are matched with glob, remote paths list the parent directory and match the file name pattern.
+    - Remote paths are listed with pyarrow, the size is left unmeasured when pyarrow is not installed or the listing
+      fails.
+
+    :param path: (str): File path or glob, eg. 's3a://lnd-bikehire/source_data/journey/2012/*.csv'
+    :return: (int): Total bytes, None when unmeasured
+    """
+
+    if '://' not in path or path.startswith('file://'):
+        local_path = path[len('file://'):] if path.startswith('file://') else path
+        return sum(os.path.getsize(file_path) for file_path in glob.glob(local_path) if os.path.isfile(file_path))
+
+    try:
+        from pyarrow import fs
+    except ImportError:
+        print('Input size unmeasured, remote paths are measured with the pyarrow package')
+        return None
+
+    directory, pattern = posixpath.split(path)
+    try:
+        filesystem, root = fs.FileSystem.from_uri(re.sub(r'^s3a://', 's3://', directory))
+        file_infos = filesystem.get_file_info(fs.FileSelector(root, allow_not_found=True))
+    except OSError as error:
+        print(f'Input size unmeasured, could not list {directory}: {error}')
+        return None
+    return sum(info.size for info in file_infos
+               if info.type == fs.FileType.File and fnmatch(posixpath.basename(info.path), pattern))
+
+
+def sized_settings(profile, input_bytes):
+    """Derives shuffle partitions and memory from the input size, within the profile's bounds
+
+    - Shuffle partitions: one per shuffle_partition_mb of input. Adaptive query execution coalesces them further at
+      run time, so the count is an upper bound rather than a fixed setting.
+    - Memory: memory_per_input_mb for each MB of input, spread over the executors. Local profiles size the driver,
+      which runs every task.
+
+    :param profile: (object): SparkProfile
+    :param input_bytes: (int): Measured input size, None for the profile's minimum sizes
+    :return: (dict): spark.* settings
+    """
+
+    sizing = profile.sizing
+    input_mb = (input_bytes or 0) / MB
+    local = bool(profile.master and profile.master.startswith('local'))
+    executors = 1 if local else max(1, int(sizing['executors']))
+
+    shuffle_partitions = min(max(math.ceil(input_mb / sizing['shuffle_partition_mb']),
+                                 sizing['min_shuffle_partitions']), sizing['max_shuffle_partitions'])
+    memory_mb = min(max(math.ceil(input_mb * sizing['memory_per_input_mb'] / executors), sizing['min_memory_mb']),
+                    sizing['max_memory_mb'])
+
+    settings = {
+        'spark.sql.shuffle.partitions': str(int(shuffle_partitions)),
+        'spark.sql.adaptive.advisoryPartitionSizeInBytes': f"{int(sizing['shuffle_partition_mb'])}m",
+        'spark.driver.memory' if local else 'spark.executor.memory': f'{int(memory_mb)}m',
+    }
+    if not local:
+        settings['spark.executor.instances'] = str(executors)
+    return settings
+
+
+def task_slots(profile):
+    """Counts the tasks a profile runs at once, the driver's cores for a local master, executors times executor cores
+    on a cluster
+    """
+
+    if profile.master and profile.master.startswith('local'):
+        cores = re.match(r'local\[(\d+)', profile.master)
+        return int(cores.group(1)) if cores else os.cpu_count() or 1
+    return max(1, int(profile.sizing['executors'])) * int(profile.settings.get('spark.executor.cores', 1))
+
+
+def session_settings(profile, input_bytes):
+    """Combines sized settings with the profile's own spark.* settings, which take precedence"""
+
+    settings = sized_settings(profile, input_bytes)
+    settings.update(profile.settings)
+    return settings
+
+
+def log_effective_config(spark, profile, input_bytes, settings):
+    """Prints the run profile, measured input size and each setting's effective value in the Spark session"""
+
+    measured = f'{input_bytes / MB:.1f}MB' if input_bytes is not None else 'unmeasured'
+    print(f"Spark profile '{profile.name}', journey input {measured}, master {spark.sparkContext.master}")
+    for key in sorted(settings):
+        print(f'    {key} = {spark.conf.get(key, None)}')
@@ -0,0 +1,89 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import nullcontext
+
+# An ETL stage
+#   name: unique stage name, also its Spark job group
+#   action: callable given the dict of completed stage results by name, returning the stage's result
+#   depends_on: names of the stages that must complete first
+#   pool: Spark FAIR scheduler pool the stage's jobs run in
+Stage = namedtuple('Stage', ['name', 'action', 'depends_on', 'pool'], defaults=((), 'default'))
+
+
+def run_stage(spark, stage, results, stage_context):
+    """Runs a stage on a worker thread, its Spark jobs in the stage's pool and job group"""
+
+    sc = spark.sparkContext
+    sc.setLocalProperty('spark.scheduler.pool', stage.pool)
+    sc.setJobGroup(stage.name, stage.name)
+    print(f'Stage {stage.name} started in pool {stage.pool}')
+    with stage_context(stage.name):
+        result = stage.action(results)
+    print(f'Stage {stage.name} complete!')
+    return result
+
+
+def run_stages(spark, stages, max_workers=3, pool_limits=None, stage_context=None):
+    """Runs ETL stages on a thread pool, each as soon as the stages it depends on are complete
+
+    - Independent stages share the SparkContext concurrently, and with the FAIR scheduler each pool gets its share of
+      executors, so small dimension jobs don't queue behind a large journey shuffle.
+    - A pool limit caps the stages running in a pool at once, stages are otherwise started in declaration order.
+    - The first failure stops any further stage starting and cancels the Spark jobs of stages still running, then is
+      raised once they have stopped.
+
+    :param spark: (object): Built spark session instance
+    :param stages: (list): Stage definitions
+    :param max_workers: (int): Maximum stages running at once
+    :param pool_limits: (dict): Maximum stages running at once in a pool, by pool name
+    :param stage_context: (callable): Given a stage name, returns a context manager wrapping the stage, eg.
+        RunRecorder.stage
+    :return: (dict): Stage results by name
+    """
+
+    names = [stage.name for stage in stages]
+    unknown = {dependency for stage in stages for dependency in stage.depends_on} - set(names)
+    if len(set(names)) != len(names) or unknown:
+        raise ValueError(f'Stage names must be unique and dependencies declared, unknown: {sorted(unknown)}')
+
+    pool_limits = pool_limits or {}
+    stage_context = stage_context or (lambda name: nullcontext())
+    pending = list(stages)
+    running = {}
+    results = {}
+    failure = None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if failure is None:
+                for stage in list(pending):
+                    pool_running = sum(1 for other in running.values() if other.pool == stage.pool)
+                    if len(running) >= max_workers or pool_running >= pool_limits.get(stage.pool, max_workers):
+                        continue
+                    if all(dependency in results for dependency in stage.depends_on):
+                        pending.remove(stage)
+                        running[executor.submit(run_stage, spark, stage, results, stage_context)] = stage
+            else:
+                pending = []
+
+            if not running:
+                if pending:
+                    raise ValueError(f"Stage dependencies form a cycle: {', '.join(stage.name for stage in pending)}")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    results[stage.name] = future.result()
+                except Exception as error:
+                    if failure is not None:
+                        continue
+                    failure = error
+                    print(f'Stage {stage.name} failed, cancelling running stages: {error}')
+                    for other in running.values():
+                        spark.sparkContext.cancelJobGroup(other.name)
+
+    if failure is not None:
+        raise failure
+    return results
@@ -0,0 +1,322 @@
+from collections import namedtuple
+
+# A table column, as typed in the data warehouse and in Spark. Encoding defaults by SQL type when not given.
+Column = namedtuple('Column', ['name', 'sql_type', 'spark_type', 'not_null', 'encoding'], defaults=(False, None))
+
+# A data warehouse table and its parquet files in the data lake
+#   lake_path: data lake directory of the table's parquet files
+#   diststyle, distkey, sortkey: Redshift distribution style, distribution key column and compound sort key columns
+#   partitions: table year and month columns the parquet files are partitioned by
+#   lake_partitions: names of the matching partition directory columns in the data lake
+#   keys: columns identifying a row
+#   bucket_column: column the parquet files are bucketed by within each partition, a Spark table
+#   layout: parquet file layout, DEFAULT_LAYOUT when not given, a bucketed table's files are sorted by its bucket
+#     column unless its layout opts in to other sort columns
+Table = namedtuple('Table', ['name', 'lake_path', 'columns', 'diststyle', 'distkey', 'sortkey', 'partitions',
+                             'lake_partitions', 'keys', 'bucket_column', 'layout'],
+                   defaults=(None, (), (), (), (), None, None))
+
+# Parquet file layout of a table
+#   sort_columns: columns rows are sorted by within each file, so row group min/max statistics prune range queries
+#   codec: compression codec, eg. 'zstd' or 'snappy'
+#   row_group_mb, page_kb: parquet row group and page size
+#   dictionary: dictionary encode columns, falling back to plain encoding where a column's dictionary grows too large
+ParquetLayout = namedtuple('ParquetLayout', ['sort_columns', 'codec', 'row_group_mb', 'page_kb', 'dictionary'],
+                           defaults=((), 'zstd', 128, 1024, True))
+
+DEFAULT_LAYOUT = ParquetLayout()
+
+# data lake directory of the source fingerprints recorded with dimension tables, '<table>.json' for each table
+FINGERPRINT_DIR = 'manifests/fingerprints'
+
+# data lake directory of the partition row counts etl.py records as it ingests each table, '<table>.json' for each table
+INGEST_COUNT_DIR = 'manifests/ingest_counts'
+
+# Redshift column compression encodings by SQL type, the leading sort key column is always left raw
+DEFAULT_ENCODINGS = {
+    'INTEGER': 'az64',
+    'BIGINT': 'az64',
+    'TIMESTAMP': 'az64',
+    'DATE': 'az64',
+    'DOUBLE PRECISION': 'zstd',
+    'VARCHAR(255)': 'zstd',
+}
+
+TABLES = {table.name: table for table in [
+    Table('dim_docking_stations', 'infrastructure/docking_stations', [
+        Column('docking_station_live_date', 'VARCHAR(255)', 'string'),
+        Column('docking_station_name', 'VARCHAR(255)', 'string'),
+        Column('docking_station_id', 'INTEGER', 'integer', not_null=True),
+        Column('docking_points', 'INTEGER', 'integer'),
+        Column('docking_station_latitude', 'DOUBLE PRECISION', 'double'),
+        Column('docking_station_longitude', 'DOUBLE PRECISION', 'double'),
+    ], diststyle='ALL', sortkey=('docking_station_id',), keys=('docking_station_id',)),
+
+    Table('dim_time', 'time', [
+        Column('time_id', 'BIGINT', 'long', not_null=True),
+        Column('rental_start_date', 'TIMESTAMP', 'timestamp', not_null=True),
+        Column('hour', 'INTEGER', 'integer', not_null=True),
+        Column('day', 'INTEGER', 'integer', not_null=True),
+        Column('weekday', 'INTEGER', 'integer', not_null=True),
+        Column('week', 'INTEGER', 'integer', not_null=True),
+        Column('month', 'INTEGER', 'integer', not_null=True),
+        Column('year', 'INTEGER', 'integer', not_null=True),
+    ], diststyle='ALL', sortkey=('time_id',), partitions=('year', 'month'), lake_partitions=('year_', 'month_'),
+        keys=('time_id',), layout=ParquetLayout(('time_id',))),
+
+    Table('dim_journey_distances', 'journey_distances', [
+        Column('rental_id', 'INTEGER', 'integer', not_null=True),
+        Column('start_station_id', 'INTEGER', 'integer'),
+        Column('start_lat', 'DOUBLE PRECISION', 'double'),
+        Column('start_lon', 'DOUBLE PRECISION', 'double'),
+        Column('rental_start_year', 'INTEGER', 'integer'),
+        Column('rental_start_month', 'INTEGER', 'integer'),
+        Column('rental_start_day', 'INTEGER', 'integer'),
+        Column('end_station_id', 'INTEGER', 'integer'),
+        Column('end_lat', 'DOUBLE PRECISION', 'double'),
+        Column('end_lon', 'DOUBLE PRECISION', 'double'),
+        Column('journey_distance_km', 'DOUBLE PRECISION', 'double'),
+    ], diststyle='KEY', distkey='rental_id', sortkey=('rental_start_year', 'rental_start_month', 'rental_start_day'),
+        partitions=('rental_start_year', 'rental_start_month'),
+        lake_partitions=('rental_start_year_', 'rental_start_month_'), keys=('rental_id',), bucket_column='rental_id',
+        layout=ParquetLayout(row_group_mb=32)),
+
+    Table('dim_daily_weather', 'weather', [
+        Column('date', 'TIMESTAMP', 'date', not_null=True),
+        Column('year', 'INTEGER', 'integer'),
+        Column('month', 'INTEGER', 'integer'),
+        Column('day_of_month', 'INTEGER', 'integer'),
+        Column('conditions', 'VARCHAR(255)', 'string', encoding='bytedict'),
+        Column('description', 'VARCHAR(255)', 'string'),
+        Column('avg_temp', 'DOUBLE PRECISION', 'double'),
+        Column('min_temp', 'DOUBLE PRECISION', 'double'),
+        Column('max_temp', 'DOUBLE PRECISION', 'double'),
+        Column('precipitation', 'DOUBLE PRECISION', 'double'),
+        Column('windspeed', 'DOUBLE PRECISION', 'double'),
+        Column('sunrise', 'VARCHAR(255)', 'string'),
+        Column('sunset', 'VARCHAR(255)', 'string'),
+    ], diststyle='ALL', sortkey=('date',), partitions=('year', 'month'), lake_partitions=('year_', 'month_'),
+        keys=('date',), layout=ParquetLayout(('date',))),
+
+    Table('fact_journeys', 'journeys', [
+        Column('rental_id', 'INTEGER', 'integer', not_null=True),
+        Column('bike_id', 'INTEGER', 'integer'),
+        Column('rental_duration_seconds', 'INTEGER', 'integer'),
+        Column('start_station_id', 'INTEGER', 'integer'),
+        Column('rental_start_date', 'TIMESTAMP', 'timestamp'),
+        Column('end_station_id', 'INTEGER', 'integer'),
+        Column('rental_end_date', 'TIMESTAMP', 'timestamp'),
+        Column('rental_start_year', 'INTEGER', 'integer'),
+        Column('rental_start_month', 'INTEGER', 'integer'),
+        Column('rental_start_day', 'INTEGER', 'integer'),
+        Column('time_id', 'BIGINT', 'long'),
+    ], diststyle='KEY', distkey='rental_id', sortkey=('rental_start_date',),
+        partitions=('rental_start_year', 'rental_start_month'),
+        lake_partitions=('rental_start_year_', 'rental_start_month_'), keys=('rental_id',), bucket_column='rental_id',
+        layout=ParquetLayout(row_group_mb=32)),
+
+    # Dashboard rollups, aggregated from fact_journeys a month partition at a time
+    Table('rollup_station_daily', 'rollups/station_daily', [
+        Column('start_station_id', 'INTEGER', 'integer'),
+        Column('rental_date', 'DATE', 'date', not_null=True),
+        Column('rental_start_year', 'INTEGER', 'integer', not_null=True),
+        Column('rental_start_month', 'INTEGER', 'integer', not_null=True),
+        Column('rental_start_day', 'INTEGER', 'integer', not_null=True),
+        Column('journeys', 'BIGINT', 'long', not_null=True),
+        Column('total_duration_seconds', 'BIGINT', 'long'),
+        Column('avg_duration_seconds', 'DOUBLE PRECISION', 'double'),
+    ], diststyle='KEY', distkey='start_station_id', sortkey=('rental_date',),
+        partitions=('rental_start_year', 'rental_start_month'),
+        lake_partitions=('rental_start_year_', 'rental_start_month_'), keys=('start_station_id', 'rental_date'),
+        layout=ParquetLayout(('start_station_id', 'rental_date'))),
+
+    Table('rollup_hour_of_week', 'rollups/hour_of_week', [
+        Column('rental_start_year', 'INTEGER', 'integer', not_null=True),
+        Column('rental_start_month', 'INTEGER', 'integer', not_null=True),
+        Column('weekday', 'INTEGER', 'integer', not_null=True),
+        Column('hour', 'INTEGER', 'integer', not_null=True),
+        Column('journeys', 'BIGINT', 'long', not_null=True),
+        Column('total_duration_seconds', 'BIGINT', 'long'),
+        Column('avg_duration_seconds', 'DOUBLE PRECISION', 'double'),
+    ], diststyle='ALL', sortkey=('rental_start_year', 'rental_start_month'),
+        partitions=('rental_start_year', 'rental_start_month'),
+        lake_partitions=('rental_start_year_', 'rental_start_month_'),
+        keys=('rental_start_year', 'rental_start_month', 'weekday', 'hour')),
+
+    Table('rollup_daily_weather_demand', 'rollups/daily_weather_demand', [
+        Column('rental_date', 'DATE', 'date', not_null=True),
+        Column('rental_start_year', 'INTEGER', 'integer', not_null=True),
+        Column('rental_start_month', 'INTEGER', 'integer', not_null=True),
+        Column('rental_start_day', 'INTEGER', 'integer', not_null=True),
+        Column('journeys', 'BIGINT', 'long', not_null=True),
+        Column('total_duration_seconds', 'BIGINT', 'long'),
+        Column('avg_duration_seconds', 'DOUBLE PRECISION', 'double'),
+        Column('distance_journeys', 'BIGINT', 'long'),
+        Column('total_distance_km', 'DOUBLE PRECISION', 'double'),
+        Column('avg_journey_distance_km', 'DOUBLE PRECISION', 'double'),
+        Column('conditions', 'VARCHAR(255)', 'string', encoding='bytedict'),
+        Column('avg_temp', 'DOUBLE PRECISION', 'double'),
+        Column('precipitation', 'DOUBLE PRECISION', 'double'),
+    ], diststyle='ALL', sortkey=('rental_date',), partitions=('rental_start_year', 'rental_start_month'),
+        lake_partitions=('rental_start_year_', 'rental_start_month_'), keys=('rental_date',)),
+]}
+
+
+def column_names(table):
+    """Lists a table's column names, in table order"""
+
+    return [column.name for column in table.columns]
+
+
+def column_encoding(table, column):
+    """Gets a column's Redshift compression encoding, raw for the leading sort key column"""
+
+    if table.sortkey and column.name == table.sortkey[0]:
+        return 'raw'
+    return column.encoding or DEFAULT_ENCODINGS.get(column.sql_type, 'zstd')
+
+
+def create_table_sql(table, dialect='redshift'):
+    """Generates a CREATE TABLE query
+
+    :param table: (object): Table definition
+    :param dialect: (str): 'redshift' with column encodings, distribution and sort keys, or 'postgres' without them
+    :return: (str): SQL query
+    """
+
+    lines = []
+    for column in table.columns:
+        line = f'    {column.name} {column.sql_type}'
+        if column.not_null:
+            line += ' NOT NULL'
+        if dialect == 'redshift':
+            line += f' ENCODE {column_encoding(table, column)}'
+        lines.append(line)
+
+    attributes = ''
+    if dialect == 'redshift':
+        attributes = f' DISTSTYLE {table.diststyle}'
+        if table.distkey:
+            attributes += f' DISTKEY ({table.distkey})'
+        if table.sortkey:
+            attributes += f" COMPOUND SORTKEY ({', '.join(table.sortkey)})"
+
+    return f"CREATE TABLE IF NOT EXISTS {table.name} (\n" + ',\n'.join(lines) + f"\n){attributes};"
+
+
+def drop_table_sql(table):
+    """Generates a DROP TABLE query"""
+
+    return f'DROP TABLE IF EXISTS {table.name};'
+
+
+def lake_location(lake_data):
+    """Converts the Spark data lake path to the S3 location read by Redshift COPY, eg. 's3a://bucket/' to 's3://bucket'
+    """
+
+    location = lake_data.rstrip('/')
+    if location.startswith('s3a://'):
+        location = 's3://' + location[len('s3a://'):]
+    return location
+
+
+def partition_key(partition_year, partition_month):
+    """Names a (year, month) partition 'YYYY-MM', or 'unpartitioned' for rows without a year or month"""
+
+    if partition_year is None or partition_month is None:
+        return 'unpartitioned'
+    return f'{partition_year:04d}-{partition_month:02d}'
+
+
+def copy_sql(table, location, arn, target=None, partition_dir=None):
+    """Generates a Redshift COPY query of a table's parquet files
+
+    :param table: (object): Table definition
+    :param location: (str): S3 location of the data lake, as per lake_location
+    :param arn: (str): IAM role ARN used by Redshift to read from S3
+    :param target: (str): Table loaded, defaults to the defined table, eg. a staging table
+    :param partition_dir: (str): Partition directory to load, eg. 'year_=2012/month_=5', defaults to every partition
+    :return: (str): SQL query
+    """
+
+    path = f'{location}/{table.lake_path}/'
+    if partition_dir:
+        path += f'{partition_dir}/'
+    return f"COPY {target or table.name}\nFROM '{path}'\niam_role {arn}\nformat as parquet;"
+
+
+def spark_schema(table):
+    """Generates a table's Spark schema, nullable throughout so reading source data never fails on a missing value
+
+    :param table: (object): Table definition
+    :return: (object): Spark StructType
+    """
+
+    # Spark is imported here, so the SQL generated from the definitions doesn't need it
+    from pyspark.sql.types import StructType, StructField, _parse_datatype_string
+
+    return StructType([StructField(column.name, _parse_datatype_string(column.spark_type), True)
+                       for column in table.columns])
+
+
+def table_layout(table, overrides=None):
+    """Gets a table's parquet file layout, with any overridden settings
+
+    :param table: (object): Table definition
+    :param overrides: (dict): Layout settings as strings, eg. a [layout:fact_journeys] config section, keyed by
+        ParquetLayout field with 'sort_columns' comma separated
+    :return: (object): ParquetLayout
+    """
+
+    layout = table.layout or DEFAULT_LAYOUT
+    if not overrides:
+        return layout
+
+    settings = {}
+    if 'sort_columns' in overrides:
+        settings['sort_columns'] = tuple(column.strip() for column in overrides['sort_columns'].split(',')
+                                         if column.strip())
+    if 'codec' in overrides:
+        settings['codec'] = overrides['codec'].strip().lower()
+    for field in ('row_group_mb', 'page_kb'):
+        if field in overrides:
+            settings[field] = int(overrides[field])
+    if 'dictionary' in overrides:
+        settings['dictionary'] = overrides['dictionary'].strip().lower() in ('1', 'true', 'yes', 'on')
+
+    unknown = set(settings.get('sort_columns', ())) - set(column_names(table))
+    if unknown:
+        raise ValueError(f'{table.name} layout sort columns are not table columns: {sorted(unknown)}')
+    return layout._replace(**settings)
+
+
+def lake_schema(table):
+    """Generates the Spark schema of a table's parquet files, its columns followed by the partition directory columns
+
+    :param table: (object): Table definition
+    :return: (object): Spark StructType
+    """
+
+    from pyspark.sql.types import StructField, IntegerType
+
+    schema = spark_schema(table)
+    for lake_partition in table.lake_partitions:
+        schema = schema.add(StructField(lake_partition, IntegerType(), True))
+    return schema
+
+
+def spark_columns(table):
+    """Generates a select of a table's columns, in table order and cast to their Spark type
+
+    Partition directory columns follow for partitioned tables, copied from their table year and month columns.
+
+    :param table: (object): Table definition
+    :return: (list): Spark Columns
+    """
+
+    from pyspark.sql.functions import col
+
+    columns = [col(column.name).cast(column.spark_type).alias(column.name) for column in table.columns]
+    columns += [col(partition).alias(lake_partition)
+                for partition, lake_partition in zip(table.partitions, table.lake_partitions)]
+    return columns
@@ -0,0 +1,43 @@
+import pytest
+
+pytest.importorskip('pyspark')
+
+from etl import create_spark_session, process_docking_station_data, process_station_pair_distances, \
+    process_weather_data, process_journey_data, journey_distance, process_rollups, write_journey_manifest, \
+    process_journey_stream
+from generate_data import write_source_data
+from spark_profiles import load_profile
+
+
+@pytest.fixture(scope='module')
+def spark():
+    spark = create_spark_session(load_profile('local-dev'))
+    yield spark
+    spark.stop()
+
+
+def test_stream_after_batch_run_appends_nothing(spark, tmp_path):
+    """A stream started after a batch run skips the extracts the batch run ingested, so no rental is written twice"""
+
+    input_data = f'{tmp_path}/source_data/'
+    output_data = f'{tmp_path}/lake/'
+    write_source_data(spark, input_data, rows=2000, stations=50, files=3)
+
+    process_docking_station_data(spark, input_data, output_data)
+    process_station_pair_distances(spark, output_data)
+    process_weather_data(spark, input_data, output_data)
+    partitions, manifest_rows, journeys_df = process_journey_data(spark, input_data, output_data)
+    journey_distance(spark, output_data, output_data, partitions, journeys_df, bucket_partitioned=True)
+    process_rollups(spark, output_data, partitions, journeys_df)
+    journeys_df.unpersist(blocking=True)
+    write_journey_manifest(spark, output_data, manifest_rows, 'overwrite')
+
+    def row_counts():
+        return {path: spark.read.parquet(output_data + path).count() for path in ('journeys', 'journey_distances')}
+
+    batch_counts = row_counts()
+    assert batch_counts['journeys'] > 0
+
+    process_journey_stream(spark, input_data, output_data, available_now=True)
+
+    assert row_counts() == batch_counts
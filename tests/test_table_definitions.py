@@ -0,0 +1,96 @@
+import importlib
+import re
+
+import pytest
+
+from table_definitions import TABLES, create_table_sql, copy_sql, lake_location
+
+
+def column_line(sql, column):
+    """Gets the line of a column from a CREATE TABLE query, without its trailing comma"""
+
+    return next(line.strip().rstrip(',') for line in sql.splitlines() if line.strip().startswith(f'{column} '))
+
+
+@pytest.fixture
+def sql_queries(tmp_path, monkeypatch):
+    """Imports sql_queries with a config file holding an OUTPUT_DATA of its own"""
+
+    (tmp_path / 'aws').mkdir()
+    (tmp_path / 'aws' / 'dl.cfg').write_text("[S3]\nOUTPUT_DATA = s3a://test-lake/output/\n\n"
+                                             "[IAM_ROLE]\nARN = 'arn:aws:iam::123456789012:role/test'\n")
+    monkeypatch.chdir(tmp_path)
+    import sql_queries
+    yield importlib.reload(sql_queries)
+    monkeypatch.undo()
+    importlib.reload(sql_queries)
+
+
+def test_redshift_distribution_and_sort_keys():
+    """Journey tables are distributed on rental_id, station rollups on station id, journeys sorted on start date"""
+
+    fact_sql = create_table_sql(TABLES['fact_journeys'])
+    assert 'DISTSTYLE KEY DISTKEY (rental_id)' in fact_sql
+    assert 'COMPOUND SORTKEY (rental_start_date)' in fact_sql
+    assert 'DISTKEY (rental_id)' in create_table_sql(TABLES['dim_journey_distances'])
+    assert 'DISTKEY (start_station_id)' in create_table_sql(TABLES['rollup_station_daily'])
+    assert 'DISTSTYLE ALL' in create_table_sql(TABLES['dim_docking_stations'])
+
+
+def test_redshift_encodings_leave_leading_sort_key_raw():
+    """Every column is encoded, the leading sort key column raw so its zone maps stay effective"""
+
+    for table in TABLES.values():
+        sql = create_table_sql(table)
+        for column in table.columns:
+            line = column_line(sql, column.name)
+            assert re.search(r' ENCODE \w+$', line), line
+            if column.name == table.sortkey[0]:
+                assert line.endswith(' ENCODE raw')
+            else:
+                assert not line.endswith(' ENCODE raw')
+
+
+def test_postgres_dialect_has_no_redshift_attributes():
+    """The postgres dialect keeps the columns and NOT NULL constraints, without encodings, dist or sort keys"""
+
+    for table in TABLES.values():
+        sql = create_table_sql(table, dialect='postgres')
+        assert 'ENCODE' not in sql and 'DIST' not in sql and 'SORTKEY' not in sql
+        assert [column_line(sql, column.name).split()[0] for column in table.columns] == \
+               [column.name for column in table.columns]
+        assert sql.startswith(f'CREATE TABLE IF NOT EXISTS {table.name} (')
+    assert 'rental_id INTEGER NOT NULL' in create_table_sql(TABLES['fact_journeys'], dialect='postgres')
+
+
+def test_copy_paths_follow_configured_output_data(sql_queries):
+    """COPY reads each table's lake directory under the configured OUTPUT_DATA, as an s3:// location"""
+
+    assert sql_queries.LAKE_LOCATION == 's3://test-lake/output'
+    for name, table in TABLES.items():
+        query = sql_queries.table_copy_queries[name]
+        assert f"FROM 's3://test-lake/output/{table.lake_path}/'" in query
+        assert "iam_role 'arn:aws:iam::123456789012:role/test'" in query
+        assert query.startswith(f'COPY {name}\n')
+
+
+def test_copy_of_a_partition_into_a_staging_table():
+    """A partition load reads just its directory into the target table"""
+
+    query = copy_sql(TABLES['fact_journeys'], lake_location('s3a://lake/'), "'arn'", 'fact_journeys_staging',
+                     'rental_start_year_=2012/rental_start_month_=5')
+    assert query == ("COPY fact_journeys_staging\n"
+                     "FROM 's3://lake/journeys/rental_start_year_=2012/rental_start_month_=5/'\n"
+                     "iam_role 'arn'\nformat as parquet;")
+
+
+def test_queries_cover_every_table(sql_queries):
+    """Drop and create queries are generated for every defined table"""
+
+    for name in TABLES:
+        assert f'DROP TABLE IF EXISTS {name};' in sql_queries.drop_table_queries
+        assert any(query.startswith(f'CREATE TABLE IF NOT EXISTS {name} (')
+                   for query in sql_queries.create_table_queries)
+        assert any(query.startswith(f'CREATE TABLE IF NOT EXISTS {name} (')
+                   for query in sql_queries.postgres_create_table_queries)
+    assert list(sql_queries.table_copy_queries) == list(TABLES)
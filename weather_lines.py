@@ -0,0 +1,103 @@
+import codecs
+import json
+import posixpath
+import re
+from fnmatch import fnmatch
+
+from pyarrow import fs
+
+from lake_metadata import lake_filesystem
+
+READ_BYTES = 1024 * 1024
+
+# opening of the daily observations array in a Visual Crossing API response
+DAYS_ARRAY = re.compile(r'"days"\s*:\s*\[')
+
+
+def iter_days(stream, read_bytes=READ_BYTES):
+    """Streams the day objects of a nested weather JSON document, one at a time
+
+    - The document is read in fixed size chunks and each day object is decoded as soon as it is complete, so memory
+      stays at a chunk plus one day however many days the file holds.
+    - Only the 'days' array is decoded, the rest of the document is skipped.
+
+    :param stream: (object): Binary file-like object of the weather JSON document
+    :param read_bytes: (int): Bytes read at a time
+    :return: (generator): Day dicts
+    """
+
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+
+    def read_more():
+        nonlocal buffer
+        chunk = stream.read(read_bytes)
+        buffer += text_decoder.decode(chunk, final=not chunk)
+        return bool(chunk)
+
+    # skip to the days array, keeping enough of each chunk's end to match an opening split between chunks
+    while True:
+        match = DAYS_ARRAY.search(buffer)
+        if match:
+            position = match.end()
+            break
+        buffer = buffer[-32:]
+        if not read_more():
+            return
+
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            day, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # the next day object isn't complete yet, drop the decoded days and read on
+            buffer, position = buffer[position:], 0
+            if not read_more():
+                raise ValueError('Weather JSON document ended inside its days array')
+            continue
+        yield day
+
+
+def convert_weather_files(source_glob, target_dir, fields):
+    """Converts nested weather JSON files to line-delimited day records, read by Spark in parallel splits
+
+    - Each source file becomes a '.jsonl' file of the same name, one day per line with only the given fields.
+    - A source file is skipped when its converted file is newer, so repeated runs only convert changed files.
+
+    :param source_glob: (str): Weather file path pattern, eg. 's3a://lnd-bikehire/source_data/weather/*.json'
+    :param target_dir: (str): Directory of converted files, on the same filesystem type
+    :param fields: (list): Day fields kept
+    :return: (int): No. of days written
+    """
+
+    source_dir, pattern = posixpath.split(source_glob)
+    filesystem, source_root = lake_filesystem(source_dir)
+    target_filesystem, target_root = lake_filesystem(target_dir.rstrip('/'))
+    target_filesystem.create_dir(target_root, recursive=True)
+
+    days_written = 0
+    for info in filesystem.get_file_info(fs.FileSelector(source_root)):
+        name = posixpath.basename(info.path)
+        if info.type != fs.FileType.File or not fnmatch(name, pattern):
+            continue
+
+        target_path = posixpath.join(target_root, posixpath.splitext(name)[0] + '.jsonl')
+        target_info = target_filesystem.get_file_info(target_path)
+        if target_info.type == fs.FileType.File and target_info.mtime and info.mtime and \
+                target_info.mtime >= info.mtime:
+            continue
+
+        days = 0
+        with filesystem.open_input_stream(info.path) as source, \
+                target_filesystem.open_output_stream(target_path) as target:
+            for day in iter_days(source):
+                target.write((json.dumps({field: day.get(field) for field in fields}) + '\n').encode('utf-8'))
+                days += 1
+        print(f'Converted {days} days of {info.path} to {target_path}')
+        days_written += days
+
+    return days_written